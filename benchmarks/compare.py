@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# benchmarks/compare.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Compares two sets of results written by hotpaths.py or loadgen.py,
+printing the change in each benchmark and marking those that got worse by
+more than the threshold.
+
+    python benchmarks/compare.py [-t percent] [--fail] before.json after.json
+
+With --fail the exit status is 1 if anything got worse, so it can be used
+to check a change in a script.
+"""
+
+import sys
+import json
+
+from optparse import OptionParser
+
+# The figures compared, and whether a higher value is better
+METRICS = [
+    ('ops_per_sec', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+]
+
+# The details of where the results were taken that should match for the
+# comparison to mean anything.
+META = ('python', 'implementation', 'platform', 'machine', 'twisted')
+
+def load(path):
+    return json.load(open(path))
+
+def compare(before, after, threshold):
+    """
+    Returns a row for every figure of every benchmark in both results, and
+    the number of those that got worse by more than the threshold.
+    """
+    rows = []
+    regressions = 0
+    for name in sorted(set(before) & set(after)):
+        for metric, higher in METRICS:
+            if metric not in before[name] or metric not in after[name]:
+                continue
+            old, new = before[name][metric], after[name][metric]
+            change = (new - old) * 100.0 / old if old else 0.0
+            worse = -change if higher else change
+            flag = ''
+            if worse > threshold:
+                flag = 'WORSE'
+                regressions += 1
+            elif -worse > threshold:
+                flag = 'better'
+            rows.append((name, metric, old, new, change, flag))
+    return rows, regressions
+
+def main():
+    parser = OptionParser(usage='%prog [options] before.json after.json')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+        default=5.0, help='the percentage change to report as a regression '
+        '[default: %default]')
+    parser.add_option('--fail', dest='fail', action='store_true',
+        default=False, help='exit with status 1 if there are any regressions')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('two result files are required')
+
+    before, after = load(args[0]), load(args[1])
+    for key in META:
+        if before['meta'].get(key) != after['meta'].get(key):
+            print 'warning: %s differs: %s != %s' % (key,
+                before['meta'].get(key), after['meta'].get(key))
+
+    for name in sorted(set(before['results']) ^ set(after['results'])):
+        print 'warning: %s is only in one set of results' % name
+
+    rows, regressions = compare(before['results'], after['results'],
+        options.threshold)
+    print '%-32s %-12s %14s %14s %9s' % ('benchmark', 'figure', 'before',
+        'after', 'change')
+    for name, metric, old, new, change, flag in rows:
+        print '%-32s %-12s %14.2f %14.2f %+8.1f%% %s' % (name, metric, old,
+            new, change, flag)
+
+    if regressions:
+        print '%d figures got worse by more than %.1f%%' % (regressions,
+            options.threshold)
+    if regressions and options.fail:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#
+# benchmarks/harness.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Helpers shared by the benchmarks: requests faked in-process that go
+through the same site and resources as real ones, timing loops and
+writing results as JSON that compare.py can diff.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import subprocess
+
+from timeit import default_timer
+
+from twisted.internet.address import IPv4Address
+
+from corkscrew.jsonrpc import export
+from corkscrew.server import CorkscrewSite, StaticResources, TopLevelBase
+
+def make_rows(count, seed=1):
+    """
+    Returns a list of rows like those a web ui polls for, the same for
+    the same seed.
+    """
+    rand = random.Random(seed)
+    return [{
+        'id': i,
+        'name': 'torrent-%d' % rand.getrandbits(32),
+        'progress': rand.random() * 100,
+        'state': rand.choice(['Downloading', 'Seeding', 'Paused']),
+        'peers': [rand.getrandbits(16) for p in xrange(5)]
+    } for i in xrange(count)]
+
+def make_text(size, seed=1):
+    """
+    Returns text that compresses about as well as javascript, the same
+    for the same seed.
+    """
+    rand = random.Random(seed)
+    words = ['Ext', 'corkscrew', 'function', 'return', 'var', 'this', '{',
+        '}', 'config', 'el', 'render', 'store', 'null', '0', '1']
+    text = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text)[:size]
+
+class Bench(object):
+    """
+    The methods the benchmarks call, registered as `bench`.
+    """
+
+    def __init__(self, rows=500):
+        self.data = make_rows(rows)
+
+    @export
+    def echo(self, value):
+        return value
+
+    @export
+    def rows(self):
+        return self.data
+
+    @export(cacheable=True)
+    def cached_rows(self):
+        return self.data
+
+class BenchTopLevel(TopLevelBase):
+    """
+    A top level with the JSON-RPC interface at /json and a static script
+    at /js/app/app.js.
+    """
+
+    jsonrpc = 'json'
+
+    def __init__(self, path):
+        TopLevelBase.__init__(self)
+        self.json.register_object(Bench(), 'bench')
+
+        js = os.path.join(path, 'js')
+        if not os.path.isdir(js):
+            os.makedirs(js)
+            open(os.path.join(js, 'app.js'), 'wb').write(make_text(64 * 1024))
+        static = StaticResources('js')
+        static.add_folder('app', js)
+        self.putChild('js', static)
+
+INDEX_TEMPLATE = """<html>
+<head>
+    <title>Benchmark ${version}</title>
+    % for stylesheet in stylesheets:
+    <link rel="stylesheet" type="text/css" href="${base}${stylesheet}" />
+    % endfor
+    % for script in scripts:
+    <script type="text/javascript" src="${base}${script}"></script>
+    % endfor
+    <script type="text/javascript">config = ${js_config};</script>
+</head>
+<body></body>
+</html>
+"""
+
+GETTEXT_TEMPLATE = """GetText = {
+    maps: {},
+    add: function(string, translation) { this.maps[string] = translation; },
+    get: function(string) { return this.maps[string] || string; }
+};
+"""
+
+def make_ui(path):
+    """
+    Creates the public files and templates of an ExtJSTopLevel in the
+    directory. The scripts and stylesheets of the normal mode are about
+    the size of the real ones, dev mode has 20 empty extension scripts.
+
+    :param path: The directory
+    :type path: string
+    :returns: The public and templates directories
+    :rtype: tuple
+    """
+    public = os.path.join(path, 'public')
+    templates = os.path.join(path, 'templates')
+    os.makedirs(os.path.join(public, 'js', 'ext-extensions', 'panels'))
+    os.makedirs(os.path.join(public, 'css', 'ext-extensions'))
+    os.makedirs(templates)
+
+    for i in xrange(20):
+        open(os.path.join(public, 'js', 'ext-extensions', 'panels',
+            'panel%02d.js' % i), 'wb').write('')
+    for name, size in (('ext-base.js', 40), ('ext-all.js', 640),
+                       ('ext-extensions.js', 120)):
+        open(os.path.join(public, 'js', name), 'wb').write(
+            make_text(size * 1024))
+    for name, size in (('ext-all-notheme.css', 80),
+                       ('ext-extensions.css', 10)):
+        open(os.path.join(public, 'css', name), 'wb').write(
+            make_text(size * 1024))
+
+    open(os.path.join(templates, 'index.html'), 'wb').write(INDEX_TEMPLATE)
+    open(os.path.join(templates, 'gettext.js'), 'wb').write(GETTEXT_TEMPLATE +
+        ''.join(["GetText.add('String %d', '${escape(_(\"String %d\"))}')\n"
+            % (i, i) for i in xrange(300)]))
+    return public, templates
+
+def rpc_body(method, *params, **kwargs):
+    """
+    Returns the body of a JSON-RPC request, with any keyword arguments as
+    extra members such as `hash`.
+    """
+    body = {'method': method, 'params': params, 'id': 1}
+    body.update(kwargs)
+    return json.dumps(body)
+
+class FakeTransport(object):
+    """
+    A transport that throws away what is written to it, keeping count of
+    the bytes.
+    """
+
+    disconnected = False
+    connected = True
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, iovec):
+        for data in iovec:
+            self.write(data)
+
+    def getPeer(self):
+        return IPv4Address('TCP', '127.0.0.1', 40000)
+
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', 8080)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+class FakeChannel(object):
+    """
+    Stands in for the HTTP connection of a request made in-process.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.transport = FakeTransport()
+
+    def requestDone(self, request):
+        pass
+
+    def writeHeaders(self, version, code, reason, headers):
+        lines = ['%s %s %s\r\n' % (version, code, reason)]
+        lines.extend(['%s: %s\r\n' % (name, value) for name, value in headers])
+        lines.append('\r\n')
+        self.transport.writeSequence(lines)
+
+    def getPeer(self):
+        return self.transport.getPeer()
+
+    def getHost(self):
+        return self.transport.getHost()
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, iovec):
+        self.transport.writeSequence(iovec)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def isSecure(self):
+        return False
+
+def make_site(resource):
+    """
+    Returns the site that requests made with `fake_request` are served
+    by.
+    """
+    return CorkscrewSite(resource)
+
+def fake_request(site, method, uri, body='', headers=None):
+    """
+    Makes a request to the site in-process, parsing it and serving it in
+    the same way as one received over a connection.
+
+    :param site: The site
+    :type site: corkscrew.server.CorkscrewSite
+    :param method: The HTTP method
+    :type method: string
+    :param uri: The uri requested
+    :type uri: string
+    :keyword body: The body of the request
+    :type body: string
+    :keyword headers: The request headers
+    :type headers: dict
+    :returns: The request
+    :rtype: twisted.web.server.Request
+    """
+    channel = FakeChannel(site)
+    request = site.requestFactory(channel, False)
+    request.gotLength(len(body))
+    if body:
+        request.handleContentChunk(body)
+    for name, value in (headers or {}).iteritems():
+        request.requestHeaders.setRawHeaders(name, [value])
+    # The channel parses the cookies before handing the request over
+    request.parseCookies()
+    request.requestReceived(method, uri, 'HTTP/1.1')
+    return request
+
+def measure(func, min_time=0.2, rounds=5):
+    """
+    Calls a function repeatedly, working out how many calls take about
+    `min_time` seconds and then timing that many calls `rounds` times.
+
+    :param func: The function to time, called without arguments
+    :type func: function
+    :keyword min_time: The least seconds to spend in each round
+    :type min_time: float
+    :keyword rounds: The number of rounds
+    :type rounds: int
+    :returns: The statistics of the time each call took, see `summarise`
+    :rtype: dict
+    """
+    number = 1
+    while True:
+        started = default_timer()
+        for i in xrange(number):
+            func()
+        elapsed = default_timer() - started
+        if elapsed >= min_time / 10 or number >= 10 ** 7:
+            break
+        number *= 10
+    number = max(1, int(number * (min_time / max(elapsed, 1e-9))))
+
+    times = []
+    for r in xrange(rounds):
+        started = default_timer()
+        for i in xrange(number):
+            func()
+        times.append((default_timer() - started) / number)
+    return summarise(times, number)
+
+def summarise(times, number):
+    """
+    Returns the statistics of a benchmark's per call times, in
+    microseconds.
+    """
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    return {
+        'calls': number * len(times),
+        'ops_per_sec': 1.0 / times[len(times) // 2],
+        'min_us': times[0] * 1e6,
+        'median_us': times[len(times) // 2] * 1e6,
+        'mean_us': mean * 1e6,
+        'max_us': times[-1] * 1e6
+    }
+
+def get_metadata():
+    """
+    Returns details of where the benchmarks were run, so that results
+    from different machines or versions aren't compared by mistake.
+    """
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    except OSError:
+        revision = ''
+    import twisted
+    return {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'twisted': twisted.__version__,
+        'revision': revision.strip() or None
+    }
+
+def write_results(results, path=None):
+    """
+    Writes the results, along with the metadata, as JSON to a file or
+    stdout.
+    """
+    output = json.dumps({'meta': get_metadata(), 'results': results},
+        indent=2, sort_keys=True)
+    if path:
+        open(path, 'w').write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
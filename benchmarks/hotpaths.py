@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# benchmarks/hotpaths.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Times the hot paths of a corkscrew server in-process, serving fake
+requests through a CorkscrewSite without any sockets, and writes the
+results as JSON.
+
+    python benchmarks/hotpaths.py [-o results.json] [-t seconds] [pattern]
+
+Only the benchmarks whose names contain the pattern are run. The payloads
+are generated from a fixed seed, so runs on the same machine can be
+compared with benchmarks/compare.py.
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.web import resource
+
+from corkscrew import common
+from corkscrew.auth import Auth, AUTH_LEVEL_ADMIN, make_checksum
+from corkscrew.common import compress, json
+from corkscrew.events import EventManager
+from corkscrew.jsonrpc import result_hash
+from corkscrew.server import ExtJSTopLevel
+
+from harness import (Bench, BenchTopLevel, fake_request, make_site, make_text,
+    make_ui, measure, rpc_body, write_results)
+
+class Benchmarks(object):
+    """
+    Sets up what the benchmarks need in a temporary directory, and
+    returns the function to time for each benchmark.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='corkscrew-bench-')
+
+    def cleanup(self):
+        shutil.rmtree(self.path)
+
+    def get_benchmarks(self):
+        return [
+            ('jsonrpc.render.small', self.jsonrpc_small),
+            ('jsonrpc.render.large', self.jsonrpc_large),
+            ('jsonrpc.render.not_modified', self.jsonrpc_not_modified),
+            ('static.render.hit', self.static_hit),
+            ('static.render.miss', self.static_miss),
+            ('index.render', self.index_render),
+            ('gettext.render', lambda: self.gettext_render(False)),
+            ('gettext.render.not_modified', lambda: self.gettext_render(True)),
+            ('compress.1k', lambda: self.compress(1024)),
+            ('compress.16k', lambda: self.compress(16 * 1024)),
+            ('compress.256k', lambda: self.compress(256 * 1024)),
+            ('auth.check_request.anonymous', lambda: self.check_request(False)),
+            ('auth.check_request.session', lambda: self.check_request(True)),
+            ('events.fanout.10', lambda: self.events_fanout(10)),
+            ('events.fanout.1000', lambda: self.events_fanout(1000)),
+        ]
+
+    def _site(self):
+        return make_site(BenchTopLevel(self.path))
+
+    def _jsonrpc(self, body):
+        site = self._site()
+        headers = {'content-type': 'application/json'}
+        def call():
+            request = fake_request(site, 'POST', '/json', body, headers)
+            assert request.finished
+        return call
+
+    def jsonrpc_small(self):
+        return self._jsonrpc(rpc_body('bench.echo', 'hello'))
+
+    def jsonrpc_large(self):
+        return self._jsonrpc(rpc_body('bench.rows'))
+
+    def jsonrpc_not_modified(self):
+        digest = result_hash(json.dumps(Bench().data, sort_keys=True))
+        return self._jsonrpc(rpc_body('bench.cached_rows', hash=digest))
+
+    def static_hit(self):
+        site = self._site()
+        def call():
+            request = fake_request(site, 'GET', '/js/app/app.js')
+            assert request.finished
+        return call
+
+    def static_miss(self):
+        site = self._site()
+        def call():
+            request = fake_request(site, 'GET', '/js/app/missing.js')
+            assert request.code == 404
+        return call
+
+    def index_render(self):
+        class TopLevel(ExtJSTopLevel):
+            dev_mode = True
+        TopLevel.public, TopLevel.templates = make_ui(self.path)
+        site = make_site(TopLevel())
+        def call():
+            request = fake_request(site, 'GET', '/')
+            assert request.code == 200
+        return call
+
+    def gettext_render(self, conditional):
+        class TopLevel(ExtJSTopLevel):
+            pass
+        TopLevel.public, TopLevel.templates = make_ui(os.path.join(self.path,
+            'gettext-%s' % conditional))
+        site = make_site(TopLevel())
+        etag = fake_request(site, 'GET', '/gettext.js').etag
+        headers = {'if-none-match': etag} if conditional else {}
+        code = 304 if conditional else 200
+        def call():
+            request = fake_request(site, 'GET', '/gettext.js', headers=headers)
+            assert request.code == code
+        return call
+
+    def compress(self, size):
+        text = make_text(size)
+        return lambda: compress(text)
+
+    def check_request(self, session):
+        auth = Auth()
+        auth.worker.stop()
+        headers = {}
+        if session:
+            session_id = 'a' * 32
+            auth.config['sessions'][session_id] = {
+                'login': 'admin', 'level': AUTH_LEVEL_ADMIN, 'expires': 0}
+            headers['cookie'] = '_session_id=%s%d' % (session_id,
+                make_checksum(session_id))
+
+        site = make_site(resource.Resource())
+        request = fake_request(site, 'GET', '/', headers=headers)
+        def call():
+            request.cookies = []
+            auth.check_request(request, level=0)
+        return call
+
+    def events_fanout(self, listeners):
+        events = EventManager()
+        if events.reaper:
+            events.reaper.stop()
+        ids = ['listener-%d' % i for i in xrange(listeners)]
+        for listener_id in ids:
+            events.add_listener(listener_id, 'TorrentStateChanged')
+        def call():
+            events.fire_event('TorrentStateChanged', 'a1b2c3', 'Seeding')
+            for listener_id in ids:
+                events.get_events(listener_id)
+        return call
+
+def main():
+    parser = OptionParser(usage='%prog [options] [pattern]')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results to FILE rather than stdout', metavar='FILE')
+    parser.add_option('-t', '--time', dest='time', type='float', default=0.2,
+        help='the least seconds to spend on each round [default: %default]')
+    parser.add_option('-r', '--rounds', dest='rounds', type='int', default=5,
+        help='the number of rounds of each benchmark [default: %default]')
+    options, args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    # Without a reactor running nothing is compressed in a thread, and it's
+    # the work done on the reactor that's timed anyway.
+    common.THREAD_THRESHOLD = sys.maxint
+
+    benchmarks = Benchmarks()
+    results = {}
+    try:
+        for name, setup in benchmarks.get_benchmarks():
+            if args and args[0] not in name:
+                continue
+            results[name] = measure(setup(), options.time, options.rounds)
+            print >>sys.stderr, '%-32s %12.1f/s %10.1fus' % (name,
+                results[name]['ops_per_sec'], results[name]['median_us'])
+    finally:
+        benchmarks.cleanup()
+
+    write_results(results, options.output)
+
+if __name__ == '__main__':
+    main()
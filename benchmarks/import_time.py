@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# benchmarks/import_time.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Measures how long importing the corkscrew modules takes in a fresh
+interpreter, which every worker process pays for when it starts, and
+writes the results as JSON.
+
+    python benchmarks/import_time.py [-n runs] [-o results.json] [--fail]
+
+Twisted Web is timed on its own too, as the part of the time that
+corkscrew can't do anything about. Modules that are only needed once the
+server is handling requests, such as Mako, shouldn't be imported at all,
+and corkscrew.common shouldn't import Twisted; with --fail the exit
+status is 1 if any of them are.
+"""
+
+import os
+import sys
+import subprocess
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import write_results
+
+MODULES = ['twisted.web.server', 'corkscrew.common', 'corkscrew.jsonrpc',
+    'corkscrew.server']
+
+# Modules that importing corkscrew shouldn't pull in
+LAZY = ['mako', 'pkg_resources', 'importlib_metadata']
+
+# Modules that importing a particular corkscrew module shouldn't pull in,
+# on top of the ones above
+MODULE_LAZY = {
+    'corkscrew.common': ['twisted.web', 'twisted.internet']
+}
+
+SCRIPT = """
+import sys, time
+started = time.time()
+import %s
+elapsed = time.time() - started
+print('%%f %%s' %% (elapsed, ','.join([m for m in %r if m in sys.modules])))
+"""
+
+def time_import(module):
+    """
+    Imports a module in a fresh interpreter, returning the seconds it took
+    and which of the lazy modules were imported.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([p for p in
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+         env.get('PYTHONPATH')] if p])
+    lazy = LAZY + MODULE_LAZY.get(module, [])
+    process = subprocess.Popen([sys.executable, '-c', SCRIPT % (module, lazy)],
+        stdout=subprocess.PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('importing %s failed' % module)
+    elapsed, imported = (output.strip().split(' ') + [''])[:2]
+    return float(elapsed), [m for m in imported.split(',') if m]
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results to FILE rather than stdout', metavar='FILE')
+    parser.add_option('-n', '--runs', dest='runs', type='int', default=10,
+        help='the number of times to import each module [default: %default]')
+    parser.add_option('--fail', dest='fail', action='store_true',
+        default=False, help='exit with status 1 if a module that should be '
+        'imported lazily is imported')
+    options, args = parser.parse_args()
+
+    results = {}
+    eager = set()
+    for module in MODULES:
+        times = []
+        for i in xrange(options.runs):
+            elapsed, imported = time_import(module)
+            times.append(elapsed * 1000)
+        times.sort()
+        if module.startswith('corkscrew'):
+            eager.update(imported)
+        results['import.' + module] = {
+            'runs': options.runs,
+            'min_ms': times[0],
+            'p50_ms': times[len(times) // 2],
+            'max_ms': times[-1],
+            'imported': imported
+        }
+        print >>sys.stderr, '%-24s min %7.1fms  median %7.1fms  %s' % (module,
+            times[0], times[len(times) // 2], ' '.join(imported))
+
+    write_results(results, options.output)
+    if eager:
+        print >>sys.stderr, 'imported at startup: %s' % ', '.join(sorted(eager))
+        if options.fail:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
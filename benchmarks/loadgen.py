@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# benchmarks/loadgen.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Starts a CorkscrewServer in a child process and drives it over local
+keep-alive connections, measuring throughput and latency, and writes the
+results as JSON.
+
+    python benchmarks/loadgen.py [-o results.json] [-c clients] [-d seconds]
+
+Each scenario keeps the given number of clients busy, each sending its
+next request as soon as it has the response to the last.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, \
+    readBody
+from twisted.web.http_headers import Headers
+
+from corkscrew.server import CorkscrewServer
+from corkscrew.stats import Histogram
+
+from harness import BenchTopLevel, rpc_body, write_results
+
+SCENARIOS = [
+    ('rpc.small', '/json', rpc_body('bench.echo', 'hello')),
+    ('rpc.large', '/json', rpc_body('bench.rows')),
+    ('static', '/js/app/app.js', None),
+]
+
+def serve(path):
+    """
+    Serves the benchmark top level on a free port, writing the port to
+    stdout once it is listening.
+    """
+    server = CorkscrewServer(BenchTopLevel(path), port=0)
+    server.start_normal()
+    sys.stdout.write('%d\n' % server.socket.getHost().port)
+    sys.stdout.flush()
+    reactor.run()
+
+def start_server():
+    """
+    Starts the server process, returning it along with its port.
+    """
+    path = tempfile.mkdtemp(prefix='corkscrew-loadgen-')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+        '--serve', path], stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line:
+        shutil.rmtree(path)
+        raise RuntimeError('the server failed to start')
+    return process, path, int(line)
+
+class Scenario(object):
+    """
+    Keeps a number of clients sending the same request for a time,
+    recording the latency of each response.
+    """
+
+    def __init__(self, agent, url, body, clients, duration):
+        self.agent = agent
+        self.url = url
+        self.body = body
+        self.clients = clients
+        self.duration = duration
+        self.latency = Histogram()
+        self.errors = 0
+        self.bytes = 0
+
+    def run(self):
+        self.started = time.time()
+        self.deadline = self.started + self.duration
+        clients = []
+        for i in xrange(self.clients):
+            d = defer.Deferred()
+            self._next(None, d)
+            clients.append(d)
+        return defer.DeferredList(clients).addCallback(self._results)
+
+    def _next(self, result, done):
+        if time.time() >= self.deadline:
+            done.callback(None)
+            return
+
+        if self.body is None:
+            method, body = 'GET', None
+        else:
+            method, body = 'POST', FileBodyProducer(StringIO(self.body))
+        headers = Headers({'content-type': ['application/json'],
+            'accept-encoding': ['gzip']})
+        started = time.time()
+        d = self.agent.request(method, self.url, headers, body)
+        d.addCallback(self._got_response)
+        d.addCallbacks(self._done, self._failed, (started,))
+        d.addCallback(self._next, done)
+
+    def _got_response(self, response):
+        if response.code != 200:
+            raise ValueError('unexpected status %d' % response.code)
+        return readBody(response)
+
+    def _done(self, data, started):
+        self.latency.record(int((time.time() - started) * 1000000))
+        self.bytes += len(data)
+
+    def _failed(self, failure):
+        self.errors += 1
+
+    def _results(self, result):
+        elapsed = time.time() - self.started
+        latency = self.latency
+        p50, p90, p99, p999 = latency.percentiles(50, 90, 99, 99.9)
+        return {
+            'clients': self.clients,
+            'requests': latency.count,
+            'errors': self.errors,
+            'ops_per_sec': latency.count / elapsed,
+            'bytes_per_sec': self.bytes / elapsed,
+            'mean_ms': latency.total / 1000.0 / latency.count
+                if latency.count else 0,
+            'p50_ms': p50 / 1000.0,
+            'p90_ms': p90 / 1000.0,
+            'p99_ms': p99 / 1000.0,
+            'p999_ms': p999 / 1000.0,
+            'max_ms': latency.max / 1000.0
+        }
+
+@defer.inlineCallbacks
+def run(port, options, pattern, results):
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = options.clients
+    agent = Agent(reactor, pool=pool)
+    try:
+        for name, path, body in SCENARIOS:
+            if pattern and pattern not in name:
+                continue
+            url = 'http://127.0.0.1:%d%s' % (port, path)
+
+            # Warm up the connections and the server first
+            yield Scenario(agent, url, body, options.clients, 1).run()
+            results[name] = yield Scenario(agent, url, body, options.clients,
+                options.duration).run()
+            print >>sys.stderr, '%-12s %10.1f/s  p50 %7.2fms  p99 %7.2fms' \
+                '  errors %d' % (name, results[name]['ops_per_sec'],
+                results[name]['p50_ms'], results[name]['p99_ms'],
+                results[name]['errors'])
+        yield pool.closeCachedConnections()
+    finally:
+        reactor.stop()
+
+def main():
+    parser = OptionParser(usage='%prog [options] [pattern]')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results to FILE rather than stdout', metavar='FILE')
+    parser.add_option('-c', '--clients', dest='clients', type='int',
+        default=10, help='the number of concurrent clients [default: %default]')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+        default=10, help='the seconds to run each scenario for '
+        '[default: %default]')
+    parser.add_option('--serve', dest='serve', metavar='PATH',
+        help='run the server, used for the child process')
+    options, args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    if options.serve:
+        return serve(options.serve)
+
+    process, path, port = start_server()
+    results = {}
+    try:
+        reactor.callWhenRunning(run, port, options, args and args[0], results)
+        reactor.run()
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(path)
+
+    for name in results:
+        results[name]['duration'] = options.duration
+    write_results(results, options.output)
+
+if __name__ == '__main__':
+    main()
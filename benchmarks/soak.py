@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+#
+# benchmarks/soak.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Soaks a CorkscrewServer running a sample ExtJS application with virtual
+clients, to catch leaks and slowdowns that only show up over time.
+
+    python benchmarks/soak.py [-c clients] [-d seconds] [-o results.json]
+
+The server runs in a child process. Each virtual client loads the index
+page and its assets, logs in, subscribes to an event and then polls for
+events and fetches rows every few seconds, until it leaves without
+logging out and is replaced by a new client. Leaving clients behind means
+their sessions and event listeners are only freed by the server reaping
+them.
+
+Every interval the server's memory, open file descriptors, sessions,
+event listeners and queued events are sampled, along with its reactor lag
+from /metrics and the latency of the responses since the last sample.
+Once the clients have settled in, anything that keeps growing, latency
+that rises, reactor lag over the limit and failed requests are flagged.
+The memory and file descriptors are read from /proc, so are only sampled
+on Linux.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, \
+    readBody
+from twisted.web.http_headers import Headers
+
+from corkscrew.common import json
+from corkscrew.events import EventManager
+from corkscrew.jsonrpc import export
+from corkscrew.server import CorkscrewServer, ExtJSTopLevel
+from corkscrew.stats import Histogram
+
+from harness import Bench, make_ui, write_results
+
+PASSWORD = 'soak'
+
+# The assets an ExtJS client loads after the index page
+ASSETS = ['gettext.js', 'js/ext-base.js', 'js/ext-all.js',
+    'js/ext-extensions.js', 'css/ext-all-notheme.css',
+    'css/ext-extensions.css']
+
+# The gauges read from the server's metrics, and whether the soak flags
+# them for growing.
+GAUGES = [
+    ('corkscrew_reactor_max_lag_seconds', 'lag', False),
+    ('corkscrew_sessions', 'sessions', True),
+    ('corkscrew_event_listeners', 'listeners', True),
+    ('corkscrew_event_queue_depth', 'queued_events', True),
+]
+
+class SoakEvents(EventManager):
+    pass
+
+class Soak(object):
+    """
+    The methods the virtual clients call, registered as `soak`.
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    @export
+    def subscribe(self, listener_id):
+        self.events.add_listener(listener_id, 'TorrentStateChanged')
+        return True
+
+    @export
+    def poll(self, listener_id):
+        return self.events.get_events(listener_id)
+
+class SoakTopLevel(ExtJSTopLevel):
+
+    jsonrpc     = 'json'
+    auth        = True
+    eventsource = 'events'
+    events_cls  = SoakEvents
+    metrics     = 'metrics'
+
+    def __init__(self):
+        ExtJSTopLevel.__init__(self)
+        self.json.auth._change_password(PASSWORD)
+        self.json.register_object(Bench(), 'bench')
+        self.json.register_object(Soak(self.events), 'soak')
+        self.firing = LoopingCall(self.fire)
+        self.firing.start(0.1)
+
+    def fire(self):
+        self.events.fire_event('TorrentStateChanged',
+            '%040x' % random.getrandbits(160), 'Seeding')
+
+def serve(path, options):
+    """
+    Serves the soak application on a free port, writing the port to
+    stdout once it is listening.
+    """
+    SoakTopLevel.public, SoakTopLevel.templates = make_ui(path)
+    SoakEvents.listener_timeout = options.listener_timeout
+    top_level = SoakTopLevel()
+    top_level.json.auth.config['session_timeout'] = options.session_timeout
+    server = CorkscrewServer(top_level, port=0)
+    server.start_normal()
+    sys.stdout.write('%d\n' % server.socket.getHost().port)
+    sys.stdout.flush()
+    reactor.run()
+
+def start_server(options):
+    """
+    Starts the server process, returning it along with its port.
+    """
+    path = tempfile.mkdtemp(prefix='corkscrew-soak-')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+        '--serve', path,
+        '--session-timeout', str(options.session_timeout),
+        '--listener-timeout', str(options.listener_timeout)],
+        stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line:
+        shutil.rmtree(path)
+        raise RuntimeError('the server failed to start')
+    return process, path, int(line)
+
+def read_process(pid):
+    """
+    Returns the resident memory in kilobytes and number of open file
+    descriptors of a process, or None for each if they can't be read.
+    """
+    rss = fds = None
+    try:
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+        fds = len(os.listdir('/proc/%d/fd' % pid))
+    except (IOError, OSError):
+        pass
+    return rss, fds
+
+def parse_metrics(text):
+    """
+    Returns the values of the metrics without labels.
+    """
+    values = {}
+    for line in text.splitlines():
+        if not line or line[0] == '#' or '{' in line:
+            continue
+        name, value = line.split()
+        values[name] = float(value)
+    return values
+
+class Soaker(object):
+    """
+    Runs the virtual clients against the server and keeps the samples.
+    """
+
+    def __init__(self, port, process, options):
+        self.base = 'http://127.0.0.1:%d/' % port
+        self.process = process
+        self.options = options
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = options.connections
+        self.pool = pool
+        self.agent = Agent(reactor, pool=pool)
+        self.window = Histogram()
+        self.latency = Histogram()
+        self.requests = 0
+        self.errors = 0
+        self.clients = 0
+        self.samples = []
+        self.stopping = False
+
+    def request(self, path, body=None, cookie=None):
+        """
+        Makes a request, recording its latency, and returns a Deferred
+        firing with the response headers and body.
+        """
+        headers = Headers({'accept-encoding': ['gzip']})
+        if cookie:
+            headers.addRawHeader('cookie', '_session_id=%s' % cookie)
+        if body is not None:
+            headers.addRawHeader('content-type', 'application/json')
+            body = FileBodyProducer(StringIO(body))
+        started = time.time()
+        d = self.agent.request('GET' if body is None else 'POST',
+            self.base + path, headers, body)
+        d.addCallback(self._got_response, started)
+        d.addErrback(self._failed)
+        return d
+
+    def _got_response(self, response, started):
+        if response.code != 200:
+            raise ValueError('%d response' % response.code)
+        d = readBody(response)
+        d.addCallback(self._got_body, response, started)
+        return d
+
+    def _got_body(self, body, response, started):
+        latency = int((time.time() - started) * 1000000)
+        self.window.record(latency)
+        self.latency.record(latency)
+        self.requests += 1
+        return response.headers, body
+
+    def _failed(self, failure):
+        self.errors += 1
+        if self.errors <= 10:
+            print >>sys.stderr, 'request failed: %s' % \
+                failure.getErrorMessage()
+        return failure
+
+    def call(self, method, params, cookie=None):
+        body = json.dumps({'method': method, 'params': params, 'id': 1})
+        return self.request('json', body, cookie)
+
+    @defer.inlineCallbacks
+    def client(self):
+        """
+        Runs a virtual client for its lifetime, then starts another.
+        """
+        self.clients += 1
+        options = self.options
+        leave = time.time() + random.expovariate(1.0 / options.lifetime)
+        try:
+            yield self.request('')
+            yield defer.DeferredList([self.request(asset)
+                for asset in ASSETS], consumeErrors=True)
+
+            headers, body = yield self.call('auth.login', [PASSWORD])
+            cookie = None
+            for value in headers.getRawHeaders('set-cookie', []):
+                if value.startswith('_session_id='):
+                    cookie = value.split(';')[0].split('=', 1)[1]
+            if cookie is None:
+                self.errors += 1
+                raise ValueError('login failed')
+
+            listener_id = '%032x' % random.getrandbits(128)
+            yield self.call('soak.subscribe', [listener_id], cookie)
+            while time.time() < leave and not self.stopping:
+                yield sleep(random.uniform(0.5, 1.5) * options.think)
+                yield self.call('soak.poll', [listener_id], cookie)
+                if random.random() < 0.1:
+                    yield self.call('bench.rows', [], cookie)
+        except Exception:
+            # Already counted, the client gives up and is replaced
+            pass
+        finally:
+            self.clients -= 1
+
+        if not self.stopping:
+            self.client()
+
+    def sample(self):
+        """
+        Records the server's resource use and the latency since the last
+        sample.
+        """
+        d = self.request('metrics')
+        d.addCallback(lambda (headers, body): parse_metrics(body))
+        d.addErrback(lambda failure: {})
+        d.addCallback(self._sample)
+        return d
+
+    def _sample(self, metrics):
+        rss, fds = read_process(self.process.pid)
+        window = self.window
+        p50, p99 = window.percentiles(50, 99)
+        sample = {
+            'time': round(time.time() - self.started, 1),
+            'clients': self.clients,
+            'requests': self.requests,
+            'errors': self.errors,
+            'rss_kb': rss,
+            'fds': fds,
+            'p50_ms': p50 / 1000.0,
+            'p99_ms': p99 / 1000.0,
+            'max_ms': window.max / 1000.0
+        }
+        for name, key, growth in GAUGES:
+            sample[key] = metrics.get(name)
+        window.reset()
+        self.samples.append(sample)
+        print >>sys.stderr, ('%(time)7.1fs clients %(clients)5d rss %(rss_kb)s'
+            'kB fds %(fds)s p50 %(p50_ms).1fms p99 %(p99_ms).1fms lag '
+            '%(lag)s sessions %(sessions)s listeners %(listeners)s '
+            'errors %(errors)d') % sample
+
+    @defer.inlineCallbacks
+    def run(self):
+        options = self.options
+        self.started = time.time()
+        sampler = LoopingCall(self.sample)
+        sampler.start(options.interval, now=False)
+
+        # Spread the clients joining over the ramp up
+        for i in xrange(options.clients):
+            reactor.callLater(options.ramp * i / options.clients, self.client)
+
+        yield sleep(options.duration)
+        sampler.stop()
+
+        # Let the clients finish what they're doing, so the connections
+        # aren't cut off mid request.
+        self.stopping = True
+        waited = 0
+        while self.clients and waited < 30:
+            yield sleep(0.1)
+            waited += 0.1
+        yield self.sample()
+        yield self.pool.closeCachedConnections()
+
+    def get_results(self):
+        """
+        Returns the summary of the soak and any problems it found.
+        """
+        options = self.options
+        elapsed = time.time() - self.started
+        p50, p99 = self.latency.percentiles(50, 99)
+        # The last sample is taken once the clients have stopped
+        settled = [s for s in self.samples[:-1]
+            if s['time'] >= options.ramp + options.warmup]
+        return {
+            'clients': options.clients,
+            'duration': options.duration,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ops_per_sec': self.requests / elapsed,
+            'p50_ms': p50 / 1000.0,
+            'p99_ms': p99 / 1000.0,
+            'max_ms': self.latency.max / 1000.0,
+            'max_rss_kb': max([s['rss_kb'] for s in self.samples] or [None]),
+            'max_lag': max([s['lag'] for s in self.samples] or [None]),
+            'flags': self.check(settled),
+            'samples': self.samples
+        }
+
+    def check(self, samples):
+        """
+        Returns a description of each problem found in the samples taken
+        after the clients settled in, comparing the first third of them
+        with the last.
+        """
+        options = self.options
+        flags = []
+        if self.errors:
+            flags.append('%d requests failed' % self.errors)
+        if len(samples) < 3:
+            flags.append('too few samples after warming up to check growth')
+            return flags
+
+        third = len(samples) // 3
+        def average(key, samples):
+            values = [s[key] for s in samples if s[key] is not None]
+            return sum(values) / float(len(values)) if values else None
+
+        # The growth allowed in each figure, as a percentage and an
+        # absolute amount for figures that start out small. The server
+        # holds a descriptor for each connection the client pool keeps,
+        # so those can grow by the size of the pool.
+        growing = [
+            ('rss_kb', options.max_growth, 0),
+            ('fds', options.max_growth, options.connections),
+            ('p99_ms', options.max_latency_growth, 0)
+        ]
+        growing.extend([(key, options.max_growth, 5)
+            for name, key, growth in GAUGES if growth])
+        for key, limit, slack in growing:
+            first = average(key, samples[:third])
+            last = average(key, samples[-third:])
+            if first is None or last is None:
+                continue
+            if last > max(first * (1 + limit / 100.0), first + slack):
+                flags.append('%s grew from %.1f to %.1f' % (key, first, last))
+
+        lag = max([s['lag'] for s in samples if s['lag'] is not None] or [0])
+        if lag > options.max_lag:
+            flags.append('reactor lag reached %.3fs' % lag)
+        return flags
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results to FILE rather than stdout', metavar='FILE')
+    parser.add_option('-c', '--clients', dest='clients', type='int',
+        default=1000, help='the number of virtual clients [default: %default]')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+        default=3600, help='the seconds to soak for [default: %default]')
+    parser.add_option('-i', '--interval', dest='interval', type='float',
+        default=10, help='the seconds between samples [default: %default]')
+    parser.add_option('--ramp', dest='ramp', type='float', default=600,
+        help='the seconds over which the clients join [default: %default]')
+    parser.add_option('--warmup', dest='warmup', type='float', default=120,
+        help='the seconds after the ramp up before checking for growth '
+        '[default: %default]')
+    parser.add_option('--think', dest='think', type='float', default=5,
+        help='the average seconds between a client\'s polls '
+        '[default: %default]')
+    parser.add_option('--lifetime', dest='lifetime', type='float',
+        default=1800, help='the average seconds a client stays for '
+        '[default: %default]')
+    parser.add_option('--connections', dest='connections', type='int',
+        default=100, help='the most connections kept open to the server '
+        '[default: %default]')
+    parser.add_option('--session-timeout', dest='session_timeout',
+        type='int', default=60, help='the server\'s session timeout '
+        '[default: %default]')
+    parser.add_option('--listener-timeout', dest='listener_timeout',
+        type='int', default=60, help='the seconds before the server reaps '
+        'an idle event listener [default: %default]')
+    parser.add_option('--max-growth', dest='max_growth', type='float',
+        default=20, help='the percentage growth in memory, descriptors, '
+        'sessions, listeners or queued events to flag [default: %default]')
+    parser.add_option('--max-latency-growth', dest='max_latency_growth',
+        type='float', default=50, help='the percentage growth in p99 latency '
+        'to flag [default: %default]')
+    parser.add_option('--max-lag', dest='max_lag', type='float', default=0.5,
+        help='the reactor lag in seconds to flag [default: %default]')
+    parser.add_option('--fail', dest='fail', action='store_true',
+        default=False, help='exit with status 1 if anything was flagged')
+    parser.add_option('--serve', dest='serve', metavar='PATH',
+        help='run the server, used for the child process')
+    options, args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    if options.serve:
+        return serve(options.serve, options)
+
+    process, path, port = start_server(options)
+    soaker = Soaker(port, process, options)
+    def run():
+        d = soaker.run()
+        d.addErrback(lambda failure: failure.printTraceback())
+        d.addBoth(lambda result: reactor.stop())
+    try:
+        reactor.callWhenRunning(run)
+        reactor.run()
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(path)
+
+    results = soaker.get_results()
+    for flag in results['flags']:
+        print >>sys.stderr, 'FLAGGED: %s' % flag
+    write_results({'soak': results}, options.output)
+    if options.fail and results['flags']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# benchmarks/tls_handshake.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+"""
+Measures the rate of TLS handshakes against a local CorkscrewServer, with
+every connection making a full handshake and with connections resuming the
+previous session.
+
+    python benchmarks/tls_handshake.py [connections]
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+
+from OpenSSL import SSL, crypto
+from twisted.internet import reactor
+from twisted.web import resource
+
+from corkscrew.server import CorkscrewServer
+
+class Hello(resource.Resource):
+
+    isLeaf = True
+
+    def render(self, request):
+        return 'hello'
+
+def make_cert(path):
+    """
+    Writes a self-signed certificate and its key into path.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    cert_path = os.path.join(path, 'cert.pem')
+    key_path = os.path.join(path, 'key.pem')
+    open(cert_path, 'wb').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    open(key_path, 'wb').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    return cert_path, key_path
+
+def connect(context, port, session=None):
+    """
+    Makes a request over a new TLS connection, returning its session.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    conn = SSL.Connection(context, sock)
+    conn.set_connect_state()
+    if session is not None:
+        conn.set_session(session)
+    conn.do_handshake()
+    conn.sendall('GET / HTTP/1.0\r\n\r\n')
+    try:
+        while conn.recv(4096):
+            pass
+    except SSL.ZeroReturnError:
+        pass
+    session = conn.get_session()
+    conn.shutdown()
+    sock.close()
+    return session
+
+def run(port, connections, results):
+    context = SSL.Context(SSL.SSLv23_METHOD)
+    context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+
+    try:
+        start = time.time()
+        for i in range(connections):
+            connect(context, port)
+        results['full'] = connections / (time.time() - start)
+
+        session = connect(context, port)
+        start = time.time()
+        for i in range(connections):
+            session = connect(context, port, session)
+        results['resumed'] = connections / (time.time() - start)
+    finally:
+        reactor.callFromThread(reactor.stop)
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    path = tempfile.mkdtemp()
+    try:
+        cert, key = make_cert(path)
+        server = CorkscrewServer(Hello(), port=0, https=True, ssl_cert=cert,
+            ssl_key=key)
+        server.start_ssl()
+        port = server.socket.getHost().port
+
+        results = {}
+        reactor.callInThread(run, port, connections, results)
+        reactor.run()
+    finally:
+        shutil.rmtree(path)
+
+    print 'full handshakes:    %8.1f/s' % results['full']
+    print 'resumed handshakes: %8.1f/s' % results['resumed']
+    print 'speedup:            %8.2fx' % (results['resumed'] / results['full'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/accesslog.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+import Queue
+import hashlib
+import logging
+import threading
+
+from corkscrew.common import json
+from corkscrew.metrics import registry
+
+log = logging.getLogger(__name__)
+
+RECORDS_WRITTEN = registry.counter('corkscrew_access_log_records_total',
+    'The number of access log records written')
+RECORDS_DROPPED = registry.counter('corkscrew_access_log_dropped_total',
+    'The number of access log records dropped because the writer fell behind')
+
+def make_record(request):
+    """
+    Returns the access log record for a completed request.
+
+    :param request: The request
+    :type request: twisted.web.http.Request
+    :rtype: dict
+    """
+    now = time.time()
+    rpc = getattr(request, 'json', None)
+    session = request.getCookie('_session_id')
+    timings = getattr(request, 'timings', {})
+    return {
+        'time': now,
+        'client': request.getClientIP(),
+        'method': request.method,
+        'path': request.path,
+        'rpc': rpc.get('method') if isinstance(rpc, dict) else None,
+        'status': request.code,
+        'bytes_in': int(request.getHeader('content-length') or 0),
+        'bytes_out': request.sentLength,
+        'bytes_uncompressed': getattr(request, 'uncompressed_length', None),
+        'duration': round((now - request.started) * 1000, 3)
+            if hasattr(request, 'started') else None,
+        'timings': dict([(name, round(seconds * 1000, 3))
+            for name, seconds in timings.iteritems()]),
+        # Only a digest of the session id is logged, the id itself would
+        # let anyone reading the log take over the session.
+        'session': hashlib.sha1(session).hexdigest()[:12] if session else None
+    }
+
+def encode_record(record):
+    """
+    Returns a record as a line of JSON.
+
+    :param record: The record
+    :type record: dict
+    :rtype: string
+    """
+    try:
+        return json.dumps(record) + '\n'
+    except UnicodeDecodeError:
+        # Twisted doesn't decode the request path, so it can hold any
+        # bytes. Latin-1 keeps each one as the code point of its value.
+        return json.dumps(record, encoding='latin-1') + '\n'
+
+class AccessLog(object):
+    """
+    Writes a JSON record for every request to a file, one per line. The
+    records are handed to a thread that writes them in batches, so the
+    reactor never waits on the disk. If the thread falls behind and
+    `max_buffered` records are waiting, further records are dropped and
+    counted rather than held.
+
+    Times in the records are in milliseconds. The timings break down
+    where the time went, for JSON-RPC calls: decoding the request,
+    waiting in the queue, running the method, encoding and compressing
+    the response.
+    """
+
+    # The most records waiting to be written
+    max_buffered = 10000
+
+    # The most records written at once
+    batch_size = 500
+
+    def __init__(self, path):
+        """
+        :param path: The file to append the records to
+        :type path: string
+        """
+        self.path = path
+        self.queue = Queue.Queue(self.max_buffered)
+        self.dropped = 0
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the writer thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                name='corkscrew-access-log')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Writes the records waiting and stops the writer thread.
+
+        :keyword timeout: The most seconds to wait for the thread
+        :type timeout: int
+        """
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            log.warning('Unable to stop the access log writer')
+            return
+        self.thread.join(timeout)
+        self.thread = None
+
+    def log(self, request):
+        """
+        Queues the record for a completed request to be written.
+
+        :param request: The request
+        :type request: twisted.web.http.Request
+        """
+        try:
+            self.queue.put_nowait(make_record(request))
+        except Queue.Full:
+            self.dropped += 1
+            RECORDS_DROPPED.inc()
+
+    def _run(self):
+        try:
+            output = open(self.path, 'ab')
+        except IOError as e:
+            log.error('Unable to open the access log %s: %s', self.path, e)
+            return
+
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if None in records:
+                stopping = True
+                records = [r for r in records if r is not None]
+
+            # A record that can't be written mustn't stop the thread, or
+            # every record after it would be held until dropped.
+            lines = []
+            for record in records:
+                try:
+                    lines.append(encode_record(record))
+                except Exception:
+                    log.exception('Unable to encode an access log record')
+            try:
+                output.write(''.join(lines))
+                output.flush()
+            except (IOError, OSError) as e:
+                log.error('Unable to write to the access log: %s', e)
+            RECORDS_WRITTEN.inc(amount=len(lines))
+        output.close()
@@ -40,9 +40,14 @@ from twisted.internet.task import LoopingCall
 
 from corkscrew.errors import AuthError
 from corkscrew.jsonrpc import export
+from corkscrew.metrics import registry
+from corkscrew.scheduler import PRIORITY_INTERACTIVE
 
 log = logging.getLogger(__name__)
 
+SESSIONS = registry.gauge('corkscrew_sessions', 'The number of live sessions',
+    collected=True)
+
 def make_checksum(session_id):
     return reduce(lambda x,y:x+y, map(ord, session_id))
 
@@ -78,10 +83,15 @@ class Auth(object):
     def __init__(self):
         self.config = {
             'sessions': {},
-            'session_timeout': 3600
+            'session_timeout': 3600,
+            'cookie_path': '/json'
         }
         self.worker = LoopingCall(self._clean_sessions)
         self.worker.start(5)
+        registry.add_collector(self)
+
+    def collect_metrics(self):
+        SESSIONS.inc(amount=len(self.config['sessions']))
     
     def _clean_sessions(self):
         session_ids = self.config['sessions'].keys()
@@ -117,7 +127,7 @@ class Auth(object):
         checksum = str(make_checksum(session_id))
         
         request.addCookie('_session_id', session_id + checksum,
-                path="/json", expires=expires_str)
+                path=self.config['cookie_path'], expires=expires_str)
         
         log.debug("Creating session for %s", login)
 
@@ -168,7 +178,7 @@ class Auth(object):
 
             _session_id = request.getCookie("_session_id")
             request.addCookie('_session_id', _session_id,
-                    path="/json", expires=expires_str)
+                    path=self.config['cookie_path'], expires=expires_str)
         
         if method:
             if not hasattr(method, "_json_export"):
@@ -219,7 +229,7 @@ class Auth(object):
             return False
         return self._change_password(new_password)
     
-    @export(AUTH_LEVEL_NONE)
+    @export(AUTH_LEVEL_NONE, priority=PRIORITY_INTERACTIVE)
     def check_session(self, session_id=None):
         """
         Check a session to see if it's still valid.
@@ -241,7 +251,7 @@ class Auth(object):
         del self.config["sessions"][__request__.session_id]
         return True
     
-    @export(AUTH_LEVEL_NONE)
+    @export(AUTH_LEVEL_NONE, priority=PRIORITY_INTERACTIVE)
     def login(self, password):
         """
         Test a password to see if it's valid.
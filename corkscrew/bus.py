@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/bus.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import logging
+
+from twisted.internet import protocol, reactor
+from twisted.internet.error import CannotListenError
+from twisted.protocols.basic import LineReceiver
+
+from corkscrew.common import json
+from corkscrew.events import EventManager
+
+log = logging.getLogger(__name__)
+
+def encode_event(event, args, key=None):
+    """
+    Encodes an event to be sent on the bus.
+
+    :param event: The event name
+    :type event: string
+    :param args: The event's parameters
+    :type args: tuple
+    :keyword key: The coalescing key for the firing
+    :type key: hashable
+    :returns: The event as a line of JSON, without the newline
+    :rtype: string
+    :raises: TypeError if the parameters can't be encoded
+    """
+    return json.dumps([event, args, key])
+
+class BrokerProtocol(LineReceiver):
+    """
+    A connection from a server process to the broker. Every line received
+    is an event, which is relayed to every other connected process.
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.clients.remove(self)
+
+    def dataReceived(self, data):
+        # Relay all the lines that arrived together in a single write to
+        # each of the other processes.
+        self.lines = []
+        LineReceiver.dataReceived(self, data)
+        if not self.lines:
+            return
+        data = '\n'.join(self.lines) + '\n'
+        for client in self.factory.clients:
+            if client is not self:
+                client.transport.write(data)
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+class EventBroker(protocol.ServerFactory):
+    """
+    Relays events between the server processes connected to it.
+    """
+
+    protocol = BrokerProtocol
+
+    def __init__(self):
+        self.clients = []
+
+class BusProtocol(LineReceiver):
+    """
+    A server process's connection to the broker.
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.bus._connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.bus._disconnected(self)
+
+    def lineReceived(self, line):
+        try:
+            event, args, key = json.loads(line)
+        except ValueError:
+            log.warning('Discarding undecodable event from the bus')
+            return
+        if isinstance(key, list):
+            key = tuple(key)
+        self.factory.bus.manager.deliver_event(event, tuple(args), key)
+
+class BusClientFactory(protocol.ReconnectingClientFactory):
+
+    protocol = BusProtocol
+    maxDelay = 5
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def clientConnectionFailed(self, connector, reason):
+        # The broker may have gone away with the process that was running
+        # it, so try to take its place before connecting again, unless the
+        # bus is being stopped.
+        if self.continueTrying:
+            self.bus._listen()
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self,
+            connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.continueTrying:
+            self.bus._listen()
+        protocol.ReconnectingClientFactory.clientConnectionLost(self,
+            connector, reason)
+
+class EventBus(object):
+    """
+    Carries events between the `EventManager`s of several server processes
+    on the same machine through a broker listening on a Unix socket. The
+    first process to start listens on the socket and runs the broker for
+    the others, if it exits another process takes over.
+    """
+
+    # The most seconds an event is held back so that it can be written
+    # to the broker along with others.
+    flush_interval = 0.005
+
+    # The number of events that are written as soon as they are queued.
+    batch_size = 100
+
+    # The number of events held while there is no connection to the
+    # broker, older events are dropped after that.
+    max_backlog = 10000
+
+    def __init__(self, path, manager):
+        self.path = path
+        self.manager = manager
+        self.broker = None
+        self.connection = None
+        self.connector = None
+        self.pending = []
+        self.flush_call = None
+        self.stopped = False
+
+    def start(self):
+        """
+        Connects to the broker, starting one if there is none running.
+        """
+        self.stopped = False
+        self._listen()
+        self.connector = reactor.connectUNIX(self.path, BusClientFactory(self))
+
+    def stop(self):
+        """
+        Disconnects from the broker and stops it if it is running in this
+        process. The connection is closed in a later reactor iteration, so
+        the bus is marked as stopped to keep it from starting the broker
+        again when it sees the connection go.
+        """
+        self.stopped = True
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if self.connector:
+            self.connector.factory.stopTrying()
+            self.connector.disconnect()
+            self.connector = None
+        if self.broker:
+            self.broker.stopListening()
+            self.broker = None
+
+    def publish(self, event, args, key=None):
+        """
+        Queues an event to be sent to the other processes.
+
+        :param event: The event name
+        :type event: string
+        :param args: The event's parameters
+        :type args: tuple
+        :keyword key: The coalescing key for the firing
+        :type key: hashable
+        """
+        self.send(encode_event(event, args, key))
+
+    def send(self, message):
+        """
+        Queues an event encoded with `encode_event` to be sent to the other
+        processes.
+
+        :param message: The encoded event
+        :type message: string
+        """
+        self.pending.append(message)
+        if len(self.pending) > self.max_backlog:
+            del self.pending[0]
+
+        if not self.connection:
+            return
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Writes the queued events to the broker.
+        """
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
+        if not self.connection or not self.pending:
+            return
+        self.connection.transport.write('\n'.join(self.pending) + '\n')
+        self.pending = []
+
+    def _listen(self):
+        if self.broker or self.stopped:
+            return
+        try:
+            self.broker = reactor.listenUNIX(self.path, EventBroker(),
+                wantPID=True)
+            log.info('Running the event broker on %s', self.path)
+        except CannotListenError:
+            self.broker = None
+
+    def _connected(self, connection):
+        log.debug('Connected to the event broker on %s', self.path)
+        self.connection = connection
+        self.flush()
+
+    def _disconnected(self, connection):
+        if self.connection is connection:
+            log.debug('Lost connection to the event broker on %s', self.path)
+            self.connection = None
+
+class BusEventManager(EventManager):
+    """
+    An `EventManager` that also delivers every event fired to the
+    listeners of the other server processes sharing the bus socket, and
+    the events they fire to its own listeners.
+    """
+
+    # The path of the Unix socket the broker listens on
+    bus_path = None
+
+    def __init__(self, path=None):
+        EventManager.__init__(self)
+        self.bus = EventBus(path or self.bus_path, self)
+
+        # Wait for the reactor so that when running workers, each worker
+        # makes its own connection after being forked.
+        reactor.callWhenRunning(self.bus.start)
+
+    def fire_event(self, event, *args, **kwargs):
+        """
+        Fires an event with the specified parameters, in this process and
+        every other connected to the bus.
+
+        :param event: The event name
+        :type event: string
+        :keyword key: The coalescing key for the firing
+        :type key: hashable
+        :raises: TypeError if the parameters can't be encoded
+        """
+        # Encode the event first, so that one that can't be sent to the
+        # other processes isn't fired in this one either.
+        message = encode_event(event, args, kwargs.get('key'))
+        EventManager.fire_event(self, event, *args, **kwargs)
+        self.bus.send(message)
+
+    def deliver_event(self, event, args, key=None):
+        """
+        Fires an event received from another process to the listeners in
+        this one only.
+
+        :param event: The event name
+        :type event: string
+        :param args: The event's parameters
+        :type args: tuple
+        :keyword key: The coalescing key for the firing
+        :type key: hashable
+        """
+        EventManager.fire_event(self, event, *args, key=key)
@@ -27,17 +27,55 @@ import time
 import zlib
 import random
 import hashlib
-import platform
-import subprocess
-import pkg_resources
+import logging
 
-from mako.template import Template as MakoTemplate
+# Twisted and corkscrew.metrics, which imports Twisted Web, are imported
+# where they're used so that importing this module stays cheap.
+
+log = logging.getLogger(__name__)
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+# Contents of at least this many bytes are compressed in a thread by
+# compress_async, rather than holding up the reactor. zlib releases the
+# GIL while it works, so other requests are served in the meantime.
+THREAD_THRESHOLD = 64 * 1024
+
+def gzip(contents):
+    """
+    GZip compress the contents. This touches nothing but its arguments, so
+    it's safe to call from a thread.
+
+    :param contents: The contents to compress
+    :type contents: str
+    :returns: The compressed contents and the seconds it took
+    :rtype: tuple
+    """
+    # This is wall time, Python 2 has no clock for the CPU time of just
+    # the current thread and the process's would include the reactor's.
+    gzip_started = time.time()
+    compress = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16,
+        zlib.DEF_MEM_LEVEL,0)
+    compressed = compress.compress(contents) + compress.flush()
+    return compressed, time.time() - gzip_started
+
+def _compressed(result, contents, request, started):
+    from corkscrew.metrics import (COMPRESS_CALLS, COMPRESS_INPUT,
+        COMPRESS_OUTPUT, COMPRESS_SECONDS)
+    compressed, seconds = result
+    COMPRESS_CALLS.inc()
+    COMPRESS_INPUT.inc(amount=len(contents))
+    COMPRESS_OUTPUT.inc(amount=len(compressed))
+    COMPRESS_SECONDS.inc(amount=seconds)
+    if request:
+        request.uncompressed_length = \
+            getattr(request, 'uncompressed_length', 0) + len(contents)
+        record_timing(request, 'compress', started)
+    return compressed
+
 def compress(contents, request=None):
     """
     GZip compress the contents, optionally setting the content-encoding
@@ -50,10 +88,76 @@ def compress(contents, request=None):
     """
     if request:
         request.setHeader('content-encoding', 'gzip')
-    compress = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16,
-        zlib.DEF_MEM_LEVEL,0)
-    contents = compress.compress(contents)
-    return contents + compress.flush()
+    started = time.time()
+    return _compressed(gzip(contents), contents, request, started)
+
+def compress_async(contents, request=None, threshold=None):
+    """
+    GZip compress the contents in the same way as `compress`, but in one
+    of the reactor's threads if they're large. Small contents aren't worth
+    the trip to a thread and are compressed straight away.
+
+    :param contents: The contents to compress
+    :type contents: str
+    :keyword request: The request object
+    :type request: twisted.web.http.Request
+    :keyword threshold: The size to compress in a thread from, defaults
+        to THREAD_THRESHOLD
+    :type threshold: int
+    :returns: A Deferred firing with the compressed contents
+    :rtype: twisted.internet.defer.Deferred
+    """
+    from twisted.internet import defer, threads
+    if threshold is None:
+        threshold = THREAD_THRESHOLD
+    if len(contents) < threshold:
+        return defer.succeed(compress(contents, request))
+
+    if request:
+        request.setHeader('content-encoding', 'gzip')
+    started = time.time()
+    d = threads.deferToThread(gzip, contents)
+    d.addCallback(_compressed, contents, request, started)
+    return d
+
+def compress_failed(failure, request):
+    """
+    Errback for the Deferred returned by `compress_async`, ending the
+    request with a 500 rather than leaving it open.
+
+    :param failure: The reason compressing failed
+    :type failure: twisted.python.failure.Failure
+    :param request: The request the contents were for
+    :type request: twisted.web.http.Request
+    """
+    from twisted.internet.defer import CancelledError
+    from twisted.web import http
+    # Compressing is cancelled along with the call when the client goes
+    # away, which isn't worth logging.
+    if not failure.check(CancelledError):
+        log.error('Failed to compress the response: %s',
+            failure.getErrorMessage())
+    if request._disconnected:
+        return
+    request.responseHeaders.removeHeader('content-encoding')
+    request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+    request.finish()
+
+def record_timing(request, name, started):
+    """
+    Adds the time since started to one of a request's timings, if it is
+    keeping them for the access log.
+
+    :param request: The request
+    :type request: twisted.web.http.Request
+    :param name: The name of the timing
+    :type name: string
+    :param started: The time the step being timed started
+    :type started: float
+    """
+    timings = getattr(request, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + time.time() - started
 
 def escape(text):
     """
@@ -66,14 +170,61 @@ def escape(text):
     text = text.replace('\n', '\\n')
     return text
 
+# The program version, looked up the first time it's asked for
+_version = None
+
+class LazyVersion(object):
+    """
+    Stands in for the program version until it's used, so that it can be
+    a built-in of every template without being looked up on import.
+    """
+
+    def __str__(self):
+        return str(get_version())
+
+    def __unicode__(self):
+        return unicode(get_version())
+
+    def __repr__(self):
+        return repr(get_version())
+
+    def __eq__(self, other):
+        return get_version() == other
+
+    def __ne__(self, other):
+        return get_version() != other
+
+    def __hash__(self):
+        return hash(get_version())
+
+    def __getattr__(self, name):
+        return getattr(get_version(), name)
+
 def get_version():
     """
-    Returns the program version from the egg metadata
+    Returns the program version from the package metadata. Finding it
+    means scanning the installed distributions, so it's only done the
+    first time it's asked for.
 
     :returns: the version of Deluge
     :rtype: string
     """
-    return pkg_resources.require("corkscrew")[0].version
+    global _version
+    if _version is None:
+        try:
+            from importlib.metadata import version
+        except ImportError:
+            try:
+                from importlib_metadata import version
+            except ImportError:
+                version = None
+
+        if version is not None:
+            _version = version("corkscrew")
+        else:
+            import pkg_resources
+            _version = pkg_resources.require("corkscrew")[0].version
+    return _version
 
 def make_uid():
     """
@@ -89,20 +240,41 @@ def windows_check():
     :rtype: bool
 
     """
+    import platform
     return platform.system() in ('Windows', 'Microsoft')
 
-class Template(MakoTemplate):
+class Template(object):
     """
-    A template that adds some built-ins to the rendering
+    A template that adds some built-ins to the rendering. Mako is only
+    imported when the first template is made and the `version` built-in
+    is looked up when it's first used, so neither slows down starting the
+    server. The built-ins can be replaced by passing data of the same name
+    to `render`, as `GetText` does with `_` for the locale's translations.
+
+    This wraps a Mako template rather than subclassing it, as that would
+    mean importing Mako with this module. Attributes that aren't its own
+    are passed on to the Mako template, but it isn't an instance of one.
     """
     
     builtins = {
         "_": lambda x: x.decode('utf-8'),
         "escape": escape,
-        "version": get_version()
+        "version": LazyVersion()
     }
+
+    def __init__(self, *args, **kwargs):
+        from mako.template import Template as MakoTemplate
+        self.template = MakoTemplate(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name == 'template':
+            raise AttributeError(name)
+        return getattr(self.template, name)
     
     def render(self, *args, **data):
-        data.update(self.builtins)
-        rendered = MakoTemplate.render_unicode(self, *args, **data)
+        values = dict(self.builtins)
+        values.update(data)
+        if isinstance(values.get('version'), LazyVersion):
+            values['version'] = get_version()
+        rendered = self.template.render_unicode(*args, **values)
         return rendered.encode('utf-8', 'replace')
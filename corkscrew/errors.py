@@ -45,3 +45,15 @@ class JsonError(CorkscrewError):
     @property
     def message(self):
         return self.args[1]
+
+class TLSError(CorkscrewError):
+    """
+    An exception that is raised when the certificate or private key for
+    the TLS listener can't be used.
+    """
+
+class OverloadError(CorkscrewError):
+    """
+    An exception that is raised when a call is turned away because too
+    many calls are already waiting to run.
+    """
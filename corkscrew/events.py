@@ -21,32 +21,325 @@
 #   Boston, MA    02110-1301, USA.
 #
 
+import time
+import heapq
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from corkscrew.metrics import registry
+
+# The name of the marker event returned by get_events in place of the
+# firings a listener missed because it fell too far behind.
+EVENTS_DROPPED = 'events_dropped'
+
+# What get_events does when a listener has more than max_pending events
+# waiting for it.
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_COALESCE = 'coalesce'
+
+EVENT_LISTENERS = registry.gauge('corkscrew_event_listeners',
+    'The number of event listeners', collected=True)
+EVENT_WAITING = registry.gauge('corkscrew_event_listeners_waiting',
+    'The number of event listeners waiting for events to be fired',
+    collected=True)
+EVENT_QUEUE_DEPTH = registry.gauge('corkscrew_event_queue_depth',
+    'The number of events queued for all the listeners', collected=True)
+EVENT_MAX_QUEUE_DEPTH = registry.gauge('corkscrew_event_max_queue_depth',
+    'The most events queued for a single listener', collected=True)
+EVENTS_DROPPED_TOTAL = registry.counter('corkscrew_events_dropped_total',
+    'The number of events dropped from listener queues')
+LISTENERS_REAPED_TOTAL = registry.counter('corkscrew_event_listeners_reaped_total',
+    'The number of idle listeners removed')
+
+def is_pattern(event):
+    """
+    Checks if an event name is a pattern, containing `*` segments that
+    match any single segment or `#` segments that match any number of
+    segments, e.g. `torrent.*` or `torrent.#`.
+
+    :param event: The event name
+    :type event: string
+    :returns: True or False
+    :rtype: bool
+    """
+    segments = event.split('.')
+    return '*' in segments or '#' in segments
+
+class TopicNode(object):
+
+    __slots__ = ('children', 'pattern')
+
+    def __init__(self):
+        self.children = {}
+        self.pattern = None
+
+class TopicTrie(object):
+    """
+    A trie of the dot separated segments of event patterns, so that the
+    patterns an event matches can be found by walking its segments
+    rather than testing every pattern.
+    """
+
+    def __init__(self):
+        self.root = TopicNode()
+
+    def __len__(self):
+        return len(self.root.children)
+
+    def add(self, pattern):
+        """
+        Adds a pattern to the trie.
+
+        :param pattern: The event pattern
+        :type pattern: string
+        """
+        node = self.root
+        for segment in pattern.split('.'):
+            if segment not in node.children:
+                node.children[segment] = TopicNode()
+            node = node.children[segment]
+        node.pattern = pattern
+
+    def remove(self, pattern):
+        """
+        Removes a pattern from the trie, pruning the nodes left empty.
+
+        :param pattern: The event pattern
+        :type pattern: string
+        """
+        path = [self.root]
+        segments = pattern.split('.')
+        for segment in segments:
+            path.append(path[-1].children[segment])
+        path[-1].pattern = None
+
+        for segment in reversed(segments):
+            node = path.pop()
+            if node.children or node.pattern is not None:
+                break
+            del path[-1].children[segment]
+
+    def match(self, event):
+        """
+        Finds the patterns that match an event.
+
+        :param event: The event name
+        :type event: string
+        :returns: The matching patterns
+        :rtype: set
+        """
+        matches = set()
+        self._match(self.root, event.split('.'), 0, matches)
+        return matches
+
+    def _match(self, node, segments, index, matches):
+        children = node.children
+        if '#' in children:
+            for i in range(index, len(segments) + 1):
+                self._match(children['#'], segments, i, matches)
+
+        if index == len(segments):
+            if node.pattern is not None:
+                matches.add(node.pattern)
+            return
+
+        if segments[index] in children:
+            self._match(children[segments[index]], segments, index + 1, matches)
+        if '*' in children:
+            self._match(children['*'], segments, index + 1, matches)
+
+class EventLog(object):
+    """
+    A bounded, append-only ring buffer of the firings of a single event,
+    shared by all of the event's listeners. Each listener keeps its own
+    cursor, the position of the next entry it has yet to collect, which
+    is added to the log with `add_cursor`. The buffer only grows to its
+    capacity as entries are appended, so events that rarely fire cost
+    little.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = []
+        self.count = 0
+        self.keys = {}
+
+        # The number of entries overwritten before they were blanked out
+        # by a newer entry with the same key. Superseded entries are not
+        # missed by anyone, so they are not reported as dropped.
+        self.lost = 0
+
+        # The number of cursors at each position and, once the entry at
+        # the position has been overwritten, how many had been lost before
+        # it. This keeps the number a cursor missed exact however far
+        # behind it falls.
+        self.cursors = {}
+
+    def add_cursor(self):
+        """
+        Adds a cursor at the end of the log.
+
+        :returns: The cursor position
+        :rtype: int
+        """
+        cursor = self.cursors.get(self.count)
+        if cursor is None:
+            self.cursors[self.count] = [1, None]
+        else:
+            cursor[0] += 1
+        return self.count
+
+    def remove_cursor(self, position):
+        """
+        Removes a cursor.
+
+        :param position: The cursor position
+        :type position: int
+        """
+        cursor = self.cursors[position]
+        cursor[0] -= 1
+        if not cursor[0]:
+            del self.cursors[position]
+
+    def move_cursor(self, position):
+        """
+        Moves a cursor to the end of the log, once it has read up to it.
+
+        :param position: The cursor position
+        :type position: int
+        :returns: The new cursor position
+        :rtype: int
+        """
+        self.remove_cursor(position)
+        return self.add_cursor()
+
+    def append(self, entry, key=None):
+        """
+        Appends an entry, overwriting the oldest once the log is full. If
+        a key is given, an entry still in the log that was appended with
+        the same key for the same event is blanked out so that only the
+        latest is read. A pattern's log holds the firings of several
+        events, and the same key on two of them doesn't supersede either.
+
+        :param entry: The entry to append
+        :type entry: tuple
+        :keyword key: The coalescing key for the entry
+        :type key: hashable
+        """
+        index = self.count % self.capacity
+        if index == len(self.entries):
+            self.entries.append(None)
+        else:
+            overwritten = self.count - self.capacity
+            cursor = self.cursors.get(overwritten)
+            if cursor is not None:
+                cursor[1] = self.lost
+            old = self.entries[index]
+            if old is not None:
+                if old[3] is not None and \
+                   self.keys.get((old[1], old[3])) == overwritten:
+                    del self.keys[(old[1], old[3])]
+                self.lost += 1
+
+        if key is not None:
+            key = (entry[1], key)
+            position = self.keys.get(key)
+            if position is not None:
+                self.entries[position % self.capacity] = None
+            self.keys[key] = self.count
+
+        self.entries[index] = entry
+        self.count += 1
+
+    def read(self, position):
+        """
+        Reads the entries from a cursor position up to the end of the log.
+
+        :param position: The position of a cursor added with `add_cursor`
+        :type position: int
+        :returns: The number of entries that were overwritten before they
+            could be read and the entries that are left
+        :rtype: tuple
+        """
+        capacity = self.capacity
+        start = max(position, self.count - capacity)
+        if start == position:
+            missed = 0
+        else:
+            missed = self.lost - self.cursors[position][1]
+
+        entries = [self.entries[i % capacity] for i in range(start, self.count)]
+        return missed, [e for e in entries if e is not None]
+
 class EventManager(object):
     """
     This class provides an easy means for having events within a web
     application.
     """
 
+    # The number of seconds a call to wait_events is parked for before
+    # it is answered with an empty list.
+    wait_timeout = 30
+
+    # The number of firings of each event kept for listeners that have
+    # yet to collect them.
+    log_capacity = 1000
+
+    # The most events handed to a listener at once, None for no limit,
+    # and how to choose which to drop when there are more than that.
+    # Coalescing keeps only the latest firing of each event, dropping
+    # the oldest of those if that is still too many.
+    max_pending = None
+    overflow = OVERFLOW_DROP_OLDEST
+
+    # The number of seconds a listener can go without collecting its
+    # events before it is removed, None to never remove listeners.
+    listener_timeout = 300
+
     def __init__(self):
         self.__events = {}
-        self.__handlers = {}
-        self.__queue = {}
+        self.__logs = {}
+        self.__patterns = TopicTrie()
+        self.__cursors = {}
+        self.__seen = {}
+        self.__waiting = {}
+        self.__pinned = set()
+        self.__seq = 0
+        self.dropped = 0
+        self.reaped = 0
+        registry.add_collector(self)
+        if self.listener_timeout:
+            self.reaper = LoopingCall(self._reap_listeners)
+            self.reaper.start(min(self.listener_timeout, 60))
+        else:
+            self.reaper = None
 
     def add_listener(self, listener_id, event):
         """
-        Add a listener for an event.
+        Add a listener for an event. The event may be a pattern such as
+        `torrent.*` to listen to every event it matches, see `is_pattern`.
 
         :param listener_id: A unique id for the listener
         :type listener_id: string
-        :param event: The event name
+        :param event: The event name or pattern
         :type event: string
         """
         if event not in self.__events:
             self._add_listener(listener_id, event)
-            self.__handlers[event] = on_event
             self.__events[event] = [listener_id]
+            self.__logs[event] = EventLog(self.log_capacity)
+            if is_pattern(event):
+                self.__patterns.add(event)
         elif listener_id not in self.__events[event]:
             self.__events[event].append(listener_id)
+        else:
+            return
+
+        cursors = self.__cursors.setdefault(listener_id, {})
+        cursors[event] = self.__logs[event].add_cursor()
+        self.__seen[listener_id] = time.time()
 
     def _add_listener(self, listener_id, event):
         """
@@ -60,45 +353,324 @@ class EventManager(object):
         :type event: string
         """
 
-    def fire_event(self, event, *args):
+    def fire_event(self, event, *args, **kwargs):
         """
-        Fires an event with the specified parameters.
+        Fires an event with the specified parameters. Firings that are
+        snapshots of some state can be given a coalescing key, a pending
+        firing of the event with the same key is then replaced rather than
+        queued behind. Firing an event nobody is listening to does
+        nothing.
 
         :param event: The event name
         :type event: string
+        :keyword key: The coalescing key for the firing
+        :type key: hashable
         """
-        for listener in self.__events[event]:
-            if listener not in self.__queue:
-                self.__queue[listener] = []
-            self.__queue[listener].append((event, args))
+        key = kwargs.pop('key', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                ', '.join(kwargs))
+
+        if self.__patterns:
+            subscriptions = self.__patterns.match(event)
+            if event in self.__logs:
+                subscriptions.add(event)
+        elif event in self.__logs:
+            subscriptions = (event,)
+        else:
+            return
+
+        self.__seq += 1
+        entry = (self.__seq, event, args, key)
+        for subscription in subscriptions:
+            self.__logs[subscription].append(entry, key)
+
+        if not self.__waiting:
+            return
+
+        # Only the parked listeners need waking, so walk whichever of the
+        # two sets is smaller.
+        waiting = set()
+        for subscription in subscriptions:
+            listeners = self.__events[subscription]
+            if len(self.__waiting) < len(listeners):
+                waiting.update([l for l in self.__waiting
+                    if subscription in self.__cursors.get(l, ())])
+            else:
+                waiting.update([l for l in listeners if l in self.__waiting])
+        for listener in waiting:
+            self._release_waiter(listener, self.get_events(listener))
 
     def get_events(self, listener_id):
         """
-        Retrieve the pending events for the listener.
+        Retrieve the pending events for the listener. If the listener fell
+        so far behind that some firings were overwritten, or it had more
+        than `max_pending` waiting, an `EVENTS_DROPPED` event carrying the
+        event name and the number of firings missed is returned ahead of
+        the rest.
+
+        :param listener_id: A unique id for the listener
+        :type listener_id: string
+        """
+        if listener_id not in self.__cursors:
+            return None
+
+        self.__seen[listener_id] = time.time()
+        cursors = self.__cursors[listener_id]
+        dropped = {}
+        batches = []
+        for event, position in cursors.items():
+            log = self.__logs[event]
+            if position == log.count:
+                continue
+            missed, entries = log.read(position)
+            cursors[event] = log.move_cursor(position)
+            if missed:
+                dropped[event] = missed
+            if entries:
+                batches.append(entries)
+
+        if not dropped and not batches:
+            return None
+
+        # Each log is already in firing order, so merging them on the
+        # sequence number gives the order across events. A firing matching
+        # more than one of the listener's patterns is only returned once.
+        if len(batches) == 1:
+            entries = batches[0]
+        else:
+            entries = []
+            last = None
+            for entry in heapq.merge(*batches):
+                if entry[0] != last:
+                    entries.append(entry)
+                    last = entry[0]
+
+        if self.max_pending and len(entries) > self.max_pending:
+            entries = self._overflow(entries, dropped)
+
+        if dropped:
+            self.dropped += sum(dropped.values())
+            EVENTS_DROPPED_TOTAL.inc(amount=sum(dropped.values()))
+        return [(EVENTS_DROPPED, (event, missed))
+            for event, missed in dropped.items()] + \
+            [(event, args) for seq, event, args, key in entries]
+
+    def _overflow(self, entries, dropped):
+        """
+        Trims a listener's pending events down to `max_pending` according
+        to the `overflow` policy.
+
+        :param entries: The pending entries, in firing order
+        :type entries: list
+        :param dropped: The number of firings dropped per event, updated
+            with the entries trimmed
+        :type dropped: dict
+        :returns: The entries that are kept
+        :rtype: list
+        """
+        if self.overflow == OVERFLOW_COALESCE:
+            # Firings with a coalescing key were already coalesced as they
+            # were fired, so only the unkeyed firings collapse here.
+            seen = set()
+            kept = []
+            for entry in reversed(entries):
+                if entry[3] is None:
+                    if entry[1] in seen:
+                        dropped[entry[1]] = dropped.get(entry[1], 0) + 1
+                        continue
+                    seen.add(entry[1])
+                kept.append(entry)
+            kept.reverse()
+            entries = kept
+
+        if len(entries) <= self.max_pending:
+            return entries
+
+        if self.overflow == OVERFLOW_DROP_NEWEST:
+            kept = entries[:self.max_pending]
+            trimmed = entries[self.max_pending:]
+        else:
+            kept = entries[-self.max_pending:]
+            trimmed = entries[:-self.max_pending]
+
+        for entry in trimmed:
+            dropped[entry[1]] = dropped.get(entry[1], 0) + 1
+        return kept
+
+    def get_queue_depths(self):
+        """
+        Returns the number of events waiting to be collected by each
+        listener.
+
+        :returns: The queue depth keyed by listener id
+        :rtype: dict
+        """
+        depths = {}
+        for listener_id, cursors in self.__cursors.items():
+            depth = 0
+            for event, position in cursors.items():
+                log = self.__logs[event]
+                depth += min(log.count - position, log.capacity)
+            if self.max_pending:
+                depth = min(depth, self.max_pending)
+            depths[listener_id] = depth
+        return depths
+
+    def get_stats(self):
+        """
+        Returns a summary of the listeners and their queues.
+
+        :rtype: dict
+        """
+        depths = self.get_queue_depths().values()
+        return {
+            'events':    len(self.__events),
+            'listeners': len(self.__cursors),
+            'waiting':   len(self.__waiting),
+            'pending':   sum(depths),
+            'max_depth': max(depths) if depths else 0,
+            'dropped':   self.dropped,
+            'reaped':    self.reaped
+        }
+
+    def collect_metrics(self):
+        stats = self.get_stats()
+        EVENT_LISTENERS.inc(amount=stats['listeners'])
+        EVENT_WAITING.inc(amount=stats['waiting'])
+        EVENT_QUEUE_DEPTH.inc(amount=stats['pending'])
+        EVENT_MAX_QUEUE_DEPTH.set(max(EVENT_MAX_QUEUE_DEPTH.get(),
+            stats['max_depth']))
+
+    def wait_events(self, listener_id, timeout=None, request=None):
+        """
+        Retrieve the pending events for the listener, waiting for some to
+        be fired if there are none queued. Only one call may be parked per
+        listener, a newer call answers the previous one with an empty list.
+
+        :param listener_id: A unique id for the listener
+        :type listener_id: string
+        :keyword timeout: Seconds to wait before giving up, defaults to
+            `wait_timeout`
+        :type timeout: int
+        :keyword request: The request waiting on the events, if the
+            connection drops the wait is cancelled
+        :type request: twisted.web.http.Request
+        :returns: A Deferred that fires with the list of events
+        :rtype: twisted.internet.defer.Deferred
+        """
+        events = self.get_events(listener_id)
+        if events:
+            return defer.succeed(events)
+
+        self._release_waiter(listener_id, [])
+
+        d = defer.Deferred(lambda d: self._forget_waiter(listener_id, d))
+        if timeout is None:
+            timeout = self.wait_timeout
+        call = reactor.callLater(timeout, self._release_waiter, listener_id, [])
+        self.__waiting[listener_id] = (d, call)
+
+        if request is not None:
+            request.notifyFinish().addErrback(lambda failure: d.cancel())
+        return d
+
+    def _release_waiter(self, listener_id, events):
+        """
+        Answers the call parked for the listener, if there is one.
+
+        :param listener_id: A unique id for the listener
+        :type listener_id: string
+        :param events: The events to answer with
+        :type events: list
+        """
+        if listener_id not in self.__waiting:
+            return
+        d, call = self.__waiting.pop(listener_id)
+        if call.active():
+            call.cancel()
+        d.callback(events)
+
+    def _forget_waiter(self, listener_id, d):
+        """
+        Removes a parked call without answering it, used when the waiting
+        Deferred is cancelled.
 
         :param listener_id: A unique id for the listener
         :type listener_id: string
+        :param d: The Deferred that was cancelled
+        :type d: twisted.internet.defer.Deferred
         """
-        if listener_id in self.__queue:
-            queue = self.__queue[listener_id]
-            del self.__queue[listener_id]
-            return queue
-        return None
+        if self.__waiting.get(listener_id, (None,))[0] is not d:
+            return
+        d, call = self.__waiting.pop(listener_id)
+        if call.active():
+            call.cancel()
 
     def remove_listener(self, listener_id, event):
         """
-        Removes a listener for an event
+        Removes a listener for an event, doing nothing if the listener has
+        already been removed.
 
         :param listener_id: A unique id for the listener
         :type listener_id: string
         :param event: The event name
         :type event: string
         """
+        if event not in self.__cursors.get(listener_id, ()):
+            return
+
         self.__events[event].remove(listener_id)
+        self.__logs[event].remove_cursor(self.__cursors[listener_id][event])
+        del self.__cursors[listener_id][event]
+        if not self.__cursors[listener_id]:
+            del self.__cursors[listener_id]
+            del self.__seen[listener_id]
+
         if not self.__events[event]:
             self._remove_listener(listener_id, event)
             del self.__events[event]
-            del self.__handlers[event]
+            del self.__logs[event]
+            if is_pattern(event):
+                self.__patterns.remove(event)
+
+    def pin_listener(self, listener_id):
+        """
+        Stops a listener from being reaped while it's idle. This is for
+        listeners kept alive by an open connection rather than by
+        collecting their events, such as an event stream paused because
+        its client is reading slowly.
+
+        :param listener_id: A unique id for the listener
+        :type listener_id: string
+        """
+        self.__pinned.add(listener_id)
+
+    def unpin_listener(self, listener_id):
+        """
+        Lets an idle listener be reaped again.
+
+        :param listener_id: A unique id for the listener
+        :type listener_id: string
+        """
+        self.__pinned.discard(listener_id)
+
+    def _reap_listeners(self):
+        """
+        Removes the listeners that have not collected their events within
+        the `listener_timeout`. Listeners with a call parked in
+        wait_events or that are pinned are still alive and are left
+        alone.
+        """
+        expires = time.time() - self.listener_timeout
+        for listener_id, seen in self.__seen.items():
+            if seen > expires or listener_id in self.__waiting or \
+               listener_id in self.__pinned:
+                continue
+            for event in self.__cursors[listener_id].keys():
+                self.remove_listener(listener_id, event)
+            self.reaped += 1
+            LISTENERS_REAPED_TOTAL.inc()
 
     def _remove_listener(self, listener_id, event):
         """
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/eventsource.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import logging
+
+from twisted.internet.defer import CancelledError
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import http, resource, server
+from zope.interface import implementer
+
+from corkscrew.auth import AUTH_LEVEL_DEFAULT
+from corkscrew.common import json, make_uid
+from corkscrew.errors import AuthError
+
+log = logging.getLogger(__name__)
+
+@implementer(IPushProducer)
+class EventStream(object):
+    """
+    Streams the events for a single listener down a request as Server-Sent
+    Events. The stream registers itself as the request's producer so that
+    when the client stops reading, events are left queued in the
+    `EventManager` instead of piling up in the transport's buffer.
+    """
+
+    def __init__(self, request, events, subscriptions, heartbeat):
+        self.request = request
+        self.events = events
+        self.subscriptions = subscriptions
+        self.heartbeat = heartbeat
+        self.listener_id = make_uid()
+        self.paused = False
+        self.finished = False
+        self.waiting = None
+
+    def start(self):
+        """
+        Subscribes the listener and begins streaming events.
+        """
+        for event in self.subscriptions:
+            self.events.add_listener(self.listener_id, event)
+
+        # The listener lives as long as the connection, even while paused
+        # by a slow client, so it mustn't be reaped as idle.
+        self.events.pin_listener(self.listener_id)
+
+        # Let the site know not to wait for the stream when draining
+        self.request.streaming = True
+        self.request.setHeader('content-type', 'text/event-stream')
+        self.request.setHeader('cache-control', 'no-cache')
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addBoth(self._on_finish)
+        self.request.write('retry: %d\n\n' % (self.heartbeat * 1000))
+        self._wait()
+
+    def _wait(self):
+        if self.paused or self.finished or self.waiting:
+            return
+        self.waiting = self.events.wait_events(self.listener_id,
+            self.heartbeat)
+        self.waiting.addCallbacks(self._on_events, self._on_cancelled)
+
+    def _on_events(self, events):
+        self.waiting = None
+        if events:
+            self.request.write(''.join(['event: %s\ndata: %s\n\n' % (
+                event, json.dumps(args)) for event, args in events]))
+        else:
+            # Nothing fired within the heartbeat, so send a comment line
+            # to keep proxies from closing an idle connection.
+            self.request.write(': heartbeat\n\n')
+        self._wait()
+
+    def _on_cancelled(self, failure):
+        failure.trap(CancelledError)
+
+    def _cancel_wait(self):
+        if self.waiting:
+            waiting, self.waiting = self.waiting, None
+            waiting.cancel()
+
+    def _on_finish(self, result):
+        self.finished = True
+        self._cancel_wait()
+        self.events.unpin_listener(self.listener_id)
+        for event in self.subscriptions:
+            self.events.remove_listener(self.listener_id, event)
+
+    def pauseProducing(self):
+        self.paused = True
+        self._cancel_wait()
+
+    def resumeProducing(self):
+        self.paused = False
+        self._wait()
+
+    def stopProducing(self):
+        self.paused = True
+        self._cancel_wait()
+
+class EventSource(resource.Resource):
+    """
+    A Twisted Web resource that pushes events from an `EventManager` to
+    web clients as Server-Sent Events. Clients pick the events to listen
+    to with one or more `events` query arguments.
+    """
+
+    isLeaf = True
+
+    # The auth level required to open a stream
+    auth_level = AUTH_LEVEL_DEFAULT
+
+    # The number of seconds between heartbeats on an idle stream
+    heartbeat = 15
+
+    # The most events a single stream can listen to, each one being kept
+    # in the EventManager for as long as the stream is open.
+    max_subscriptions = 50
+
+    def __init__(self, events, auth=None):
+        resource.Resource.__init__(self)
+        self.events = events
+        self.auth = auth
+
+    def render(self, request):
+        if request.method != 'GET':
+            request.setResponseCode(http.NOT_ALLOWED)
+            return ''
+
+        if self.auth:
+            try:
+                self.auth.check_request(request, level=self.auth_level)
+            except AuthError:
+                request.setResponseCode(http.UNAUTHORIZED)
+                return ''
+
+        subscriptions = sorted(set(request.args.get('events', [])))
+        if not subscriptions or len(subscriptions) > self.max_subscriptions:
+            request.setResponseCode(http.BAD_REQUEST)
+            return ''
+
+        log.debug('opening event stream for: %s', subscriptions)
+        EventStream(request, self.events, subscriptions, self.heartbeat).start()
+        return server.NOT_DONE_YET
@@ -20,18 +20,33 @@
 #   Boston, MA    02110-1301, USA.
 #
 
+import time
+import hashlib
 import logging
+import tempfile
 
 from types import FunctionType
-from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, DeferredList
+from twisted.python.failure import Failure
 from twisted.web import http, resource, server
 
-from corkscrew.errors import AuthError, JsonError
+from corkscrew.errors import AuthError, JsonError, OverloadError
 
 # predefine values so we can use lazy loading
 AUTH_LEVEL_DEFAULT = None
 
-def export(auth_level=AUTH_LEVEL_DEFAULT):
+# The methods controlling the request profiler
+PROFILE_METHODS = ('system.profile', 'system.profileStats',
+    'system.profileDump', 'system.resetProfile')
+
+# The methods provided by the JsonRpc resource itself, these aren't held
+# back by the concurrency limits.
+SYSTEM_METHODS = ('system.listMethods', 'system.stats',
+    'system.resetStats') + PROFILE_METHODS
+
+def export(auth_level=AUTH_LEVEL_DEFAULT, max_concurrent=None, timeout=None,
+           priority=None, cacheable=False):
     """
     Decorator function to register an object's method as a RPC. The object
     will need to be registered with a `:class:JsonRpc` to be effective.
@@ -40,15 +55,35 @@ def export(auth_level=AUTH_LEVEL_DEFAULT):
     :type func: function
     :keyword auth_level: the auth level required to call this method
     :type auth_level: int
+    :keyword max_concurrent: the most calls to this method that can run at
+        once, further calls wait for one to complete
+    :type max_concurrent: int
+    :keyword timeout: the most seconds a call to this method that returns
+        a Deferred can take before it is cancelled
+    :type timeout: int
+    :keyword priority: the priority class calls to this method wait in
+        when they can't run straight away, see `corkscrew.scheduler`
+    :type priority: string
+    :keyword cacheable: whether the responses to this method carry the
+        hash of the result, so that a client sending the hash back is
+        told when the result hasn't changed rather than sent it again
+    :type cacheable: bool
 
     """
     global AUTH_LEVEL_DEFAULT
     if AUTH_LEVEL_DEFAULT is None:
         from corkscrew.auth import AUTH_LEVEL_DEFAULT
 
+    if auth_level is None:
+        auth_level = AUTH_LEVEL_DEFAULT
+
     def wrap(func, *args, **kwargs):
         func._json_export = True
         func._json_auth_level = auth_level
+        func._json_max_concurrent = max_concurrent
+        func._json_timeout = timeout
+        func._json_priority = priority
+        func._json_cacheable = cacheable
         return func
 
     if type(auth_level) is FunctionType:
@@ -58,21 +93,83 @@ def export(auth_level=AUTH_LEVEL_DEFAULT):
     else:
         return wrap
 
-from corkscrew.auth import Auth
-from corkscrew.common import json, compress
+from corkscrew.common import (json, compress_async, compress_failed,
+    record_timing)
+from corkscrew.limits import ConcurrencyLimiter
+from corkscrew.metrics import registry
+from corkscrew.profiler import profiler
+from corkscrew.scheduler import FairScheduler
+from corkscrew.stats import CallStats
 
 log = logging.getLogger(__name__)
 
+RPC_CALLS = registry.counter('corkscrew_rpc_calls_total',
+    'The number of calls made to each method', ('method',))
+RPC_ERRORS = registry.counter('corkscrew_rpc_errors_total',
+    'The number of calls to each method that failed', ('method',))
+RPC_IN_FLIGHT = registry.gauge('corkscrew_rpc_in_flight',
+    'The number of calls to each method running', ('method',),
+    collected=True)
+RPC_QUEUED = registry.gauge('corkscrew_rpc_queued',
+    'The number of calls waiting to run', collected=True)
+RPC_REJECTED = registry.counter('corkscrew_rpc_rejected_total',
+    'The number of calls turned away because too many were waiting')
+RPC_WAITS = registry.counter('corkscrew_rpc_queue_waits_total',
+    'The number of calls that waited to run')
+RPC_WAIT_SECONDS = registry.counter('corkscrew_rpc_queue_wait_seconds_total',
+    'The time calls spent waiting to run')
+RPC_NOT_MODIFIED = registry.counter('corkscrew_rpc_not_modified_total',
+    'The number of calls answered with not modified', ('method',))
+
+def result_hash(encoded):
+    """
+    Returns the hash of an encoded result that the responses to cacheable
+    methods carry. This is a small fraction of the time spent encoding the
+    result in the first place.
+
+    :param encoded: The JSON encoded result
+    :type encoded: str
+    :rtype: str
+    """
+    return hashlib.md5(encoded).hexdigest()
+
 class JsonRpc(resource.Resource):
     """
     A Twisted Web resource that exposes a JSON-RPC interface for web clients \
     to use.
     """
 
+    # The most method calls that can run at once, or None for no limit.
+    # Calls over this, or over a method's own limit, wait to run.
+    max_concurrent = None
+
+    # The most calls that can wait to run, once this many are waiting
+    # further calls fail straight away with an overload error.
+    max_queued = 100
+
+    # The weight of each priority class in sharing out the calls started
+    # from the queue, the scheduler's defaults if None.
+    priority_weights = None
+
+    # The most seconds a call can take, including any time spent waiting
+    # to run, before it is cancelled. Methods can set their own with
+    # @export(timeout=...).
+    timeout = None
+
+    # The directory system.profileDump writes the profiler's stats to, a
+    # new private temporary directory for each dump if None.
+    profile_dir = None
+
     def __init__(self, auth=False):
         resource.Resource.__init__(self)
         self.methods = {}
+        self.limiter = ConcurrencyLimiter(self.max_concurrent, self.max_queued,
+            FairScheduler(self.priority_weights))
+        self.stats = CallStats()
+        self.profiler = profiler
+        registry.add_collector(self)
         if auth:
+            from corkscrew.auth import Auth
             self.auth = Auth()
             self.register_object(self.auth)
         else:
@@ -81,12 +178,57 @@ class JsonRpc(resource.Resource):
     def get_methods(self):
         return self.methods.keys()
 
+    def get_stats(self):
+        """
+        Returns the number of calls made to each method, how many failed,
+        how many are running and percentiles of how long they took in
+        milliseconds, along with the state of the concurrency limits.
+
+        :rtype: dict
+        """
+        return {
+            'since': self.stats.since,
+            'methods': self.stats.get_stats(),
+            'limits': self.limiter.get_stats()
+        }
+
+    def collect_metrics(self):
+        for method, stats in self.stats.methods.iteritems():
+            RPC_IN_FLIGHT.inc((method,), stats.in_flight)
+        RPC_QUEUED.inc(amount=len(self.limiter.queue))
+
+    def reset_stats(self):
+        """
+        Clears the method stats.
+        """
+        self.stats.reset()
+
+    def check_admin(self, request):
+        """
+        Checks that the request is from an admin session, if auth is
+        enabled.
+
+        :raises: AuthError
+        """
+        if self.auth:
+            from corkscrew.auth import AUTH_LEVEL_ADMIN
+            self.auth.check_request(request, level=AUTH_LEVEL_ADMIN)
+
     def exec_method(self, method, params, request):
         """
         Handles executing all local methods.
         """
         if method == "system.listMethods":
             return self.get_methods()
+        elif method == "system.stats":
+            self.check_admin(request)
+            return self.get_stats()
+        elif method == "system.resetStats":
+            self.check_admin(request)
+            return self.reset_stats()
+        elif method in PROFILE_METHODS:
+            self.check_admin(request)
+            return self.exec_profile_method(method, params)
         elif method in self.methods:
             # This will eventually process methods that the server adds
             # and any plugins.
@@ -97,6 +239,82 @@ class JsonRpc(resource.Resource):
             return meth(*params)
         raise JSONException("Unknown method")
 
+    def exec_profile_method(self, method, params):
+        """
+        Handles the methods controlling the request profiler:
+
+        * system.profile([rate]), sets the fraction of requests to profile
+          if specified, 0 turns profiling off, and returns the rate and
+          the number of requests profiled for each method or path
+        * system.profileStats([sort, limit]), returns the stats for each
+          method or path as text
+        * system.profileDump(), writes the stats for each method or path
+          to files in `profile_dir` and returns their paths
+        * system.resetProfile(), discards the stats
+        """
+        if method == "system.profile":
+            if params and params[0] is not None:
+                self.profiler.set_rate(params[0])
+            return self.profiler.get_status()
+        elif method == "system.profileStats":
+            return self.profiler.get_stats(*params)
+        elif method == "system.profileDump":
+            directory = self.profile_dir
+            if directory is None:
+                # Files with predictable names in the shared temporary
+                # directory could be replaced or read by other users.
+                directory = tempfile.mkdtemp(prefix='corkscrew-profile-')
+            return self.profiler.dump(directory)
+        elif method == "system.resetProfile":
+            return self.profiler.reset()
+
+    def get_timeout(self, method):
+        """
+        Returns the most seconds a call to the method can take.
+
+        :param method: The method name
+        :type method: str
+        :returns: The timeout, or None for no timeout
+        :rtype: int
+        """
+        timeout = getattr(self.methods.get(method), '_json_timeout', None)
+        return self.timeout if timeout is None else timeout
+
+    def get_priority(self, method):
+        """
+        Returns the priority class of the method.
+
+        :param method: The method name
+        :type method: str
+        :returns: The priority class, or None for the default
+        :rtype: string
+        """
+        return getattr(self.methods.get(method), '_json_priority', None)
+
+    def is_cacheable(self, method):
+        """
+        Checks to see if the responses to the method carry the hash of the
+        result.
+
+        :param method: The method name
+        :type method: str
+        :returns: True or False
+        :rtype: bool
+        """
+        return getattr(self.methods.get(method), '_json_cacheable', False)
+
+    def get_session(self, request):
+        """
+        Returns what identifies the client making a request, so that
+        clients get a fair share of the calls started from the queue. This
+        is the session cookie, or the client's address if there isn't one.
+
+        :param request: The request
+        :type request: twisted.web.http.Request
+        :rtype: string
+        """
+        return request.getCookie('_session_id') or request.getClientIP()
+
     def has_method(self, method):
         """
         Checks to see if we can handle the specified method.
@@ -106,7 +324,7 @@ class JsonRpc(resource.Resource):
         :returns: True or False
         :rtype: bool
         """
-        return method == 'system.listMethods' or method in self.methods
+        return method in SYSTEM_METHODS or method in self.methods
 
     def handle_request(self, request):
         """
@@ -114,8 +332,10 @@ class JsonRpc(resource.Resource):
         the rpc object that should be contained, returning a deferred for all
         procedure calls and the request id.
         """
+        started = time.time()
         try:
             request.json = json.loads(request.json)
+            record_timing(request, 'decode', started)
         except ValueError:
             raise JSONException("JSON not decodable")
         
@@ -126,18 +346,61 @@ class JsonRpc(resource.Resource):
         method, params = request.json['method'], request.json['params']
         request.request_id = request.json['id']
 
-        if self.has_method(method):
-            try:
-                return self.exec_method(method, params, request)
-            except AuthError:
-                raise JsonError(1, 'Not authenticated')
-            except Exception as e:
-                log.error("Error calling method `%s`", method)
-                log.exception(e)
-                raise JsonError(3, e.message)
-        else:
+        if not self.has_method(method):
             raise JsonError(2, 'Unknown method')
 
+        if method in SYSTEM_METHODS or self.limiter.try_acquire(method):
+            return self.call_method(method, params, request)
+
+        try:
+            d = self.limiter.acquire(method, self.get_priority(method),
+                self.get_session(request))
+        except OverloadError:
+            RPC_REJECTED.inc()
+            log.warning("Turning away call to `%s`, too many waiting", method)
+            raise JsonError(4, 'Server overloaded')
+        queued = time.time()
+        def start(result):
+            RPC_WAITS.inc()
+            RPC_WAIT_SECONDS.inc(amount=time.time() - queued)
+            record_timing(request, 'queue', queued)
+            return self.call_method(method, params, request)
+        return d.addCallback(start)
+
+    def call_method(self, method, params, request):
+        """
+        Calls a method that has been let through the concurrency limits,
+        timing it and releasing its place once it has completed.
+        """
+        started = self.stats.start(method)
+        RPC_CALLS.inc((method,))
+        try:
+            result = self.exec_method(method, params, request)
+        except AuthError:
+            self.finish_method(Failure(), method, started, request)
+            raise JsonError(1, 'Not authenticated')
+        except Exception as e:
+            self.finish_method(Failure(), method, started, request)
+            log.error("Error calling method `%s`", method)
+            log.exception(e)
+            raise JsonError(3, e.message)
+
+        if isinstance(result, Deferred):
+            return result.addBoth(self.finish_method, method, started,
+                request)
+        self.finish_method(result, method, started, request)
+        return result
+
+    def finish_method(self, result, method, started, request):
+        failed = isinstance(result, Failure)
+        self.stats.finish(method, started, failed)
+        if failed:
+            RPC_ERRORS.inc((method,))
+        record_timing(request, 'dispatch', started)
+        if method not in SYSTEM_METHODS:
+            self.limiter.release(method)
+        return result
+
     def on_json_request(self, request):
         """
         Handler to take the json data as a string and pass it on to the
@@ -167,6 +430,7 @@ class JsonRpc(resource.Resource):
 
         # Check to see if we have a Deferred and change our behaviour if so
         if isinstance(result, Deferred):
+            self.watch_result(result, request)
             result.addCallback(self.on_got_result, request, response)
             result.addErrback(self.on_err_result, request, response)
             return result
@@ -174,6 +438,33 @@ class JsonRpc(resource.Resource):
             response['result'] = result
             return self.send_response(request, response)
 
+    def watch_result(self, result, request):
+        """
+        Cancels a call that returned a Deferred if it runs past its
+        deadline or the client goes away before it completes.
+        """
+        timeout = self.get_timeout(request.json['method'])
+        if timeout:
+            call = reactor.callLater(timeout, self.on_timeout, result, request)
+            result.addBoth(self._cancel_timeout, call)
+        request.notifyFinish().addErrback(self.on_disconnect, result, request)
+
+    def on_timeout(self, result, request):
+        log.warning("Call to `%s` timed out", request.json['method'])
+        request.timed_out = True
+        result.cancel()
+
+    def _cancel_timeout(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def on_disconnect(self, reason, result, request):
+        log.debug("Client went away, cancelling call to `%s`",
+            request.json['method'])
+        request.disconnected = True
+        result.cancel()
+
     def on_got_result(self, result, request, response):
         """
         Sends the result of a RPC call that returned a Deferred.
@@ -185,7 +476,22 @@ class JsonRpc(resource.Resource):
         """
         Handles any failures that occured while making a RPC call.
         """
-        response['error'] = failure.value.args[0] if failure.value.args else ''
+        if failure.check(CancelledError):
+            if not getattr(request, 'timed_out', False):
+                return
+            response['error'] = {'message': 'Timed out', 'code': 5}
+        elif failure.check(JsonError):
+            response['error'] = {
+                'message': failure.value.message,
+                'code': failure.value.code
+            }
+        else:
+            log.error("Error in call to `%s`: %s", request.json['method'],
+                failure.getErrorMessage())
+            response['error'] = {
+                'message': failure.getErrorMessage(),
+                'code': 3
+            }
         return self.send_response(request, response)
 
     def on_json_request_failed(self, reason, request):
@@ -205,8 +511,53 @@ class JsonRpc(resource.Resource):
         :param response: The response dictionary
         :type response: dict
         """
+        if getattr(request, 'disconnected', False):
+            return
         request.setHeader("content-type", "application/x-json")
-        request.write(compress(json.dumps(response), request))
+        started = time.time()
+        if response['error'] is None and \
+           self.is_cacheable(request.json['method']):
+            body = self.encode_cacheable(request, response)
+        else:
+            body = json.dumps(response)
+        record_timing(request, 'encode', started)
+        d = compress_async(body, request)
+        d.addCallbacks(self.write_response, compress_failed,
+            callbackArgs=(request,), errbackArgs=(request,))
+        return d
+
+    def encode_cacheable(self, request, response):
+        """
+        Encodes the response to a call to a cacheable method, adding the
+        hash of the result. If the request's `hash` is the same the client
+        already has the result, so it's left out and `not_modified` is set
+        instead, saving compressing and sending it again.
+        """
+        # Keys are sorted so that equal results hash the same however their
+        # dicts were built, and in every worker. This takes the pure python
+        # encoder, the C one doesn't sort dicts nested in lists reliably.
+        result = json.dumps(response['result'], sort_keys=True)
+        digest = result_hash(result)
+        if request.json.get('hash') == digest:
+            RPC_NOT_MODIFIED.inc((request.json['method'],))
+            return json.dumps({
+                'result': None,
+                'error': None,
+                'id': response['id'],
+                'hash': digest,
+                'not_modified': True
+            })
+        return '{"result": %s, "error": null, "id": %s, "hash": "%s"}' % (
+            result, json.dumps(response['id']), digest)
+
+    def write_response(self, body, request):
+        """
+        Writes the compressed response, unless the client went away while
+        a large one was being compressed.
+        """
+        if request._disconnected:
+            return
+        request.write(body)
         request.finish()
 
     def render(self, request):
@@ -218,6 +569,24 @@ class JsonRpc(resource.Resource):
             request.setResponseCode(http.NOT_ALLOWED)
             return ""
 
+        if self.profiler.sample():
+            profile, result = self.profiler.runcall(self.render_json, request)
+            method = request.json.get('method') \
+                if isinstance(request.json, dict) else None
+            # Only methods that exist are keyed on, so that clients can't
+            # grow the stats with made up names.
+            if isinstance(method, basestring) and (method in self.methods or
+                    (method in SYSTEM_METHODS and
+                     method not in PROFILE_METHODS)):
+                self.profiler.add(unicode(method), profile)
+            return result
+        return self.render_json(request)
+
+    def render_json(self, request):
+        """
+        Reads the JSON-RPC request from the body of the POST and starts
+        handling it.
+        """
         try:
             request.content.seek(0)
             request.json = request.content.read()
@@ -242,9 +611,12 @@ class JsonRpc(resource.Resource):
         for d in dir(obj):
             if d[0] == "_":
                 continue
-            if getattr(getattr(obj, d), '_json_export', False):
+            func = getattr(obj, d)
+            if getattr(func, '_json_export', False):
                 log.debug("Registering method: %s", name + "." + d)
-                self.methods[name + "." + d] = getattr(obj, d)
+                self.methods[name + "." + d] = func
+                self.limiter.set_limit(name + "." + d,
+                    getattr(func, '_json_max_concurrent', None))
 
 class ConnectableJsonRpc(JsonRpc):
     pass
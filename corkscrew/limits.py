@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/limits.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+
+from collections import deque
+from twisted.internet import defer
+
+from corkscrew.errors import OverloadError
+
+class FifoQueue(object):
+    """
+    The queue of calls waiting to run, started in the order they arrived.
+    Each call is a tuple of its Deferred, key and the time it was queued.
+    """
+
+    def __init__(self):
+        self.calls = deque()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def push(self, call, priority=None, session=None):
+        """
+        Adds a call to the queue.
+
+        :param call: The call
+        :type call: tuple
+        :keyword priority: The priority of the call, ignored
+        :keyword session: The session making the call, ignored
+        """
+        self.calls.append(call)
+
+    def pop(self, can_run):
+        """
+        Removes and returns the next call that can run.
+
+        :param can_run: Checks if a call for a key can run
+        :type can_run: function
+        :returns: The call, or None if none can run
+        :rtype: tuple
+        """
+        for call in self.calls:
+            if can_run(call[1]):
+                self.calls.remove(call)
+                return call
+
+    def remove(self, d):
+        """
+        Removes the call with the specified Deferred from the queue.
+
+        :param d: The call's Deferred
+        :type d: twisted.internet.defer.Deferred
+        """
+        for call in self.calls:
+            if call[0] is d:
+                self.calls.remove(call)
+                break
+
+    def get_stats(self):
+        return {}
+
+class ConcurrencyLimiter(object):
+    """
+    Limits how many calls run at once, both in total and for each key
+    that has a limit of its own set. Calls that can't run straight away
+    wait in a bounded queue, and are started in the order the queue
+    chooses as running calls are released, by default the order they
+    arrived. Once the queue is full further calls are turned away.
+    """
+
+    def __init__(self, max_concurrent=None, max_queued=100, queue=None):
+        """
+        :keyword max_concurrent: The most calls that can run at once, or
+            None for no limit
+        :type max_concurrent: int
+        :keyword max_queued: The most calls that can wait to run
+        :type max_queued: int
+        :keyword queue: The queue for waiting calls, a `FifoQueue` if
+            not specified
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.limits = {}
+        self.running = {}
+        self.total = 0
+        self.queue = FifoQueue() if queue is None else queue
+        self.__releasing = False
+
+        self.rejected = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def set_limit(self, key, limit):
+        """
+        Sets the most calls that can run at once for a key.
+
+        :param key: The key, e.g. a method name
+        :type key: string
+        :param limit: The limit, or None to remove it
+        :type limit: int
+        """
+        if limit is None:
+            self.limits.pop(key, None)
+        else:
+            self.limits[key] = limit
+
+    def can_run(self, key):
+        """
+        Checks if a call for the key could start running now.
+
+        :param key: The key
+        :type key: string
+        :returns: True or False
+        :rtype: bool
+        """
+        if self.max_concurrent is not None and \
+                self.total >= self.max_concurrent:
+            return False
+        limit = self.limits.get(key)
+        return limit is None or self.running.get(key, 0) < limit
+
+    def try_acquire(self, key):
+        """
+        Starts a call for the key if it can run now.
+
+        :param key: The key
+        :type key: string
+        :returns: True if the call was started
+        :rtype: bool
+        """
+        if not self.can_run(key):
+            return False
+        self._start(key)
+        return True
+
+    def acquire(self, key, priority=None, session=None):
+        """
+        Starts a call for the key, waiting in the queue if it can't run
+        now. The call must be released once it has completed.
+
+        :param key: The key
+        :type key: string
+        :keyword priority: The priority of the call, for the queue
+        :keyword session: The session making the call, for the queue
+        :type session: string
+        :returns: A Deferred that fires once the call has started,
+            cancelling it gives up the call's place in the queue
+        :rtype: twisted.internet.defer.Deferred
+        :raises: OverloadError if the queue is full
+        """
+        if self.try_acquire(key):
+            return defer.succeed(None)
+
+        if len(self.queue) >= self.max_queued:
+            self.rejected += 1
+            raise OverloadError('Too many calls waiting to run')
+
+        d = defer.Deferred(self.queue.remove)
+        self.queue.push((d, key, time.time()), priority, session)
+        return d
+
+    def release(self, key):
+        """
+        Marks a call for the key as complete, starting any waiting calls
+        that can now run.
+
+        :param key: The key
+        :type key: string
+        """
+        self.total -= 1
+        self.running[key] -= 1
+        if not self.running[key]:
+            del self.running[key]
+
+        # Calls started here may complete and release straight away, the
+        # outer release carries on starting calls rather than recursing.
+        if self.__releasing:
+            return
+        self.__releasing = True
+        try:
+            while self._start_next():
+                pass
+        finally:
+            self.__releasing = False
+
+    def get_stats(self):
+        """
+        Returns the running and queued calls along with how long calls
+        have waited to start.
+
+        :rtype: dict
+        """
+        return {
+            'running': self.total,
+            'queued': len(self.queue),
+            'max_concurrent': self.max_concurrent,
+            'max_queued': self.max_queued,
+            'methods': dict(self.running),
+            'rejected': self.rejected,
+            'waited': self.waited,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait,
+            'queue': self.queue.get_stats()
+        }
+
+    def _start(self, key):
+        self.total += 1
+        self.running[key] = self.running.get(key, 0) + 1
+
+    def _start_next(self):
+        if not self.queue:
+            return False
+        call = self.queue.pop(self.can_run)
+        if call is None:
+            return False
+
+        d, key, queued = call
+        wait = time.time() - queued
+        self.waited += 1
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._start(key)
+        d.callback(None)
+        return True
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/metrics.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+import weakref
+
+from twisted.web import http, resource
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n').encode('utf-8')
+
+class Metric(object):
+    """
+    A named value, or a value for each combination of label values. The
+    values are kept in a dict keyed by a tuple of the label values, so
+    updating one is a single dict update.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), collected=False):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collected = collected
+        self.values = {}
+
+    def get(self, labels=()):
+        """
+        Returns the value, 0 if it hasn't been set.
+
+        :keyword labels: The label values, in the order of the labels
+        :type labels: tuple
+        :rtype: int or float
+        """
+        return self.values.get(labels, 0)
+
+    def set(self, value, labels=()):
+        """
+        Sets the value.
+
+        :param value: The value
+        :type value: int or float
+        :keyword labels: The label values, in the order of the labels
+        :type labels: tuple
+        """
+        self.values[labels] = value
+
+    def clear(self):
+        """
+        Removes all the values.
+        """
+        self.values.clear()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type)
+        ]
+        for labels, value in sorted(self.values.iteritems()):
+            if labels:
+                labels = '{%s}' % ','.join(['%s="%s"' % (name, escape_label(v))
+                    for name, v in zip(self.labels, labels)])
+            else:
+                labels = ''
+            lines.append('%s%s %s' % (self.name, labels, repr(float(value))))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as the number of requests served.
+    """
+
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """
+        Adds to the value.
+
+        :keyword labels: The label values, in the order of the labels
+        :type labels: tuple
+        :keyword amount: The amount to add
+        :type amount: int or float
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, such as the number of sessions.
+    """
+
+    type = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        """
+        Adds to the value.
+
+        :keyword labels: The label values, in the order of the labels
+        :type labels: tuple
+        :keyword amount: The amount to add, which may be negative
+        :type amount: int or float
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Registry(object):
+    """
+    Holds the metrics that are exposed by the `MetricsResource`.
+
+    Values that are cheaper to read when scraped than to keep up to date,
+    such as the number of sessions, come from collectors: objects with a
+    `collect_metrics` method that sets them, which is called before the
+    metrics are rendered. Collectors are held weakly, so registering an
+    object doesn't keep it alive.
+
+    There can be several collectors of a kind, such as one per `JsonRpc`
+    resource, so gauges made with `collected` set are cleared before each
+    collection and the collectors add their share to them. Counters are
+    only ever added to where what they count happens, never set from a
+    collector's state, so that they can't go backwards.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = weakref.WeakKeyDictionary()
+
+    def counter(self, name, help, labels=()):
+        """
+        Returns the counter with the name, creating it the first time.
+
+        :param name: The metric name
+        :type name: string
+        :param help: A description of the metric
+        :type help: string
+        :keyword labels: The label names
+        :type labels: tuple
+        :rtype: `Counter`
+        """
+        return self._get_metric(Counter, name, help, labels, False)
+
+    def gauge(self, name, help, labels=(), collected=False):
+        """
+        Returns the gauge with the name, creating it the first time.
+
+        :param name: The metric name
+        :type name: string
+        :param help: A description of the metric
+        :type help: string
+        :keyword labels: The label names
+        :type labels: tuple
+        :keyword collected: Whether the values are added up by collectors
+        :type collected: bool
+        :rtype: `Gauge`
+        """
+        return self._get_metric(Gauge, name, help, labels, collected)
+
+    def add_collector(self, collector):
+        """
+        Registers an object whose `collect_metrics` method is called
+        before the metrics are rendered.
+
+        :param collector: The collector
+        :type collector: object
+        """
+        self.collectors[collector] = True
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format.
+
+        :rtype: string
+        """
+        for metric in self.metrics.itervalues():
+            if metric.collected:
+                metric.clear()
+        for collector in self.collectors.keys():
+            collector.collect_metrics()
+        return '\n'.join([self.metrics[name].render()
+            for name in sorted(self.metrics)]) + '\n'
+
+    def _get_metric(self, cls, name, help, labels, collected):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels, collected)
+        return metric
+
+# The registry shared by the corkscrew modules
+registry = Registry()
+
+REQUESTS = registry.counter('corkscrew_requests_total',
+    'The number of requests served', ('resource',))
+REQUEST_BYTES = registry.counter('corkscrew_request_bytes_total',
+    'The number of bytes received in request bodies', ('resource',))
+RESPONSE_BYTES = registry.counter('corkscrew_response_bytes_total',
+    'The number of bytes sent in response bodies', ('resource',))
+
+COMPRESS_CALLS = registry.counter('corkscrew_compress_total',
+    'The number of responses compressed')
+COMPRESS_INPUT = registry.counter('corkscrew_compress_input_bytes_total',
+    'The number of bytes passed to compress')
+COMPRESS_OUTPUT = registry.counter('corkscrew_compress_output_bytes_total',
+    'The number of bytes returned by compress')
+COMPRESS_SECONDS = registry.counter('corkscrew_compress_seconds_total',
+    'The time spent compressing')
+
+REACTOR_LAG = registry.gauge('corkscrew_reactor_lag_seconds',
+    'How late the reactor ran the last lag check')
+REACTOR_MAX_LAG = registry.gauge('corkscrew_reactor_max_lag_seconds',
+    'The latest the reactor ran a lag check since the last scrape')
+
+class ReactorLagMonitor(object):
+    """
+    Measures how late the reactor runs a call scheduled every `interval`
+    seconds, which is how long something has been blocking it.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.expected = None
+        self.max_lag = 0.0
+        self.call = None
+        registry.add_collector(self)
+
+    def start(self):
+        if self.call is None:
+            self._schedule()
+
+    def stop(self):
+        if self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+
+    def collect_metrics(self):
+        REACTOR_MAX_LAG.set(self.max_lag)
+        self.max_lag = 0.0
+
+    def _schedule(self):
+        from twisted.internet import reactor
+        self.expected = time.time() + self.interval
+        self.call = reactor.callLater(self.interval, self._check)
+
+    def _check(self):
+        lag = max(time.time() - self.expected, 0.0)
+        REACTOR_LAG.set(lag)
+        self.max_lag = max(self.max_lag, lag)
+        self._schedule()
+
+class MetricsResource(resource.Resource):
+    """
+    A Twisted Web resource that exposes the metrics in the Prometheus text
+    format, and measures the reactor's lag while it exists.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+        self.lag_monitor = ReactorLagMonitor()
+
+        from twisted.internet import reactor
+        reactor.callWhenRunning(self.lag_monitor.start)
+
+    def render(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            request.setResponseCode(http.NOT_ALLOWED)
+            return ''
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/profiler.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import re
+import random
+import pstats
+import logging
+
+from cProfile import Profile
+from StringIO import StringIO
+
+log = logging.getLogger(__name__)
+
+class RequestProfiler(object):
+    """
+    Runs a fraction of requests under cProfile, adding up the stats for
+    each RPC method or path. Sampling is off until a rate is set, when
+    the cost of checking whether to profile a request is one call to
+    random.
+
+    Only the work done while rendering is profiled, the part of a call
+    that returns a Deferred that runs after it fires is not.
+    """
+
+    def __init__(self):
+        self.rate = 0.0
+        self.reset()
+
+    def reset(self):
+        """
+        Discards the stats gathered so far.
+        """
+        self.stats = {}
+        self.counts = {}
+
+    def set_rate(self, rate):
+        """
+        Sets the fraction of requests to profile.
+
+        :param rate: The fraction, between 0 to turn profiling off and 1
+            to profile every request
+        :type rate: float
+        """
+        self.rate = min(max(float(rate), 0.0), 1.0)
+        log.info('Profiling %.1f%% of requests', self.rate * 100)
+
+    def sample(self):
+        """
+        Checks if the next request should be profiled.
+
+        :rtype: bool
+        """
+        return self.rate > 0 and random.random() < self.rate
+
+    def runcall(self, func, *args, **kwargs):
+        """
+        Calls a function under the profiler.
+
+        :param func: The function
+        :type func: function
+        :returns: The profile and what the function returned
+        :rtype: tuple
+        """
+        profile = Profile()
+        result = profile.runcall(func, *args, **kwargs)
+        return profile, result
+
+    def add(self, key, profile):
+        """
+        Adds a profile to the stats for a key.
+
+        :param key: The RPC method or path profiled
+        :type key: string
+        :param profile: The profile
+        :type profile: cProfile.Profile
+        """
+        if key in self.stats:
+            self.stats[key].add(profile)
+        else:
+            self.stats[key] = pstats.Stats(profile)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def get_status(self):
+        """
+        Returns the sampling rate and how many requests have been
+        profiled for each key.
+
+        :rtype: dict
+        """
+        return {'rate': self.rate, 'profiled': dict(self.counts)}
+
+    def get_stats(self, sort='cumulative', limit=30):
+        """
+        Returns the stats for each key as text.
+
+        :keyword sort: The pstats sort key
+        :type sort: string
+        :keyword limit: The number of functions to include
+        :type limit: int
+        :rtype: dict
+        """
+        results = {}
+        for key, stats in self.stats.iteritems():
+            stream = StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort).print_stats(limit)
+            results[key] = {'count': self.counts[key], 'stats': stream.getvalue()}
+        return results
+
+    def dump(self, directory):
+        """
+        Writes the stats for each key to a file in the directory, that can
+        be loaded with pstats or a viewer such as snakeviz.
+
+        :param directory: The directory to write to
+        :type directory: string
+        :returns: The paths of the files written
+        :rtype: list
+        """
+        paths = []
+        for key, stats in self.stats.iteritems():
+            name = re.sub(r'[^\w.-]+', '_', key).strip('_') or 'root'
+            path = os.path.join(directory, 'corkscrew-%s.prof' % name)
+            stats.dump_stats(path)
+            paths.append(path)
+        return paths
+
+# The profiler shared by the resources
+profiler = RequestProfiler()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/scheduler.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from collections import deque
+
+# The priority classes methods can be exported with, calls the user is
+# waiting on should be interactive and long running background work
+# bulk.
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_BULK = 'bulk'
+
+# The share of the calls started while they are all waiting that each
+# class gets.
+DEFAULT_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 8,
+    PRIORITY_NORMAL: 4,
+    PRIORITY_BULK: 1
+}
+
+class PriorityClass(object):
+    """
+    The calls waiting in one priority class, queued separately for each
+    session.
+    """
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.sessions = {}
+        self.order = deque()
+        self.queued = 0
+        self.started = 0
+        self.vtime = 0.0
+
+    def push(self, call, session):
+        if session not in self.sessions:
+            self.sessions[session] = deque()
+            self.order.append(session)
+        self.sessions[session].append(call)
+        self.queued += 1
+
+    def pop(self, can_run):
+        # Take turns between the sessions, moving the session a call is
+        # started for to the back of the line.
+        for session in self.order:
+            calls = self.sessions[session]
+            for call in calls:
+                if not can_run(call[1]):
+                    continue
+                calls.remove(call)
+                self.order.remove(session)
+                if calls:
+                    self.order.append(session)
+                else:
+                    del self.sessions[session]
+                self.queued -= 1
+                self.started += 1
+                return call
+
+    def remove(self, d):
+        for session in self.order:
+            calls = self.sessions[session]
+            for call in calls:
+                if call[0] is not d:
+                    continue
+                calls.remove(call)
+                if not calls:
+                    self.order.remove(session)
+                    del self.sessions[session]
+                self.queued -= 1
+                return True
+        return False
+
+class FairScheduler(object):
+    """
+    A queue for the `ConcurrencyLimiter` that shares the calls started
+    between priority classes by their weights, using weighted fair
+    queuing: each class has a virtual time that advances by the inverse
+    of its weight for every call started from it, and the next call comes
+    from the class furthest behind. So with the default weights, while
+    every class has calls waiting, 8 interactive calls are started for
+    every bulk call, yet bulk calls are never starved.
+
+    Within a class, the sessions with calls waiting take turns, so a
+    single client queueing many calls can't hold up everyone else's.
+    """
+
+    def __init__(self, weights=None):
+        """
+        :keyword weights: The weight of each priority class, the defaults
+            if not specified
+        :type weights: dict
+        """
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+        self.classes = {}
+        self.vtime = 0.0
+
+    def __len__(self):
+        return sum([c.queued for c in self.classes.itervalues()])
+
+    def push(self, call, priority=None, session=None):
+        """
+        Adds a call to the queue.
+
+        :param call: The call
+        :type call: tuple
+        :keyword priority: The priority class of the call, normal if not
+            specified
+        :type priority: string
+        :keyword session: The session making the call
+        :type session: string
+        """
+        priority = priority or PRIORITY_NORMAL
+        pclass = self.classes.get(priority)
+        if pclass is None:
+            pclass = PriorityClass(priority, self.weights.get(priority, 1))
+            self.classes[priority] = pclass
+
+        # A class that has been idle doesn't get to make up for lost time.
+        if not pclass.queued:
+            pclass.vtime = max(pclass.vtime, self.vtime)
+        pclass.push(call, session)
+
+    def pop(self, can_run):
+        """
+        Removes and returns the next call that can run.
+
+        :param can_run: Checks if a call for a key can run
+        :type can_run: function
+        :returns: The call, or None if none can run
+        :rtype: tuple
+        """
+        waiting = [c for c in self.classes.itervalues() if c.queued]
+        waiting.sort(key=lambda c: (c.vtime, -c.weight))
+        for pclass in waiting:
+            call = pclass.pop(can_run)
+            if call is None:
+                continue
+            self.vtime = pclass.vtime
+            pclass.vtime += 1.0 / pclass.weight
+            return call
+
+    def remove(self, d):
+        """
+        Removes the call with the specified Deferred from the queue.
+
+        :param d: The call's Deferred
+        :type d: twisted.internet.defer.Deferred
+        """
+        for pclass in self.classes.itervalues():
+            if pclass.remove(d):
+                break
+
+    def get_stats(self):
+        """
+        Returns the number of calls waiting and started for each priority
+        class.
+
+        :rtype: dict
+        """
+        return dict([(c.name, {'queued': c.queued, 'started': c.started})
+            for c in self.classes.itervalues()])
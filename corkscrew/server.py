@@ -21,27 +21,208 @@
 #
 
 import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
 import fnmatch
+import gettext
+import hashlib
 import logging
 import mimetypes
 
-from twisted.internet import reactor, defer, error
+from twisted.internet import reactor, defer, error, protocol
 from twisted.web import http, resource, server, static
 
-from corkscrew.common import Template, compress, get_version, windows_check
+from corkscrew.accesslog import AccessLog
+from corkscrew.common import (Template, compress, compress_async,
+    compress_failed, get_version, windows_check)
+from corkscrew.events import EventManager
+from corkscrew.eventsource import EventSource
 from corkscrew.jsonrpc import JsonRpc
+from corkscrew.metrics import (MetricsResource, REQUESTS, REQUEST_BYTES,
+    RESPONSE_BYTES)
+from corkscrew.profiler import profiler
 
 log = logging.getLogger(__name__)
 
+# The environment variable used to pass a listening socket to a worker or
+# replacement server process.
+LISTEN_FD_ENV = 'CORKSCREW_LISTEN_FD'
+
+# The environment variable used to pass a replacement server process the
+# pipe it reports being ready to take over on.
+READY_FD_ENV = 'CORKSCREW_READY_FD'
+
+def get_mtime(path):
+    """
+    Returns the modification time of a file, or None if it doesn't exist.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def parse_accept_language(header):
+    """
+    Returns the languages in an Accept-Language header, most preferred
+    first.
+
+    :param header: The header
+    :type header: string
+    :returns: The languages, such as `en_GB`
+    :rtype: list
+    """
+    languages = []
+    for i, part in enumerate((header or '').split(',')):
+        params = part.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if params[0] and params[0] != '*' and quality > 0:
+            languages.append((-quality, i, params[0]))
+    return [language for quality, i, language in sorted(languages)]
+
+def normalise_locale(locale):
+    """
+    Returns a language tag such as `en-gb` in the form locales are named
+    in catalog directories, `en_GB`.
+    """
+    language, _, territory = locale.strip().replace('-', '_').partition('_')
+    if territory:
+        return '%s_%s' % (language.lower(), territory.upper())
+    return language.lower()
+
 class GetText(resource.Resource):
+    """
+    Serves the gettext.js template rendered with the translations for the
+    client's locale, chosen by the `locale` query argument or else by the
+    Accept-Language header.
+
+    Each locale is rendered and compressed once and kept, along with an
+    ETag, until the template or the locale's catalog changes, so most page
+    loads are answered from memory or with a 304.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, locales=None, domain='messages'):
+        """
+        :param path: The path to the template
+        :type path: string
+        :keyword locales: The directory of the translation catalogs, laid
+            out as `<locale>/LC_MESSAGES/<domain>.mo`
+        :type locales: string
+        :keyword domain: The name of the catalogs
+        :type domain: string
+        """
+        resource.Resource.__init__(self)
         self.path = path
+        self.locales = locales
+        self.domain = domain
+        self.template = None
+        self.template_mtime = None
+        self.catalogs = {}
+        self.catalogs_mtime = None
+        self.cache = {}
+
+    def get_catalogs(self):
+        """
+        Returns the paths of the catalogs of each locale there are
+        translations for. The directory is only looked through again once
+        it has changed, such as when a locale is added.
+
+        :rtype: dict
+        """
+        if not self.locales:
+            return {}
+
+        mtime = get_mtime(self.locales)
+        if mtime != self.catalogs_mtime:
+            self.catalogs = {}
+            for locale in (os.listdir(self.locales) if mtime else []):
+                catalog = os.path.join(self.locales, locale, 'LC_MESSAGES',
+                    self.domain + '.mo')
+                if os.path.isfile(catalog):
+                    self.catalogs[locale] = catalog
+            self.catalogs_mtime = mtime
+        return self.catalogs
+
+    def get_locale(self, request):
+        """
+        Returns the locale to render the template for, None if there are
+        no translations for any of the client's locales.
+
+        :param request: The request
+        :type request: twisted.web.http.Request
+        :rtype: string
+        """
+        catalogs = self.get_catalogs()
+        if not catalogs:
+            return None
+
+        if 'locale' in request.args:
+            wanted = request.args['locale'][-1:]
+        else:
+            wanted = parse_accept_language(
+                request.getHeader('accept-language'))
+
+        for locale in wanted:
+            locale = normalise_locale(locale)
+            if locale in catalogs:
+                return locale
+            language = locale.partition('_')[0]
+            if language in catalogs:
+                return language
+        return None
+
+    def render_locale(self, locale, catalog):
+        """
+        Renders and compresses the template for a locale.
+
+        :returns: The compressed script, its length uncompressed and its
+            ETag
+        :rtype: tuple
+        """
+        mtime = get_mtime(self.path)
+        if self.template is None or mtime != self.template_mtime:
+            self.template = Template(filename=self.path)
+            self.template_mtime = mtime
+
+        data = {}
+        if catalog:
+            translations = gettext.GNUTranslations(open(catalog, 'rb'))
+            data['_'] = lambda text: translations.ugettext(
+                text.decode('utf-8'))
+        rendered = self.template.render(**data)
+        etag = '"%s"' % hashlib.md5(rendered).hexdigest()
+        return compress(rendered), len(rendered), etag
 
     def render(self, request):
+        locale = self.get_locale(request)
+        catalog = self.catalogs.get(locale)
+        mtimes = (get_mtime(self.path), catalog and get_mtime(catalog))
+
+        cached = self.cache.get(locale)
+        if cached is None or cached[0] != mtimes:
+            log.debug('rendering gettext.js for locale: %s', locale)
+            cached = (mtimes,) + self.render_locale(locale, catalog)
+            self.cache[locale] = cached
+        mtimes, contents, length, etag = cached
+
         request.setHeader('content-type', 'text/javascript; encoding=utf-8')
-        template = Template(filename=self.path)
-        return compress(template.render(), request)
+        request.setHeader('vary', 'accept-language')
+        request.setHeader('cache-control', 'no-cache')
+        if request.setETag(etag) is http.CACHED:
+            return ''
+        request.setHeader('content-encoding', 'gzip')
+        request.uncompressed_length = length
+        return contents
 
 class StaticResources(resource.Resource):
 
@@ -204,6 +385,20 @@ class StaticResources(resource.Resource):
         return self
 
     def render(self, request):
+        if profiler.sample():
+            profile, result = profiler.runcall(self.render_file, request)
+            # Only paths that matched a file are keyed on, so that requests
+            # for missing ones can't grow the stats.
+            if result is server.NOT_DONE_YET:
+                profiler.add(request.path, profile)
+            return result
+        return self.render_file(request)
+
+    def render_file(self, request):
+        """
+        Finds the file for the requested path and sends its compressed
+        contents, large files being compressed in a thread.
+        """
         log.debug('requested path: %s', request.lookup_path)
 
         for type in ('dev', 'debug', 'normal'):
@@ -229,19 +424,32 @@ class StaticResources(resource.Resource):
                 mime_type = mimetypes.guess_type(path)
                 log.debug('setting mime-type to: %s', mime_type[0])
                 request.setHeader('content-type', mime_type[0])
-                return compress(open(path, 'rb').read(), request)
+                d = compress_async(open(path, 'rb').read(), request)
+                d.addCallbacks(self._send_file, compress_failed,
+                    callbackArgs=(request,), errbackArgs=(request,))
+                return server.NOT_DONE_YET
         
         request.setResponseCode(http.NOT_FOUND)
         return '<h1>404 - Not Found</h1>'
 
+    def _send_file(self, contents, request):
+        if request._disconnected:
+            return
+        request.setHeader('content-length', str(len(contents)))
+        request.write(contents)
+        request.finish()
+
 class TopLevelBase(resource.Resource):
 
-    addSlash = True
-    auth     = False
-    base     = None
-    dev_mode = False
-    jsonrpc  = None
-    json_cls = None
+    addSlash    = True
+    auth        = False
+    base        = None
+    dev_mode    = False
+    jsonrpc     = None
+    json_cls    = None
+    eventsource = None
+    events_cls  = None
+    metrics     = None
 
     def __init__(self):
         resource.Resource.__init__(self)
@@ -254,6 +462,20 @@ class TopLevelBase(resource.Resource):
             self.json = json_cls(self.auth)
             self.putChild(self.jsonrpc, self.json)
 
+        # Add an event stream resource if required, sharing the session
+        # cookie with the JSON resource.
+        if self.eventsource:
+            events_cls = EventManager if self.events_cls is None else self.events_cls
+            self.events = events_cls()
+            auth = self.json.auth if self.jsonrpc else None
+            if auth:
+                auth.config['cookie_path'] = '/'
+            self.putChild(self.eventsource, EventSource(self.events, auth))
+
+        # Add a resource exposing the server's metrics if required
+        if self.metrics:
+            self.putChild(self.metrics, MetricsResource())
+
     def getChild(self, path, request):
         if path == '':
             return self
@@ -303,6 +525,11 @@ class ExtJSTopLevel(TopLevelBase):
     public    = ''
     templates = ''
 
+    # The directory of the translation catalogs gettext.js is rendered
+    # with, laid out as <locale>/LC_MESSAGES/<locale_domain>.mo.
+    locales       = None
+    locale_domain = 'messages'
+
     @property
     def css(self):
         return self.__css
@@ -345,7 +572,8 @@ class ExtJSTopLevel(TopLevelBase):
 
         gettext = os.path.join(self.templates, 'gettext.js')
         if os.path.exists(gettext):
-            self.putChild('gettext.js', GetText(gettext))
+            self.putChild('gettext.js', GetText(gettext, self.locales,
+                self.locale_domain))
 
         self.putChild('icons', self.__icons)
         self.putChild('images', self.__images)
@@ -374,14 +602,171 @@ class ExtJSTopLevel(TopLevelBase):
             js_config   = js_config
         ), request)
 
+class CorkscrewRequest(server.Request):
+    """
+    A request that registers itself with the site while it is in flight.
+    """
+
+    def process(self):
+        # Over HTTP/2 the channel is a single stream with no transport of
+        # its own, the connection's transport is the one to close when
+        # draining, and only once every stream on it has completed.
+        self.connection = self.transport
+        if self.connection is None and hasattr(self.channel, '_conn'):
+            self.connection = self.channel._conn.transport
+
+        site = self.channel.site
+        site.in_flight.add(self)
+        self.notifyFinish().addBoth(site._request_done, self)
+        self.resource_name = None
+        self.started = time.time()
+        self.timings = {}
+        server.Request.process(self)
+
+    def render(self, resrc):
+        # Remember which resource served the request for the metrics
+        self.resource_name = resrc.__class__.__name__
+        server.Request.render(self, resrc)
+
+class CorkscrewSite(server.Site):
+    """
+    A site that keeps track of the requests in flight so that it can wait
+    for them to complete before the server shuts down.
+    """
+
+    requestFactory = CorkscrewRequest
+
+    # The `AccessLog` completed requests are written to, if any
+    access_log = None
+
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.in_flight = set()
+        self.closing = set()
+        self.drained = None
+
+    def drain(self, timeout):
+        """
+        Waits for the requests in flight to complete. Streaming requests,
+        which are never complete, are finished straight away.
+
+        :param timeout: The most seconds to wait
+        :type timeout: int
+        :returns: A Deferred that fires with True once all the requests
+            have completed or False if some were still running at the
+            timeout
+        :rtype: twisted.internet.defer.Deferred
+        """
+        for request in list(self.in_flight):
+            if getattr(request, 'streaming', False):
+                if request.producer:
+                    request.unregisterProducer()
+                request.finish()
+
+        if not self.in_flight:
+            return defer.succeed(True)
+
+        log.info('Waiting for %d requests to complete', len(self.in_flight))
+        self.drained = defer.Deferred()
+        call = reactor.callLater(timeout, self._drain_timeout)
+        self.drained.addBoth(self._drain_done, call)
+        return self.drained
+
+    def _drain_timeout(self):
+        log.warning('Gave up waiting for %d requests', len(self.in_flight))
+        drained, self.drained = self.drained, None
+        drained.callback(False)
+
+    def _drain_done(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def _request_done(self, result, request):
+        self.in_flight.discard(request)
+        if request.resource_name:
+            labels = (request.resource_name,)
+            REQUESTS.inc(labels)
+            REQUEST_BYTES.inc(labels,
+                int(request.getHeader('content-length') or 0))
+            RESPONSE_BYTES.inc(labels, request.sentLength)
+        if self.access_log:
+            self.access_log.log(request)
+        if not self.drained:
+            return
+
+        # The response may still be sitting in the transport's buffer, so
+        # the drain isn't over until the connection has been closed.
+        if request.connection is not None:
+            self.closing.add(request.connection)
+        if not self.in_flight:
+            for transport in self.closing:
+                transport.loseConnection()
+            self._check_closed()
+
+    def _check_closed(self):
+        if not self.drained:
+            return
+        self.closing = set([t for t in self.closing if t.connected])
+        if self.closing:
+            reactor.callLater(0.01, self._check_closed)
+        else:
+            drained, self.drained = self.drained, None
+            drained.callback(True)
+
+class ReplacementProtocol(protocol.ProcessProtocol):
+    """
+    Watches a replacement server process started by a reload, stopping
+    this server once the replacement reports that it is ready.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.ready = False
+
+    def childDataReceived(self, fd, data):
+        if fd == 4 and 'ready' in data and not self.ready:
+            self.ready = True
+            log.info('Replacement server %d is ready, shutting down',
+                self.transport.pid)
+            reactor.stop()
+
+    def processEnded(self, reason):
+        if not self.ready:
+            log.error('Replacement server exited before it was ready: %s',
+                reason.getErrorMessage())
+            self.server.reloading = False
+
 class CorkscrewServer(object):
+
+    # The number of seconds a worker has to stay up for its exit to be
+    # treated as a crash rather than a failure to start, which is retried
+    # after a pause so a broken worker doesn't fork in a tight loop.
+    worker_min_uptime = 1
+
+    # The most seconds to wait for requests in flight to complete when
+    # shutting down.
+    drain_timeout = 30
+
+    # The file to write the structured access log to, None for no access
+    # log. See `corkscrew.accesslog.AccessLog`.
+    access_log = None
     
-    def __init__(self, top_level, port=8080, https=False):
+    def __init__(self, top_level, port=8080, https=False, workers=0,
+                 ssl_cert=None, ssl_key=None, http2=False):
         self.socket = None
         self.top_level = top_level
-        self.site = server.Site(self.top_level)
+        self.site = CorkscrewSite(self.top_level)
+        if self.access_log:
+            self.site.access_log = AccessLog(self.access_log)
+        self.reloading = False
         self.port = port
         self.https = https
+        self.ssl_cert = ssl_cert
+        self.ssl_key = ssl_key
+        self.http2 = http2
+        self.context_factory = None
+        self.workers = workers
         self.base = '/'
         CorkscrewServer.instance = self
 
@@ -405,31 +790,304 @@ class CorkscrewServer(object):
 
     def start(self, start_reactor=True):
         log.info('%s %s.', 'Starting server in PID', os.getpid())
-        if self.https:
+        if LISTEN_FD_ENV not in os.environ and self.workers:
+            return self.start_workers()
+
+        if LISTEN_FD_ENV in os.environ:
+            self.start_worker(int(os.environ.pop(LISTEN_FD_ENV)))
+        elif self.https:
             self.start_ssl()
         else:
             self.start_normal()
 
+        reactor.addSystemEventTrigger('before', 'shutdown', self.drain)
+        if self.site.access_log:
+            self.site.access_log.start()
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                self.site.access_log.stop)
+        if READY_FD_ENV in os.environ:
+            reactor.callWhenRunning(self._notify_ready,
+                int(os.environ.pop(READY_FD_ENV)))
+
+        # Workers are restarted by their supervisor, a lone server reloads
+        # itself.
+        if not self.workers and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP,
+                lambda signum, frame: reactor.callFromThread(self.reload))
+
         if start_reactor:
             reactor.run()
+
+    def start_workers(self):
+        """
+        Binds the listening socket and starts the worker processes that
+        share it, then supervises them until told to stop. Crashed workers
+        are replaced, SIGTERM and SIGINT are passed on to the workers and
+        SIGHUP restarts them one at a time.
+
+        Workers are started by running the program again with the
+        listening socket passed down, as the reactor can't be used in a
+        forked copy of the process that imported it.
+        """
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(('', self.port))
+        self.listen_socket.listen(socket.SOMAXCONN)
+        self.listen_socket.setblocking(False)
+        if hasattr(os, 'set_inheritable'):
+            os.set_inheritable(self.listen_socket.fileno(), True)
+        log.info('serving on %s:%s with %d workers', '0.0.0.0', self.port,
+            self.workers)
+
+        self.children = {}
+        self.stopping = False
+        self.restarting = []
+        self.retiring = None
+        self.replacing = None
+
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        signal.signal(signal.SIGHUP, self._on_restart_signal)
+
+        for i in range(self.workers):
+            self._spawn_worker()
+
+        while self.children:
+            self._rotate_workers()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if not pid:
+                try:
+                    time.sleep(0.5)
+                except (IOError, OSError):
+                    pass
+                continue
+
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+
+            if pid == self.retiring:
+                log.info('worker %d has stopped', pid)
+                self.retiring = None
+                continue
+
+            if self.replacing and pid == self.replacing[0]:
+                # The worker being replaced is still serving, so leave it
+                # be rather than starting another.
+                log.error('worker %d exited before it was ready, not '
+                    'restarting the rest', pid)
+                os.close(self.replacing[1])
+                self.replacing = None
+                self.restarting = []
+                continue
+
+            if self.stopping:
+                continue
+
+            log.warning('worker %d exited with status %d, restarting', pid,
+                status)
+            if time.time() - started < self.worker_min_uptime:
+                time.sleep(self.worker_min_uptime)
+            self._spawn_worker()
+
+        self.listen_socket.close()
+        log.info('all workers have stopped')
+
+    def _spawn_worker(self, ready_fd=None):
+        pid = os.fork()
+        if pid:
+            log.info('started worker %d', pid)
+            self.children[pid] = time.time()
+            return pid
+
+        # This is the worker process, it must never return into the
+        # supervisor's loop.
+        try:
+            os.environ[LISTEN_FD_ENV] = str(self.listen_socket.fileno())
+            if ready_fd is not None:
+                os.environ[READY_FD_ENV] = str(ready_fd)
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except:
+            log.exception('worker %d failed to start', os.getpid())
+        os._exit(1)
+
+    def start_worker(self, fd):
+        """
+        Starts serving a listening socket inherited from the parent
+        process.
+
+        :param fd: The file descriptor of the listening socket
+        :type fd: int
+        """
+        factory = self.site
+        if self.https:
+            from twisted.protocols.tls import TLSMemoryBIOFactory
+            factory = TLSMemoryBIOFactory(self.get_context_factory(), False,
+                self.site)
+        self.socket = reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+        os.close(fd)
+        log.info('serving on %s:%s in worker %d', '0.0.0.0', self.port,
+            os.getpid())
+
+    def _rotate_workers(self):
+        # Workers are restarted one at a time, the old worker is only
+        # stopped once its replacement reports that it is ready on a pipe,
+        # in the same way as a reload, so there is always one serving.
+        if self.stopping or self.retiring:
+            return
+        if self.replacing:
+            return self._check_replacement()
+        if not self.restarting:
+            return
+        pid = self.restarting.pop(0)
+        if pid not in self.children:
+            return
+        read_fd, write_fd = os.pipe()
+        if hasattr(os, 'set_inheritable'):
+            os.set_inheritable(write_fd, True)
+        replacement = self._spawn_worker(write_fd)
+        os.close(write_fd)
+        self.replacing = (replacement, read_fd, pid)
+
+    def _check_replacement(self):
+        replacement, read_fd, pid = self.replacing
+        if not select.select([read_fd], [], [], 0)[0]:
+            return
+        data = os.read(read_fd, 64)
+        os.close(read_fd)
+        self.replacing = None
+        if 'ready' in data:
+            log.info('worker %d is ready, stopping worker %d', replacement,
+                pid)
+            self.retiring = pid
+        else:
+            # The pipe was closed without a word, so the replacement is
+            # going away and the old worker is kept.
+            log.error('worker %d exited before it was ready, not '
+                'restarting the rest', replacement)
+            self.retiring = replacement
+            self.restarting = []
+        try:
+            os.kill(self.retiring, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _on_stop_signal(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _on_restart_signal(self, signum, frame):
+        self.restarting = [p for p in self.children if p != self.retiring]
     
     def start_normal(self):
+        if self.http2:
+            log.warning('HTTP/2 is only served over https')
         self.socket = reactor.listenTCP(self.port, self.site)
         log.info('serving on %s:%s view at http://127.0.0.1:%s', '0.0.0.0',
             self.port, self.port)
 
+    def get_context_factory(self):
+        """
+        Returns the context factory shared by the TLS connections, making
+        it the first time.
+        """
+        if self.context_factory is None:
+            from corkscrew.tls import ServerContextFactory
+            self.context_factory = ServerContextFactory(self.ssl_cert,
+                self.ssl_key, self.get_protocols())
+            self.context_factory.start_watching()
+        return self.context_factory
+
+    def get_protocols(self):
+        """
+        Returns the protocols offered to clients with ALPN on the TLS
+        listener, in order of preference. HTTP/2 is only offered when it
+        has been enabled and the h2 library is installed.
+
+        HTTP/2 over plain connections (h2c) isn't supported by Twisted, so
+        browsers, which only use HTTP/2 over TLS anyway, will need https
+        enabled to make use of it.
+        """
+        if not self.http2:
+            return []
+        if not http.H2_ENABLED:
+            log.warning('HTTP/2 requires the h2 library, only serving '
+                'HTTP/1.1')
+            return []
+        return [b'h2', b'http/1.1']
+
     def start_ssl(self):
-        check_ssl_keys()
-        self.socket = reactor.listenSSL(self.port, self.site, ServerContextFactory())
+        self.socket = reactor.listenSSL(self.port, self.site,
+            self.get_context_factory())
         log.info('serving on %s:%s view at https://127.0.0.1:%s', '0.0.0.0',
             self.port, self.port)
 
+    def warm_up(self):
+        """
+        Called before a replacement server started by a reload takes
+        over, so that subclasses can fill caches first rather than have
+        the first requests do it. It may return a Deferred. By default this
+        does nothing.
+        """
+
+    def _notify_ready(self, fd):
+        def notify(result):
+            os.write(fd, 'ready\n')
+            os.close(fd)
+        defer.maybeDeferred(self.warm_up).addBoth(notify)
+
+    def reload(self):
+        """
+        Starts a replacement server process, handing it the listening
+        socket. Both serve requests until the replacement reports that it
+        is ready, then this server drains and shuts down.
+        """
+        if self.reloading or not self.socket:
+            return
+        self.reloading = True
+        log.info('Reloading, starting a replacement server')
+
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = '3'
+        env[READY_FD_ENV] = '4'
+        reactor.spawnProcess(ReplacementProtocol(self), sys.executable,
+            [sys.executable] + sys.argv, env=env,
+            childFDs={0: 0, 1: 1, 2: 2, 3: self.socket.fileno(), 4: 'r'})
+
+    def drain(self):
+        """
+        Stops accepting connections and waits for the requests in flight
+        to complete, for up to `drain_timeout` seconds.
+        """
+        if self.reloading and self.socket:
+            # The replacement is serving the same socket, stopping listening
+            # would shut it down for both, so only stop accepting on it.
+            self.socket.stopReading()
+            self.socket = None
+            d = defer.succeed(None)
+        elif self.socket:
+            d = self.stop()
+        else:
+            d = defer.succeed(None)
+        d.addCallback(lambda result: self.site.drain(self.drain_timeout))
+        return d
+
     def stop(self):
         log.info('Shutting down webserver')
         log.debug('Saving configuration file')
 
         if self.socket:
-            d = self.socket.stopListening()
+            d = defer.maybeDeferred(self.socket.stopListening)
             self.socket = None
         else:
             d = defer.Deferred()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/stats.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import time
+
+class Histogram(object):
+    """
+    Counts values in buckets that grow with the size of the value, in the
+    manner of an HdrHistogram. Values below 2 ** precision get a bucket
+    each, above that every power of two is split into 2 ** precision
+    buckets, so a value is reported to within 1 / 2 ** precision of what
+    was recorded however large it is, while recording is only a dict
+    update.
+    """
+
+    def __init__(self, precision=5):
+        """
+        :keyword precision: The number of significant bits kept of each
+            value
+        :type precision: int
+        """
+        self.precision = precision
+        self.sub_buckets = 1 << precision
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all the recorded values.
+        """
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        """
+        Records a value.
+
+        :param value: The value, a positive integer
+        :type value: int
+        """
+        if value < self.sub_buckets:
+            index = value
+        else:
+            shift = value.bit_length() - self.precision - 1
+            index = ((shift + 1) << self.precision) + \
+                (value >> shift) - self.sub_buckets
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        """
+        Returns the highest value that is counted in a bucket.
+
+        :param index: The bucket
+        :type index: int
+        :rtype: int
+        """
+        if index < self.sub_buckets:
+            return index
+        shift = (index >> self.precision) - 1
+        top = (index & (self.sub_buckets - 1)) + self.sub_buckets
+        return ((top + 1) << shift) - 1
+
+    def percentiles(self, *percentiles):
+        """
+        Returns the values at or below which the specified percentages of
+        the recorded values fall.
+
+        :returns: A value for each percentile
+        :rtype: list
+        """
+        results = []
+        if not self.count:
+            return [0 for p in percentiles]
+
+        indexes = sorted(self.counts)
+        for percentile in percentiles:
+            target = self.count * percentile / 100.0
+            seen = 0
+            for index in indexes:
+                seen += self.counts[index]
+                if seen >= target:
+                    break
+            results.append(min(self.bucket_value(index), self.max))
+        return results
+
+class MethodStats(object):
+    """
+    The number of calls made to a method, how many failed, how many are
+    running and how long they took.
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def reset(self):
+        self.latency.reset()
+        self.calls = 0
+        self.errors = 0
+
+    def to_dict(self):
+        """
+        Returns the stats with the latencies in milliseconds.
+
+        :rtype: dict
+        """
+        latency = self.latency
+        p50, p90, p99, p999 = latency.percentiles(50, 90, 99, 99.9)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'mean': latency.total / 1000.0 / latency.count if latency.count else 0,
+            'min': (latency.min or 0) / 1000.0,
+            'max': latency.max / 1000.0,
+            'p50': p50 / 1000.0,
+            'p90': p90 / 1000.0,
+            'p99': p99 / 1000.0,
+            'p999': p999 / 1000.0
+        }
+
+class CallStats(object):
+    """
+    Keeps the `MethodStats` for every method called.
+    """
+
+    def __init__(self):
+        self.methods = {}
+        self.since = time.time()
+
+    def start(self, method):
+        """
+        Records that a call to a method has started.
+
+        :param method: The method name
+        :type method: string
+        :returns: The time the call started, to be passed to finish
+        :rtype: float
+        """
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        stats.in_flight += 1
+        return time.time()
+
+    def finish(self, method, started, error=False):
+        """
+        Records that a call to a method has completed.
+
+        :param method: The method name
+        :type method: string
+        :param started: The time the call started
+        :type started: float
+        :keyword error: Whether the call failed
+        :type error: bool
+        """
+        stats = self.methods[method]
+        stats.in_flight -= 1
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+        stats.latency.record(int((time.time() - started) * 1000000))
+
+    def reset(self):
+        """
+        Clears the stats, other than the calls still running.
+        """
+        for stats in self.methods.itervalues():
+            stats.reset()
+        self.since = time.time()
+
+    def get_stats(self):
+        """
+        Returns the stats for each method, with latencies in milliseconds.
+
+        :rtype: dict
+        """
+        return dict([(method, stats.to_dict())
+            for method, stats in self.methods.iteritems()])
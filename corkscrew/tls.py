@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# corkscrew/tls.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import logging
+
+from OpenSSL import SSL
+from twisted.internet.task import LoopingCall
+
+from corkscrew.errors import TLSError
+
+log = logging.getLogger(__name__)
+
+def check_ssl_keys(cert, key):
+    """
+    Checks that the certificate and private key for the TLS listener
+    exist.
+
+    :param cert: The path to the certificate file
+    :type cert: string
+    :param key: The path to the private key file
+    :type key: string
+    :raises: TLSError
+    """
+    if not cert or not key:
+        raise TLSError('A certificate and private key are required for https')
+    for path in (cert, key):
+        if not os.path.isfile(path):
+            raise TLSError('Unable to find %s' % path)
+
+class ServerContextFactory(object):
+    """
+    Provides the TLS listener with a single SSL context that is shared by
+    every connection, so that the certificate is loaded once and returning
+    clients can resume their sessions, either from the context's session
+    cache or with a session ticket, rather than make a full handshake.
+
+    The certificate and key files are checked for changes every
+    `reload_interval` seconds and a new context is made when they do,
+    which is used for new connections. Each process has its own cache and
+    ticket keys, so with several workers a session is only resumed when
+    the client reaches the same worker again.
+
+    When given a list of protocols the context negotiates one of them with
+    the client using ALPN, preferring those earlier in the list.
+    """
+
+    # The number of seconds a session can be resumed for
+    session_timeout = 3600
+
+    # The number of seconds between checks for a changed certificate
+    reload_interval = 60
+
+    def __init__(self, cert, key, protocols=None):
+        check_ssl_keys(cert, key)
+        self.cert = cert
+        self.key = key
+        self.protocols = protocols or []
+        self._mtimes = self._get_mtimes()
+        self._context = self._make_context()
+        self.watcher = None
+
+    def getContext(self):
+        return self._context
+
+    def start_watching(self):
+        """
+        Starts checking the certificate and key files for changes.
+        """
+        if self.watcher is None and self.reload_interval:
+            self.watcher = LoopingCall(self.reload)
+            self.watcher.start(self.reload_interval, now=False)
+
+    def reload(self):
+        """
+        Makes a new context if the certificate or key files have changed
+        since the current one was made. If the new files can't be loaded
+        the current context is kept.
+
+        :returns: True if the context was replaced
+        :rtype: bool
+        """
+        try:
+            mtimes = self._get_mtimes()
+        except OSError as e:
+            log.error('Unable to check the certificate for changes: %s', e)
+            return False
+        if mtimes == self._mtimes:
+            return False
+
+        try:
+            context = self._make_context()
+        except (SSL.Error, TLSError) as e:
+            log.error('Unable to load the new certificate, keeping the old '
+                'one: %s', e)
+            return False
+
+        log.info('Loaded the new certificate from %s', self.cert)
+        self._mtimes = mtimes
+        self._context = context
+        return True
+
+    def _get_mtimes(self):
+        return (os.stat(self.cert).st_mtime, os.stat(self.key).st_mtime)
+
+    def _make_context(self):
+        context = SSL.Context(SSL.SSLv23_METHOD)
+        context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3 |
+            SSL.OP_NO_COMPRESSION)
+        context.use_certificate_chain_file(self.cert)
+        context.use_privatekey_file(self.key)
+        context.check_privatekey()
+
+        context.set_session_id('corkscrew')
+        context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        context.set_timeout(self.session_timeout)
+
+        if self.protocols:
+            context.set_alpn_select_callback(self._select_protocol)
+        return context
+
+    def _select_protocol(self, connection, offered):
+        for protocol in self.protocols:
+            if protocol in offered:
+                return protocol
+        # Carry on without a protocol, the connection will be treated as
+        # HTTP/1.1.
+        return getattr(SSL, 'NO_OVERLAPPING_PROTOCOLS', b'')
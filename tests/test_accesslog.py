@@ -0,0 +1,78 @@
+#
+# tests/test_accesslog.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import json
+
+from twisted.trial import unittest
+
+from corkscrew.accesslog import AccessLog
+
+class Request(object):
+
+    method = 'GET'
+    code = 200
+    sentLength = 10
+
+    def __init__(self, path):
+        self.path = path
+
+    def getCookie(self, name):
+        return None
+
+    def getClientIP(self):
+        return '127.0.0.1'
+
+    def getHeader(self, name):
+        return None
+
+class AccessLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.abspath(self.mktemp())
+        self.access_log = AccessLog(self.path)
+        self.access_log.start()
+        self.addCleanup(self.access_log.stop)
+
+    def read(self):
+        self.access_log.stop()
+        return [json.loads(line) for line in open(self.path)]
+
+    def test_records_written(self):
+        self.access_log.log(Request('/json'))
+        records = self.read()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['path'], '/json')
+        self.assertEqual(records[0]['status'], 200)
+
+    def test_undecodable_path(self):
+        # Paths aren't percent-decoded, so a raw byte that isn't UTF-8 can
+        # arrive in one and must neither be lost nor stop the writer.
+        self.access_log.log(Request('/\xff\xfe'))
+        self.access_log.log(Request('/json'))
+        records = self.read()
+        self.assertEqual([r['path'] for r in records], [u'/\xff\xfe', '/json'])
+
+    def test_unencodable_record_skipped(self):
+        self.access_log.queue.put({'path': object()})
+        self.access_log.log(Request('/json'))
+        self.assertEqual([r['path'] for r in self.read()], ['/json'])
@@ -0,0 +1,116 @@
+#
+# tests/test_bus.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+from corkscrew.bus import BusEventManager, EventBus
+from corkscrew.events import EventManager
+
+class Manager(EventManager):
+    listener_timeout = None
+
+class BusManager(BusEventManager):
+    listener_timeout = None
+
+@defer.inlineCallbacks
+def wait_for(check, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if check():
+            return
+        yield deferLater(reactor, 0.01, lambda: None)
+    raise AssertionError('timed out waiting')
+
+class EventBusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = EventBus(self.mktemp(), Manager())
+        self.connected = defer.Deferred()
+        connected = self.bus._connected
+        def on_connected(connection):
+            connected(connection)
+            self.connected.callback(None)
+        self.bus._connected = on_connected
+
+    def wait(self):
+        return deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_start_runs_broker(self):
+        self.bus.start()
+        yield self.connected
+        self.assertNotEqual(self.bus.broker, None)
+        self.bus.stop()
+        yield self.wait()
+
+    @defer.inlineCallbacks
+    def test_stop_does_not_restart_broker(self):
+        self.bus.start()
+        yield self.connected
+        factory = self.bus.connector.factory
+        self.bus.stop()
+        self.assertEqual(self.bus.broker, None)
+
+        # Once the socket is free, seeing the connection go mustn't start
+        # the broker again in a process that is shutting down.
+        yield self.wait()
+        factory.clientConnectionLost(None, None)
+        factory.clientConnectionFailed(None, None)
+        self.assertEqual(self.bus.broker, None)
+        self.assertEqual(self.bus.connection, None)
+
+class BusEventManagerTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        path = self.mktemp()
+        self.first = BusManager(path)
+        self.second = BusManager(path)
+        self.addCleanup(self.stop)
+        yield wait_for(lambda: self.first.bus.connection and
+            self.second.bus.connection)
+
+    def stop(self):
+        self.first.bus.stop()
+        self.second.bus.stop()
+        return deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_event_delivered(self):
+        self.first.add_listener('l1', 'added')
+        self.second.add_listener('l2', 'added')
+        self.first.fire_event('added', 'torrent', key='t1')
+
+        self.assertEqual(self.first.get_events('l1'),
+            [('added', ('torrent',))])
+        received = []
+        yield wait_for(lambda: received.extend(
+            self.second.get_events('l2') or []) or received)
+        self.assertEqual(received, [('added', ('torrent',))])
+
+    def test_unencodable_not_fired(self):
+        self.first.add_listener('l1', 'added')
+        self.assertRaises(TypeError, self.first.fire_event, 'added',
+            object())
+        self.assertEqual(self.first.get_events('l1'), None)
+        self.assertEqual(self.first.bus.pending, [])
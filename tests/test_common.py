@@ -0,0 +1,124 @@
+#
+# tests/test_common.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import sys
+import zlib
+import subprocess
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew import common
+from corkscrew.common import Template, compress_async
+from corkscrew.jsonrpc import JsonRpc
+from corkscrew.server import StaticResources
+
+def decompress(contents):
+    return zlib.decompress(contents, zlib.MAX_WBITS + 16)
+
+def failing_gzip(contents):
+    raise MemoryError()
+
+class Request(DummyRequest):
+
+    def __init__(self, postpath):
+        DummyRequest.__init__(self, postpath)
+        self._disconnected = False
+
+class CompressTestCase(unittest.TestCase):
+
+    def test_compress_async(self):
+        contents = 'x' * 1024
+        request = Request([''])
+        d = compress_async(contents, request, threshold=0)
+        d.addCallback(lambda compressed: self.assertEqual(
+            decompress(compressed), contents))
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'), ['gzip'])
+        return d
+
+    def test_compress_async_small(self):
+        d = compress_async('x', threshold=2)
+        self.assertEqual(decompress(self.successResultOf(d)), 'x')
+
+class CompressFailedTestCase(unittest.TestCase):
+    """
+    Checks that a response that can't be compressed is ended with a 500
+    instead of being left open.
+    """
+
+    def setUp(self):
+        self.patch(common, 'gzip', failing_gzip)
+        self.patch(common, 'THREAD_THRESHOLD', 0)
+        self.request = Request([''])
+
+    def assertFailed(self, result):
+        self.assertEqual(self.request.responseCode, 500)
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders('content-encoding'),
+            None)
+
+    def test_jsonrpc(self):
+        self.request.json = {'method': 'test.ok', 'id': 1}
+        response = {'result': 1, 'error': None, 'id': 1}
+        d = JsonRpc().send_response(self.request, response)
+        return d.addCallback(self.assertFailed)
+
+    def test_static(self):
+        path = os.path.abspath(self.mktemp()) + '.js'
+        open(path, 'w').write('var test = 1;')
+        resource = StaticResources()
+        resource.add_file('/test.js', path)
+        self.request.lookup_path = '/test.js'
+        resource.render_file(self.request)
+        d = self.request.notifyFinish()
+        return d.addCallback(self.assertFailed)
+
+class TemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(common, '_version', '1.2.3')
+
+    def test_version_builtin(self):
+        self.assertEqual(str(Template.builtins['version']), '1.2.3')
+        self.assertEqual(Template.builtins['version'], '1.2.3')
+        self.assertEqual(Template.builtins['version'].split('.'),
+            ['1', '2', '3'])
+
+    def test_render(self):
+        template = Template(text=u'${version} ${escape(name)}')
+        self.assertEqual(template.render(name="it's"), "1.2.3 it\\'s")
+
+class ImportTestCase(unittest.TestCase):
+
+    def test_common_imports_cheaply(self):
+        # Workers import corkscrew.common before they need Twisted Web or
+        # Mako, so it mustn't pull them in.
+        script = ('import sys, corkscrew.common; print(" ".join(sorted(set('
+            '[m.split(".")[0] for m in sys.modules]) & '
+            'set(["twisted", "mako", "pkg_resources"]))))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script],
+            env=env)
+        self.assertEqual(output.strip(), '')
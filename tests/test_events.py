@@ -0,0 +1,436 @@
+#
+# tests/test_events.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew import events as events_module
+from corkscrew.events import (EVENTS_DROPPED, OVERFLOW_COALESCE,
+    OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, EventLog, EventManager,
+    TopicTrie, is_pattern)
+
+class Manager(EventManager):
+    listener_timeout = None
+    log_capacity = 4
+
+class FakeTime(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+def fill(log, count, key=None):
+    for i in range(count):
+        seq = log.count
+        log.append((seq, 'progress', (seq,), key), key)
+
+def seqs(entries):
+    return [entry[0] for entry in entries]
+
+class EventLogReadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log = EventLog(4)
+        self.cursor = self.log.add_cursor()
+
+    def test_read_unwrapped(self):
+        fill(self.log, 3)
+        self.assertEqual(self.log.read(self.cursor), (0, [
+            (0, 'progress', (0,), None),
+            (1, 'progress', (1,), None),
+            (2, 'progress', (2,), None)]))
+
+    def test_read_wrapped(self):
+        fill(self.log, 6)
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 2)
+        self.assertEqual(seqs(entries), [2, 3, 4, 5])
+
+    def test_read_wrapped_many_times(self):
+        fill(self.log, 10)
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 6)
+        self.assertEqual(seqs(entries), [6, 7, 8, 9])
+
+    def test_read_superseded_wrapped_many_times(self):
+        fill(self.log, 10, key='t1')
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 0)
+        self.assertEqual(seqs(entries), [9])
+
+    def test_read_mixed_wrapped_many_times(self):
+        # The keyed firings are all superseded, the unkeyed ones
+        # overwritten are missed.
+        for i in range(10):
+            key = 't1' if i % 2 == 0 else None
+            self.log.append((i, 'progress', (i,), key), key)
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 3)
+        self.assertEqual(seqs(entries), [7, 8, 9])
+
+    def test_read_keyed_overwritten_before_superseded(self):
+        self.log.append((0, 'progress', (0,), 't1'), 't1')
+        fill(self.log, 4)
+        self.log.append((5, 'progress', (5,), 't1'), 't1')
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 2)
+        self.assertEqual(seqs(entries), [2, 3, 4, 5])
+
+    def test_keys_scoped_to_event(self):
+        self.log.append((0, 'torrent.progress', (50,), 't1'), 't1')
+        self.log.append((1, 'torrent.state', ('Seeding',), 't1'), 't1')
+        self.log.append((2, 'torrent.state', ('Paused',), 't1'), 't1')
+        self.assertEqual(seqs(self.log.read(self.cursor)[1]), [0, 2])
+
+    def test_keyed_overwritten_across_events(self):
+        for i in range(10):
+            event = 'torrent.progress' if i % 2 else 'torrent.state'
+            self.log.append((i, event, (i,), 't1'), 't1')
+        missed, entries = self.log.read(self.cursor)
+        self.assertEqual(missed, 0)
+        self.assertEqual(seqs(entries), [8, 9])
+        self.assertEqual(len(self.log.keys), 2)
+
+    def test_read_cursors_at_different_positions(self):
+        fill(self.log, 3)
+        later = self.log.add_cursor()
+        for i in range(20):
+            key = 't1' if i % 3 else None
+            seq = self.log.count
+            self.log.append((seq, 'progress', (seq,), key), key)
+        # Of the 20 fired after the later cursor 7 are unkeyed, and only
+        # the last of those is still in the log. The keyed ones are all
+        # superseded before they're overwritten.
+        self.assertEqual(self.log.read(later)[0], 6)
+        self.assertEqual(self.log.read(self.cursor)[0], 9)
+
+    def test_move_cursor(self):
+        fill(self.log, 10)
+        self.log.read(self.cursor)
+        cursor = self.log.move_cursor(self.cursor)
+        self.assertEqual(cursor, 10)
+        self.assertEqual(self.log.read(cursor), (0, []))
+        fill(self.log, 5)
+        self.assertEqual(self.log.read(cursor)[0], 1)
+
+    def test_remove_cursor(self):
+        self.log.remove_cursor(self.cursor)
+        self.assertEqual(self.log.cursors, {})
+
+    def test_grows_lazily(self):
+        self.assertEqual(EventLog(1000).entries, [])
+        fill(self.log, 3)
+        self.assertEqual(len(self.log.entries), 3)
+        fill(self.log, 10)
+        self.assertEqual(len(self.log.entries), 4)
+
+class EventManagerDroppedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = Manager()
+        self.events.add_listener('l1', 'progress')
+
+    def test_superseded_not_dropped(self):
+        for i in range(10):
+            self.events.fire_event('progress', i, key='t1')
+        self.assertEqual(self.events.get_events('l1'), [('progress', (9,))])
+        self.assertEqual(self.events.dropped, 0)
+
+    def test_keys_scoped_to_event(self):
+        self.events.add_listener('l2', 'torrent.*')
+        self.events.fire_event('torrent.progress', 50, key='t1')
+        self.events.fire_event('torrent.state', 'Seeding', key='t1')
+        self.events.fire_event('torrent.progress', 60, key='t1')
+        self.assertEqual(self.events.get_events('l2'), [
+            ('torrent.state', ('Seeding',)), ('torrent.progress', (60,))])
+
+    def test_overwritten_dropped(self):
+        for i in range(10):
+            self.events.fire_event('progress', i)
+        self.assertEqual(self.events.get_events('l1'), [
+            (EVENTS_DROPPED, ('progress', 6)), ('progress', (6,)),
+            ('progress', (7,)), ('progress', (8,)), ('progress', (9,))])
+
+class TopicTrieTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = TopicTrie()
+
+    def assertMatches(self, event, patterns):
+        self.assertEqual(self.trie.match(event), set(patterns))
+
+    def test_is_pattern(self):
+        self.assertTrue(is_pattern('torrent.*'))
+        self.assertTrue(is_pattern('#'))
+        self.assertFalse(is_pattern('torrent.state'))
+        self.assertFalse(is_pattern('torrent.#state'))
+
+    def test_star(self):
+        self.trie.add('torrent.*')
+        self.assertMatches('torrent.added', ['torrent.*'])
+        self.assertMatches('torrent', [])
+        self.assertMatches('torrent.file.added', [])
+        self.assertMatches('session.added', [])
+
+    def test_leading_star(self):
+        self.trie.add('*.state')
+        self.assertMatches('torrent.state', ['*.state'])
+        self.assertMatches('state', [])
+
+    def test_hash(self):
+        self.trie.add('torrent.#')
+        self.assertMatches('torrent', ['torrent.#'])
+        self.assertMatches('torrent.added', ['torrent.#'])
+        self.assertMatches('torrent.file.added', ['torrent.#'])
+        self.assertMatches('session', [])
+
+    def test_hash_in_middle(self):
+        self.trie.add('torrent.#.state')
+        self.assertMatches('torrent.state', ['torrent.#.state'])
+        self.assertMatches('torrent.a.b.state', ['torrent.#.state'])
+        self.assertMatches('torrent.a.b', [])
+
+    def test_hash_and_star(self):
+        self.trie.add('#')
+        self.trie.add('#.*')
+        self.trie.add('torrent.*')
+        self.trie.add('torrent.added')
+        self.assertMatches('torrent.added',
+            ['#', '#.*', 'torrent.*', 'torrent.added'])
+        self.assertMatches('torrent', ['#', '#.*'])
+
+    def test_remove(self):
+        self.trie.add('torrent.*')
+        self.trie.add('torrent.added')
+        self.trie.remove('torrent.*')
+        self.assertMatches('torrent.removed', [])
+        self.assertMatches('torrent.added', ['torrent.added'])
+        self.trie.remove('torrent.added')
+        self.assertEqual(len(self.trie), 0)
+
+class EventManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = Manager()
+
+    def test_listener_starts_at_end(self):
+        self.events.add_listener('l1', 'added')
+        self.events.fire_event('added', 1)
+        self.events.add_listener('l2', 'added')
+        self.events.fire_event('added', 2)
+        self.assertEqual(self.events.get_events('l1'),
+            [('added', (1,)), ('added', (2,))])
+        self.assertEqual(self.events.get_events('l2'), [('added', (2,))])
+        self.assertEqual(self.events.get_events('l2'), None)
+
+    def test_unknown_listener(self):
+        self.assertEqual(self.events.get_events('l1'), None)
+
+    def test_firing_order_across_events(self):
+        self.events.add_listener('l1', 'added')
+        self.events.add_listener('l1', 'removed')
+        self.events.fire_event('removed', 1)
+        self.events.fire_event('added', 2)
+        self.events.fire_event('removed', 3)
+        self.assertEqual(self.events.get_events('l1'), [('removed', (1,)),
+            ('added', (2,)), ('removed', (3,))])
+
+    def test_overlapping_patterns(self):
+        self.events.add_listener('l1', 'torrent.#')
+        self.events.add_listener('l1', 'torrent.*')
+        self.events.add_listener('l1', 'torrent.added')
+        self.events.fire_event('torrent.added', 1)
+        self.events.fire_event('torrent.file.added', 2)
+        self.assertEqual(self.events.get_events('l1'),
+            [('torrent.added', (1,)), ('torrent.file.added', (2,))])
+
+    def test_remove_listener(self):
+        logs = self.events._EventManager__logs
+        self.events.add_listener('l1', 'added')
+        self.events.add_listener('l2', 'added')
+        self.events.fire_event('added', 1)
+        self.events.remove_listener('l1', 'added')
+        self.assertEqual(logs['added'].cursors, {0: [1, None]})
+        self.events.remove_listener('l2', 'added')
+        self.assertFalse('added' in logs)
+        self.events.remove_listener('l2', 'added')
+        self.assertEqual(self.events.get_events('l2'), None)
+
+    def test_queue_depths(self):
+        self.events.add_listener('l1', 'added')
+        self.events.add_listener('l2', 'added')
+        self.events.get_events('l2')
+        for i in range(6):
+            self.events.fire_event('added', i)
+        self.events.get_events('l2')
+        self.assertEqual(self.events.get_queue_depths(), {'l1': 4, 'l2': 0})
+
+class OverflowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events = Manager()
+        self.events.log_capacity = 10
+        self.events.max_pending = 2
+        self.events.add_listener('l1', 'added')
+        self.events.add_listener('l1', 'removed')
+
+    def fire(self, *firings):
+        for event, value in firings:
+            self.events.fire_event(event, value)
+
+    def test_drop_oldest(self):
+        self.events.overflow = OVERFLOW_DROP_OLDEST
+        self.fire(('added', 1), ('added', 2), ('added', 3))
+        self.assertEqual(self.events.get_events('l1'), [
+            (EVENTS_DROPPED, ('added', 1)), ('added', (2,)), ('added', (3,))])
+        self.assertEqual(self.events.dropped, 1)
+
+    def test_drop_newest(self):
+        self.events.overflow = OVERFLOW_DROP_NEWEST
+        self.fire(('added', 1), ('added', 2), ('added', 3))
+        self.assertEqual(self.events.get_events('l1'), [
+            (EVENTS_DROPPED, ('added', 1)), ('added', (1,)), ('added', (2,))])
+
+    def test_coalesce(self):
+        self.events.overflow = OVERFLOW_COALESCE
+        self.fire(('added', 1), ('removed', 2), ('added', 3), ('added', 4))
+        self.assertEqual(self.events.get_events('l1'), [
+            (EVENTS_DROPPED, ('added', 2)), ('removed', (2,)),
+            ('added', (4,))])
+
+    def test_coalesce_then_drop_oldest(self):
+        self.events.overflow = OVERFLOW_COALESCE
+        self.events.add_listener('l1', 'moved')
+        self.fire(('added', 1), ('removed', 2), ('moved', 3))
+        self.assertEqual(self.events.get_events('l1'), [
+            (EVENTS_DROPPED, ('added', 1)), ('removed', (2,)),
+            ('moved', (3,))])
+
+    def test_coalesce_keeps_keyed(self):
+        self.events.overflow = OVERFLOW_COALESCE
+        self.events.fire_event('added', 1, key='t1')
+        self.events.fire_event('added', 2, key='t2')
+        self.assertEqual(self.events.get_events('l1'),
+            [('added', (1,)), ('added', (2,))])
+
+    def test_under_limit(self):
+        self.fire(('added', 1), ('removed', 2))
+        self.assertEqual(self.events.get_events('l1'),
+            [('added', (1,)), ('removed', (2,))])
+        self.assertEqual(self.events.dropped, 0)
+
+class WaitEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(events_module, 'reactor', self.clock)
+        self.events = Manager()
+        self.events.add_listener('l1', 'added')
+
+    def test_queued_answered_at_once(self):
+        self.events.fire_event('added', 1)
+        d = self.events.wait_events('l1')
+        self.assertEqual(self.successResultOf(d), [('added', (1,))])
+
+    def test_answered_on_fire(self):
+        d = self.events.wait_events('l1')
+        self.assertNoResult(d)
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.successResultOf(d), [('added', (1,))])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.events.get_events('l1'), None)
+
+    def test_empty_on_timeout(self):
+        d = self.events.wait_events('l1', timeout=5)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), [])
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.events.get_events('l1'), [('added', (1,))])
+
+    def test_superseded(self):
+        first = self.events.wait_events('l1')
+        second = self.events.wait_events('l1')
+        self.assertEqual(self.successResultOf(first), [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.successResultOf(second), [('added', (1,))])
+
+    def test_cancelled_on_disconnect(self):
+        request = DummyRequest([''])
+        d = self.events.wait_events('l1', request=request)
+        request.processingFailed(Exception('connection lost'))
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.events.get_events('l1'), [('added', (1,))])
+
+    def test_cancelled_superseded_leaves_newer(self):
+        first = self.events.wait_events('l1')
+        second = self.events.wait_events('l1')
+        first.cancel()
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.successResultOf(second), [('added', (1,))])
+
+class ReapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(events_module, 'time', self.clock)
+        self.events = Manager()
+        self.events.listener_timeout = 60
+        self.events.add_listener('l1', 'added')
+
+    def reap(self, seconds):
+        self.clock.now += seconds
+        self.events._reap_listeners()
+
+    def test_idle_reaped(self):
+        self.reap(61)
+        self.assertEqual(self.events.reaped, 1)
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.events.get_events('l1'), None)
+
+    def test_collecting_kept(self):
+        self.reap(50)
+        self.events.get_events('l1')
+        self.reap(50)
+        self.assertEqual(self.events.reaped, 0)
+
+    def test_waiting_kept(self):
+        d = self.events.wait_events('l1')
+        self.reap(61)
+        self.assertEqual(self.events.reaped, 0)
+        d.cancel()
+        self.assertFailure(d, defer.CancelledError)
+
+    def test_pinned_kept(self):
+        self.events.pin_listener('l1')
+        self.reap(61)
+        self.assertEqual(self.events.reaped, 0)
+        self.events.unpin_listener('l1')
+        self.reap(0)
+        self.assertEqual(self.events.reaped, 1)
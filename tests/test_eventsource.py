@@ -0,0 +1,77 @@
+#
+# tests/test_eventsource.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew import events as events_module
+from corkscrew.events import EventManager
+from corkscrew.eventsource import EventStream
+
+from tests.test_events import FakeTime
+
+class Manager(EventManager):
+    listener_timeout = None
+
+class Request(DummyRequest):
+
+    def registerProducer(self, producer, streaming):
+        # DummyRequest only handles pull producers
+        self.producer = producer
+
+class EventStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(events_module, 'time', self.clock)
+        self.events = Manager()
+        self.events.listener_timeout = 60
+        self.request = Request([''])
+        self.stream = EventStream(self.request, self.events, ['added'], 15)
+        self.stream.start()
+
+    def tearDown(self):
+        if not self.stream.finished:
+            self.request.finish()
+
+    def test_events_written(self):
+        self.events.fire_event('added', 1)
+        self.assertEqual(self.request.written[-1],
+            'event: added\ndata: [1]\n\n')
+
+    def test_paused_not_reaped(self):
+        self.stream.pauseProducing()
+        self.events.fire_event('added', 1)
+        self.clock.now += 120
+        self.events._reap_listeners()
+        self.assertEqual(self.events.reaped, 0)
+
+        self.stream.resumeProducing()
+        self.assertEqual(self.request.written[-1],
+            'event: added\ndata: [1]\n\n')
+
+    def test_finished_removes_listener(self):
+        self.request.finish()
+        self.assertEqual(self.events.get_stats()['listeners'], 0)
+        self.clock.now += 120
+        self.events._reap_listeners()
+        self.assertEqual(self.events.reaped, 0)
@@ -0,0 +1,201 @@
+#
+# tests/test_jsonrpc.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import zlib
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew import common
+from corkscrew import jsonrpc as jsonrpc_module
+from corkscrew.common import json
+from corkscrew.jsonrpc import JsonRpc, export
+
+class Methods(object):
+
+    def __init__(self):
+        self.calls = []
+        self.cancelled = []
+
+    @export
+    def later(self):
+        d = defer.Deferred(self.cancelled.append)
+        self.calls.append(d)
+        return d
+
+class Log(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg, *args):
+        self.errors.append(msg % args)
+
+class Request(DummyRequest):
+
+    def __init__(self, method, **kwargs):
+        DummyRequest.__init__(self, [''])
+        self._disconnected = False
+        self.json = json.dumps(dict(kwargs, method=method, params=[], id=1))
+
+    def getCookie(self, name):
+        return None
+
+    def disconnect(self):
+        self._disconnected = True
+        self.processingFailed(Failure(ConnectionDone()))
+
+    def response(self):
+        return json.loads(zlib.decompress(''.join(self.written),
+            zlib.MAX_WBITS + 16))
+
+class CallDeadlineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(jsonrpc_module, 'reactor', self.clock)
+        self.rpc = JsonRpc()
+        self.rpc.timeout = 5
+        self.methods = Methods()
+        self.rpc.register_object(self.methods, 'test')
+
+    def call(self):
+        request = Request('test.later')
+        self.rpc.on_json_request(request)
+        return request
+
+    def assertReleased(self):
+        self.assertEqual(self.rpc.limiter.total, 0)
+        self.assertEqual(self.rpc.limiter.running, {})
+        self.assertEqual(len(self.rpc.limiter.queue), 0)
+
+    def test_deadline_while_running(self):
+        request = self.call()
+        self.assertEqual(len(self.methods.calls), 1)
+        self.clock.advance(4)
+        self.assertEqual(request.written, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.methods.cancelled), 1)
+        self.assertEqual(request.response()['error'],
+            {'message': 'Timed out', 'code': 5})
+        self.assertEqual(request.finished, 1)
+        self.assertReleased()
+
+    def test_deadline_while_queued(self):
+        self.rpc.limiter.max_concurrent = 1
+        self.assertTrue(self.rpc.limiter.try_acquire('test.other'))
+        request = self.call()
+        self.assertEqual(len(self.rpc.limiter.queue), 1)
+        self.clock.advance(5)
+        self.assertEqual(request.response()['error'],
+            {'message': 'Timed out', 'code': 5})
+        self.assertEqual(len(self.rpc.limiter.queue), 0)
+
+        # The call was never started, so freeing the slot doesn't start it
+        self.rpc.limiter.release('test.other')
+        self.assertEqual(self.methods.calls, [])
+        self.assertReleased()
+
+    def test_result_cancels_deadline(self):
+        request = self.call()
+        self.methods.calls[0].callback(1)
+        self.assertEqual(request.response()['result'], 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertReleased()
+
+    def test_disconnect_cancels_call(self):
+        request = self.call()
+        request.disconnect()
+        self.assertEqual(len(self.methods.cancelled), 1)
+        self.assertEqual(request.written, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertReleased()
+
+    def test_disconnect_while_compressing(self):
+        compressing = defer.Deferred()
+        self.patch(jsonrpc_module, 'compress_async',
+            lambda body, request: compressing)
+        log = Log()
+        self.patch(common, 'log', log)
+
+        request = self.call()
+        self.methods.calls[0].callback(1)
+        request.disconnect()
+        self.assertTrue(compressing.called)
+        self.assertEqual(log.errors, [])
+        self.assertEqual(request.written, [])
+        self.assertEqual(request.finished, 0)
+        self.assertReleased()
+
+class Cacheable(object):
+
+    def __init__(self):
+        self.result = {}
+
+    @export(cacheable=True)
+    def get(self):
+        return self.result
+
+def ordered(*items):
+    result = {}
+    for key, value in items:
+        result[key] = value
+    return result
+
+class CacheableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rpc = JsonRpc()
+        self.methods = Cacheable()
+        self.rpc.register_object(self.methods, 'test')
+
+    def call(self, digest=None):
+        if digest is None:
+            request = Request('test.get')
+        else:
+            request = Request('test.get', hash=digest)
+        self.rpc.on_json_request(request)
+        return request.response()
+
+    def test_not_modified(self):
+        # These keys collide in a dict, so the order they come out in
+        # depends on the order they went in.
+        self.methods.result = ordered(('t0', 1), ('t8', 2))
+        response = self.call()
+        self.assertEqual(response['result'], {'t0': 1, 't8': 2})
+
+        self.methods.result = ordered(('t8', 2), ('t0', 1))
+        response = self.call(response['hash'])
+        self.assertEqual(response['not_modified'], True)
+        self.assertEqual(response['result'], None)
+
+    def test_changed(self):
+        self.methods.result = {'t0': 1}
+        digest = self.call()['hash']
+        self.methods.result = {'t0': 2}
+        response = self.call(digest)
+        self.assertFalse(response.get('not_modified'))
+        self.assertEqual(response['result'], {'t0': 2})
+        self.assertNotEqual(response['hash'], digest)
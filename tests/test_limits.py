@@ -0,0 +1,178 @@
+#
+# tests/test_limits.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew.errors import AuthError, JsonError, OverloadError
+from corkscrew.jsonrpc import JsonRpc, export
+from corkscrew.limits import ConcurrencyLimiter
+
+class ConcurrencyLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = ConcurrencyLimiter(max_concurrent=2, max_queued=2)
+
+    def test_try_acquire(self):
+        self.assertTrue(self.limiter.try_acquire('a'))
+        self.assertTrue(self.limiter.try_acquire('b'))
+        self.assertFalse(self.limiter.try_acquire('a'))
+        self.limiter.release('a')
+        self.assertTrue(self.limiter.try_acquire('a'))
+
+    def test_key_limit(self):
+        self.limiter.set_limit('a', 1)
+        self.assertTrue(self.limiter.try_acquire('a'))
+        self.assertFalse(self.limiter.try_acquire('a'))
+        self.assertTrue(self.limiter.try_acquire('b'))
+        self.limiter.set_limit('a', None)
+        self.limiter.release('b')
+        self.assertTrue(self.limiter.try_acquire('a'))
+
+    def test_queued_started_on_release(self):
+        self.limiter.try_acquire('a')
+        self.limiter.try_acquire('a')
+        started = []
+        self.limiter.acquire('b').addCallback(started.append)
+        self.assertEqual(started, [])
+        self.limiter.release('a')
+        self.assertEqual(started, [None])
+        self.assertEqual(self.limiter.running, {'a': 1, 'b': 1})
+        self.assertEqual(self.limiter.waited, 1)
+
+    def test_queued_behind_key_limit(self):
+        # A call held back by its own key's limit doesn't hold up calls
+        # for other keys queued behind it.
+        self.limiter.set_limit('a', 1)
+        self.limiter.try_acquire('a')
+        self.limiter.try_acquire('b')
+        started = []
+        self.limiter.acquire('a').addCallback(lambda r: started.append('a'))
+        self.limiter.acquire('c').addCallback(lambda r: started.append('c'))
+        self.limiter.release('b')
+        self.assertEqual(started, ['c'])
+        self.limiter.release('c')
+        self.limiter.release('a')
+        self.assertEqual(started, ['c', 'a'])
+
+    def test_overload(self):
+        self.limiter.try_acquire('a')
+        self.limiter.try_acquire('a')
+        self.limiter.acquire('a')
+        self.limiter.acquire('a')
+        self.assertRaises(OverloadError, self.limiter.acquire, 'a')
+        self.assertEqual(self.limiter.rejected, 1)
+
+    def test_cancel_while_queued(self):
+        self.limiter.try_acquire('a')
+        self.limiter.try_acquire('a')
+        d = self.limiter.acquire('b')
+        started = []
+        self.limiter.acquire('c').addCallback(started.append)
+        d.cancel()
+        self.assertEqual(len(self.limiter.queue), 1)
+
+        self.limiter.release('a')
+        self.assertEqual(started, [None])
+        self.assertEqual(self.limiter.running, {'a': 1, 'c': 1})
+        self.assertEqual(len(self.limiter.queue), 0)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_release_reentrant(self):
+        # Calls that complete as soon as they start release from within
+        # release, each queued call must still start exactly once.
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queued=10)
+        limiter.try_acquire('a')
+        started = []
+        def run(result, i):
+            started.append(i)
+            limiter.release('a')
+        for i in range(5):
+            limiter.acquire('a').addCallback(run, i)
+        limiter.release('a')
+        self.assertEqual(started, [0, 1, 2, 3, 4])
+        self.assertEqual(limiter.total, 0)
+        self.assertEqual(limiter.running, {})
+        self.assertEqual(len(limiter.queue), 0)
+
+class Methods(object):
+
+    def __init__(self):
+        self.d = defer.Deferred()
+
+    @export
+    def ok(self):
+        return 1
+
+    @export
+    def fail(self):
+        raise ValueError('failed')
+
+    @export
+    def later(self):
+        return self.d
+
+class JsonRpcReleaseTestCase(unittest.TestCase):
+    """
+    Checks that a call's place is given up however it completes.
+    """
+
+    def setUp(self):
+        self.rpc = JsonRpc()
+        self.methods = Methods()
+        self.rpc.register_object(self.methods, 'test')
+        self.request = DummyRequest([''])
+
+    def call(self, method):
+        self.assertTrue(self.rpc.limiter.try_acquire(method))
+        return self.rpc.call_method(method, [], self.request)
+
+    def assertReleased(self):
+        self.assertEqual(self.rpc.limiter.total, 0)
+        self.assertEqual(self.rpc.limiter.running, {})
+
+    def test_release_on_result(self):
+        self.assertEqual(self.call('test.ok'), 1)
+        self.assertReleased()
+
+    def test_release_on_auth_error(self):
+        def check_request(request, method=None, level=None):
+            raise AuthError('Not authenticated')
+        self.rpc.auth = self
+        self.check_request = check_request
+        e = self.assertRaises(JsonError, self.call, 'test.ok')
+        self.assertEqual(e.code, 1)
+        self.assertReleased()
+        self.assertEqual(self.rpc.stats.methods['test.ok'].errors, 1)
+
+    def test_release_on_error(self):
+        e = self.assertRaises(JsonError, self.call, 'test.fail')
+        self.assertEqual(e.code, 3)
+        self.assertReleased()
+
+    def test_release_on_deferred(self):
+        d = self.call('test.later')
+        self.assertEqual(self.rpc.limiter.total, 1)
+        self.methods.d.errback(ValueError('failed'))
+        self.assertReleased()
+        return self.assertFailure(d, ValueError)
@@ -0,0 +1,85 @@
+#
+# tests/test_metrics.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.trial import unittest
+
+from corkscrew.events import EventManager
+from corkscrew.jsonrpc import JsonRpc, export
+from corkscrew.metrics import Registry
+
+class Manager(EventManager):
+    listener_timeout = None
+
+class Methods(object):
+
+    @export
+    def ok(self):
+        return 1
+
+class Collector(object):
+
+    def __init__(self, registry, count):
+        self.gauge = registry.gauge('test_gauge', 'A gauge', collected=True)
+        self.count = count
+        registry.add_collector(self)
+
+    def collect_metrics(self):
+        self.gauge.inc(amount=self.count)
+
+class RegistryTestCase(unittest.TestCase):
+
+    def test_collected_gauges_summed(self):
+        registry = Registry()
+        collectors = [Collector(registry, 2), Collector(registry, 3)]
+        self.assertTrue('test_gauge 5.0' in registry.render())
+        # Values are collected afresh rather than added to the last ones
+        self.assertTrue('test_gauge 5.0' in registry.render())
+        collectors.pop()
+        self.assertTrue('test_gauge 2.0' in registry.render())
+
+class CollectMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from corkscrew import events, jsonrpc
+        self.events = events
+        self.jsonrpc = jsonrpc
+        for metric in (jsonrpc.RPC_CALLS, events.EVENT_LISTENERS):
+            self.addCleanup(metric.values.update, dict(metric.values))
+            metric.clear()
+
+    def test_calls_not_reset(self):
+        rpc = JsonRpc()
+        rpc.register_object(Methods(), 'test')
+        rpc.limiter.try_acquire('test.ok')
+        rpc.call_method('test.ok', [], None)
+        rpc.reset_stats()
+        rpc.collect_metrics()
+        self.assertEqual(self.jsonrpc.RPC_CALLS.get(('test.ok',)), 1)
+
+    def test_listeners_summed(self):
+        first, second = Manager(), Manager()
+        first.add_listener('l1', 'added')
+        second.add_listener('l2', 'added')
+        second.add_listener('l3', 'added')
+        first.collect_metrics()
+        second.collect_metrics()
+        self.assertEqual(self.events.EVENT_LISTENERS.get(), 3)
@@ -0,0 +1,107 @@
+#
+# tests/test_profiler.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import tempfile
+
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from corkscrew import server as server_module
+from corkscrew.jsonrpc import JsonRpc, export
+from corkscrew.profiler import RequestProfiler
+from corkscrew.server import StaticResources
+
+class Methods(object):
+
+    @export
+    def ok(self):
+        return 1
+
+class JsonRpcProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rpc = JsonRpc()
+        self.rpc.register_object(Methods(), 'test')
+        self.rpc.profiler = RequestProfiler()
+        self.rpc.profiler.set_rate(1)
+
+    def call(self, method, *params):
+        request = DummyRequest([''])
+        request._disconnected = False
+        request.method = 'POST'
+        request.content = StringIO('{"method": "%s", "params": [%s], "id": 1}'
+            % (method, ', '.join(params)))
+        self.rpc.render(request)
+        return request
+
+    def test_method_profiled(self):
+        self.call('test.ok')
+        self.call('system.listMethods')
+        self.assertEqual(self.rpc.profiler.counts,
+            {'test.ok': 1, 'system.listMethods': 1})
+
+    def test_unknown_method_not_profiled(self):
+        self.call('test.missing')
+        self.call('system.profile')
+        self.assertEqual(self.rpc.profiler.counts, {})
+
+    def test_dump_private_directory(self):
+        self.call('test.ok')
+        paths = self.rpc.exec_profile_method('system.profileDump', [])
+        self.assertEqual(len(paths), 1)
+        directory = os.path.dirname(paths[0])
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, paths[0])
+        self.assertNotEqual(directory, tempfile.gettempdir())
+        self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+        self.assertTrue(os.path.isfile(paths[0]))
+
+class StaticProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = RequestProfiler()
+        self.profiler.set_rate(1)
+        self.patch(server_module, 'profiler', self.profiler)
+        self.resource = StaticResources()
+        path = os.path.abspath(self.mktemp()) + '.js'
+        open(path, 'w').write('var test = 1;')
+        self.resource.add_file('/test.js', path)
+
+    def get(self, path):
+        request = DummyRequest(path.split('/'))
+        request._disconnected = False
+        request.path = path
+        request.lookup_path = path
+        self.resource.render(request)
+        return request
+
+    def test_file_profiled(self):
+        self.get('/test.js')
+        self.assertEqual(self.profiler.counts, {'/test.js': 1})
+
+    def test_missing_file_not_profiled(self):
+        request = self.get('/missing.js')
+        self.assertEqual(request.responseCode, 404)
+        self.assertEqual(self.profiler.counts, {})
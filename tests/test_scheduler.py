@@ -0,0 +1,92 @@
+#
+# tests/test_scheduler.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.trial import unittest
+
+from corkscrew.scheduler import (FairScheduler, PRIORITY_BULK,
+    PRIORITY_INTERACTIVE, PRIORITY_NORMAL)
+
+def can_run(key):
+    return True
+
+class FairSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = FairScheduler()
+
+    def push(self, priority, count, session=None):
+        for i in range(count):
+            self.queue.push((object(), priority, 0), priority, session)
+
+    def pop(self, count):
+        return [self.queue.pop(can_run)[1] for i in range(count)]
+
+    def test_shares(self):
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK):
+            self.push(priority, 26)
+        for i in range(2):
+            started = self.pop(13)
+            self.assertEqual(started.count(PRIORITY_INTERACTIVE), 8)
+            self.assertEqual(started.count(PRIORITY_NORMAL), 4)
+            self.assertEqual(started.count(PRIORITY_BULK), 1)
+        self.assertEqual(len(self.queue), 52)
+
+    def test_bulk_not_starved(self):
+        self.push(PRIORITY_INTERACTIVE, 100)
+        self.push(PRIORITY_BULK, 1)
+        self.assertTrue(PRIORITY_BULK in self.pop(9))
+
+    def test_idle_class_does_not_catch_up(self):
+        self.push(PRIORITY_NORMAL, 20)
+        self.pop(10)
+        self.push(PRIORITY_BULK, 10)
+        # Bulk was idle while normal calls ran, so it only gets its share
+        # from now on rather than every call until it catches up.
+        self.assertEqual(self.pop(5).count(PRIORITY_BULK), 1)
+
+    def test_default_priority(self):
+        self.queue.push((object(), 'a', 0))
+        self.assertEqual(self.queue.get_stats(),
+            {PRIORITY_NORMAL: {'queued': 1, 'started': 0}})
+
+    def test_sessions_take_turns(self):
+        for session, count in (('s1', 3), ('s2', 1), ('s3', 1)):
+            for i in range(count):
+                self.queue.push((object(), session, 0), None, session)
+        self.assertEqual(self.pop(5), ['s1', 's2', 's3', 's1', 's1'])
+
+    def test_skips_calls_that_cannot_run(self):
+        self.queue.push((object(), 'a', 0), PRIORITY_INTERACTIVE)
+        self.queue.push((object(), 'b', 0), PRIORITY_BULK)
+        call = self.queue.pop(lambda key: key == 'b')
+        self.assertEqual(call[1], 'b')
+        self.assertEqual(self.queue.pop(lambda key: False), None)
+        self.assertEqual(len(self.queue), 1)
+
+    def test_remove(self):
+        d = object()
+        self.queue.push((d, 'a', 0), PRIORITY_BULK, 's1')
+        self.queue.push((object(), 'b', 0), PRIORITY_BULK, 's1')
+        self.queue.remove(d)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.pop(1), ['b'])
+        self.assertEqual(self.queue.classes[PRIORITY_BULK].sessions, {})
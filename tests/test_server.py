@@ -0,0 +1,230 @@
+#
+# tests/test_server.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+import zlib
+import struct
+import signal
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.test.requesthelper import DummyChannel, DummyRequest
+
+from corkscrew import server as server_module
+from corkscrew.server import (CorkscrewRequest, CorkscrewServer,
+    CorkscrewSite, GetText)
+
+def write_catalog(path, messages):
+    """
+    Writes a GNU gettext catalog of the messages, in the format msgfmt
+    produces.
+    """
+    ids = sorted(messages)
+    strs = [messages[i] for i in ids]
+    header = 7 * 4
+    ids_start = header + len(ids) * 16
+    offsets = []
+    data = ''
+    for text in ids + strs:
+        offsets.append((len(text), ids_start + len(data)))
+        data += text + '\0'
+    contents = struct.pack('<7I', 0x950412de, 0, len(ids), header,
+        header + len(ids) * 8, 0, 0)
+    for length, offset in offsets:
+        contents += struct.pack('<2I', length, offset)
+    os.makedirs(os.path.dirname(path))
+    open(path, 'wb').write(contents + data)
+
+class Transport(DummyChannel.TCP):
+    connected = True
+
+    def loseConnection(self):
+        self.connected = False
+
+class Channel(DummyChannel):
+    TCP = Transport
+
+class Parked(resource.Resource):
+    """
+    Leaves every request it renders in flight.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append(request)
+        return server.NOT_DONE_YET
+
+class Producer(object):
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+class Server(CorkscrewServer):
+
+    def _spawn_worker(self, ready_fd=None):
+        # Keep the replacement's end of the pipe open in its place.
+        self.ready_fds.append(os.dup(ready_fd))
+        pid = 200 + len(self.ready_fds)
+        self.children[pid] = 0
+        return pid
+
+class RotateWorkersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.killed = []
+        self.patch(os, 'kill', lambda pid, sig: self.killed.append((pid, sig)))
+        self.server = Server(resource.Resource(), workers=2)
+        self.server.ready_fds = []
+        self.server.children = {101: 0, 102: 0}
+        self.server.stopping = False
+        self.server.retiring = None
+        self.server.replacing = None
+        self.server.restarting = [101, 102]
+
+    def tearDown(self):
+        for fd in self.server.ready_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def test_retired_once_ready(self):
+        self.server._rotate_workers()
+        self.server._rotate_workers()
+        self.assertEqual(self.killed, [])
+        self.assertEqual(self.server.retiring, None)
+
+        os.write(self.server.ready_fds[0], 'ready\n')
+        self.server._rotate_workers()
+        self.assertEqual(self.killed, [(101, signal.SIGTERM)])
+        self.assertEqual(self.server.retiring, 101)
+        self.assertEqual(self.server.replacing, None)
+        self.assertEqual(self.server.restarting, [102])
+
+    def test_replacement_not_ready(self):
+        self.server._rotate_workers()
+        os.close(self.server.ready_fds.pop())
+        self.server._rotate_workers()
+        self.assertEqual(self.killed, [(201, signal.SIGTERM)])
+        self.assertEqual(self.server.retiring, 201)
+        self.assertEqual(self.server.restarting, [])
+        self.assertTrue(101 in self.server.children)
+
+class DrainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(server_module, 'reactor', self.clock)
+        self.parked = Parked()
+        self.site = CorkscrewSite(self.parked)
+
+    def start(self):
+        channel = Channel()
+        channel.site = self.site
+        request = CorkscrewRequest(channel)
+        request.gotLength(0)
+        request.requestReceived('GET', '/', 'HTTP/1.1')
+        return request
+
+    def test_idle(self):
+        self.assertTrue(self.successResultOf(self.site.drain(5)))
+
+    def test_completed(self):
+        request = self.start()
+        self.assertEqual(self.site.in_flight, set([request]))
+        drained = self.site.drain(5)
+        self.assertNoResult(drained)
+        request.finish()
+        self.assertTrue(self.successResultOf(drained))
+        self.assertFalse(request.transport.connected)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_waits_for_every_request(self):
+        first, second = self.start(), self.start()
+        drained = self.site.drain(5)
+        first.finish()
+        self.assertNoResult(drained)
+        self.assertTrue(first.transport.connected)
+        second.finish()
+        self.assertTrue(self.successResultOf(drained))
+
+    def test_timeout(self):
+        request = self.start()
+        drained = self.site.drain(5)
+        self.clock.advance(4)
+        self.assertNoResult(drained)
+        self.clock.advance(1)
+        self.assertFalse(self.successResultOf(drained))
+        self.assertEqual(self.site.in_flight, set([request]))
+        request.finish()
+        self.assertEqual(self.site.in_flight, set())
+
+    def test_streaming_finished(self):
+        request = self.start()
+        request.streaming = True
+        request.registerProducer(Producer(), True)
+        self.assertTrue(self.successResultOf(self.site.drain(5)))
+        self.assertTrue(request.finished)
+        self.assertEqual(request.producer, None)
+        self.assertEqual(self.site.in_flight, set())
+
+class GetTextTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = os.path.abspath(self.mktemp())
+        os.makedirs(directory)
+        path = os.path.join(directory, 'gettext.js')
+        open(path, 'w').write("var hello = '${escape(_(\'Hello\'))}';")
+        locales = os.path.join(directory, 'locales')
+        write_catalog(os.path.join(locales, 'de', 'LC_MESSAGES',
+            'messages.mo'), {'Hello': 'Hallo'})
+        self.resource = GetText(path, locales)
+
+    def get(self, locale):
+        request = DummyRequest([''])
+        request.args = {'locale': [locale]}
+        return zlib.decompress(self.resource.render(request),
+            zlib.MAX_WBITS + 16)
+
+    def test_translated(self):
+        self.assertEqual(self.get('de'), "var hello = 'Hallo';")
+
+    def test_untranslated(self):
+        self.assertEqual(self.get('fr'), "var hello = 'Hello';")
+
+    def test_cached_per_locale(self):
+        self.get('de')
+        self.get('fr')
+        self.assertEqual(self.get('de_DE'), "var hello = 'Hallo';")
+        self.assertEqual(sorted(self.resource.cache), [None, 'de'])
@@ -0,0 +1,88 @@
+#
+# tests/test_stats.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+from twisted.trial import unittest
+
+from corkscrew.stats import Histogram
+
+class HistogramTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.histogram = Histogram()
+
+    def get_index(self, value):
+        histogram = Histogram()
+        histogram.record(value)
+        return histogram.counts.keys()[0]
+
+    def assertBucket(self, value, index, top):
+        self.assertEqual(self.get_index(value), index)
+        self.assertEqual(self.histogram.bucket_value(index), top)
+
+    def test_boundaries(self):
+        self.assertBucket(0, 0, 0)
+        self.assertBucket(31, 31, 31)
+        self.assertBucket(32, 32, 32)
+        self.assertBucket(63, 63, 63)
+        self.assertBucket(64, 64, 65)
+        self.assertBucket(65, 64, 65)
+        self.assertBucket(66, 65, 67)
+        self.assertBucket(127, 95, 127)
+        self.assertBucket(128, 96, 131)
+
+    def test_large(self):
+        self.assertBucket(10 ** 6, 509, 1015807)
+        self.assertBucket(2 ** 40, 1152, 2 ** 40 + 2 ** 35 - 1)
+        self.assertBucket(2 ** 70 - 1, 2111, 2 ** 70 - 1)
+
+    def test_buckets_contiguous(self):
+        # Every value falls in the bucket after the one holding the value
+        # before it, or the same one, and is reported to within 1 / 32.
+        values = range(1, 5000) + [2 ** 20 + i for i in range(-40, 40)]
+        for value in values:
+            index = self.get_index(value)
+            self.assertIn(index - self.get_index(value - 1), (0, 1))
+            top = self.histogram.bucket_value(index)
+            self.assertTrue(value <= top <= value + value / 32)
+            if index:
+                self.assertTrue(self.histogram.bucket_value(index - 1) < value)
+
+    def test_percentiles(self):
+        for value in (31, 32, 63, 64):
+            self.histogram.record(value)
+        self.assertEqual(self.histogram.percentiles(25, 50, 75, 100),
+            [31, 32, 63, 64])
+        self.assertEqual(self.histogram.min, 31)
+        self.assertEqual(self.histogram.total, 190)
+
+    def test_percentiles_large(self):
+        self.histogram.record(10 ** 6)
+        self.assertEqual(self.histogram.percentiles(50), [10 ** 6])
+        self.histogram.record(10 ** 9)
+        self.assertEqual(self.histogram.percentiles(50, 99.9),
+            [1015807, 10 ** 9])
+
+    def test_percentiles_empty(self):
+        self.assertEqual(self.histogram.percentiles(50, 99), [0, 0])
+        self.histogram.record(5)
+        self.histogram.reset()
+        self.assertEqual(self.histogram.percentiles(50), [0])
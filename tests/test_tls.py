@@ -0,0 +1,101 @@
+#
+# tests/test_tls.py
+#
+# Copyright (C) 2010 Damien Churchill <damoxc@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA    02110-1301, USA.
+#
+
+import os
+
+from OpenSSL import crypto
+from twisted.trial import unittest
+
+from corkscrew.tls import ServerContextFactory
+
+def make_key():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    return key
+
+def make_cert(key):
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return cert
+
+class ReloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base = os.path.abspath(self.mktemp())
+        os.makedirs(base)
+        self.cert = os.path.join(base, 'server.crt')
+        self.key = os.path.join(base, 'server.key')
+        self.mtime = 1000
+        self.write(make_key())
+        self.factory = ServerContextFactory(self.cert, self.key)
+        self.context = self.factory.getContext()
+
+    def write(self, key, cert=None, key_pem=None, cert_pem=None):
+        if key_pem is None:
+            key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+        if cert_pem is None:
+            cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM,
+                cert or make_cert(key))
+        open(self.key, 'wb').write(key_pem)
+        open(self.cert, 'wb').write(cert_pem)
+        # Make sure the change is seen however coarse the file system's
+        # timestamps are.
+        self.mtime += 10
+        for path in (self.cert, self.key):
+            os.utime(path, (self.mtime, self.mtime))
+
+    def test_unchanged(self):
+        self.assertFalse(self.factory.reload())
+        self.assertIdentical(self.factory.getContext(), self.context)
+
+    def test_changed(self):
+        self.write(make_key())
+        self.assertTrue(self.factory.reload())
+        self.assertNotIdentical(self.factory.getContext(), self.context)
+
+    def test_bad_cert_keeps_old(self):
+        self.write(make_key(), cert_pem='not a certificate')
+        self.assertFalse(self.factory.reload())
+        self.assertIdentical(self.factory.getContext(), self.context)
+
+    def test_mismatched_key_keeps_old(self):
+        self.write(make_key(), cert=make_cert(make_key()))
+        self.assertFalse(self.factory.reload())
+        self.assertIdentical(self.factory.getContext(), self.context)
+
+    def test_missing_key_keeps_old(self):
+        os.remove(self.key)
+        self.assertFalse(self.factory.reload())
+        self.assertIdentical(self.factory.getContext(), self.context)
+
+    def test_retried_once_fixed(self):
+        self.write(make_key(), key_pem='not a key')
+        self.assertFalse(self.factory.reload())
+        self.write(make_key())
+        self.assertTrue(self.factory.reload())
+        self.assertNotIdentical(self.factory.getContext(), self.context)